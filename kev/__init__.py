@@ -1,3 +1,4 @@
 from .document import Document, BaseDocument
 from .properties import *
 from .loading import KevHandler
+from .query import Q, Avg, Count, Max, Min, Sum
@@ -1,11 +1,46 @@
 import json
 import hashlib
+import heapq
+import itertools
+import time
 import uuid
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from valley.exceptions import ValidationException
-from kev.utils import get_doc_type
-from kev.query import SortingParam
+from kev.exceptions import DocNotFoundError, ResourceError
+from kev.utils import get_doc_type, chunks
+from kev.query import AllParam, SortingParam
+
+
+class BulkSaveResult(object):
+    """
+    Outcome of a bulk save. results holds either the saved document or the
+    exception raised for it, in the same order as the documents passed in.
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def saved(self):
+        return [i for i in self.results if not isinstance(i, Exception)]
+
+    @property
+    def errors(self):
+        return {index: i for index, i in enumerate(self.results)
+                if isinstance(i, Exception)}
+
+    @property
+    def docs_per_second(self):
+        if not self.elapsed:
+            return float(len(self.saved))
+        return len(self.saved) / self.elapsed
+
+    def __repr__(self):
+        return '<BulkSaveResult: saved={0} errors={1} docs/sec={2:.1f}>'.format(
+            len(self.saved), len(self.errors), self.docs_per_second)
 
 
 class DocDB(object):
@@ -14,6 +49,11 @@ class DocDB(object):
     backend_id = None
     doc_id_string = '{doc_id}:id:{backend_id}:{class_name}'
     index_id_string = ''
+    # Defaults for the optional chunk_size and max_workers connection settings
+    chunk_size = 500
+    max_workers = 10
+    # Whether a document that was loaded or saved only writes its changes
+    partial_updates = False
 
     def save(self, doc_obj):
         raise NotImplementedError
@@ -21,63 +61,425 @@ class DocDB(object):
     def delete(self, doc_obj):
         raise NotImplementedError
 
-    def get(self, doc_obj, doc_id):
+    def delete_many(self, doc_list):
+        """
+        Deletes a batch of loaded documents and returns how many were
+        deleted. Backends override this to batch the round trips.
+        """
+        for doc_obj in doc_list:
+            self.delete(doc_obj)
+        return len(doc_list)
+
+    def get(self, doc_obj, doc_id, fields=None):
         raise NotImplementedError
 
+    def paginate(self, iterable, skip, limit):
+        """
+        Applies skip and limit lazily so items outside of the window are
+        never fetched.
+        """
+        skip = skip or 0
+        stop = skip + limit if limit is not None else None
+        return itertools.islice(iterable, skip, stop)
+
+    def iterate(self, filters_list, sortingp_list, all_param, doc_class,
+                chunk_size=None, fields=None):
+        """
+        Yields the documents of a query fetching chunk_size documents at a
+        time. Backends whose evaluate already streams can keep this one.
+        """
+        return self.evaluate(filters_list, sortingp_list, all_param, doc_class,
+                             fields=fields)
+
+    def window_count(self, total, all_param):
+        """Applies the skip and limit of all_param to a result count."""
+        total = max(total - (all_param.skip or 0), 0)
+        if all_param.limit is not None:
+            total = min(total, all_param.limit)
+        return total
+
+    def count(self, filters_list, all_param, doc_class):
+        """
+        Returns the number of documents matching a query. Backends override
+        this to count ids without fetching the documents.
+        """
+        return sum(1 for i in self.evaluate(filters_list, [], all_param, doc_class))
+
+    def evaluate_values(self, filters_list, sortingp_list, all_param, doc_class,
+                        fields):
+        """
+        Yields a list with the Python values of fields for each result. This
+        version builds the documents; backends override it to convert their
+        raw replies without constructing documents.
+        """
+        docs = self.evaluate(filters_list, sortingp_list, all_param, doc_class,
+                             fields=[key for key in fields if key != 'id'])
+        for doc in docs:
+            yield [getattr(doc, key) for key in fields]
+
+    def facets(self, filters_list, doc_class, props):
+        """
+        Returns {prop: {value: count}} with the number of matching documents
+        per indexed value of props. This version streams the values of the
+        documents; backends override it to count with their indexes.
+        """
+        facets = {prop: {} for prop in props}
+        all_param = AllParam(all=filters_list is None)
+        for values in self.evaluate_values(filters_list, [], all_param, doc_class,
+                                           list(props)):
+            for prop, value in zip(props, values):
+                if value is None:
+                    continue
+                # Index values of strings are lowercase
+                if isinstance(value, str):
+                    value = value.lower()
+                facets[prop][value] = facets[prop].get(value, 0) + 1
+        return facets
+
+    def aggregate(self, filters_list, doc_class, aggregates):
+        """
+        Returns the number of documents matching filters_list and a dict
+        with a (count, sum, min, max) tuple of the values of the field of
+        each aggregate. This version streams the values of the documents a
+        chunk at a time; backends override it to compute them on the server.
+        """
+        fields = sorted(set(i.field for i in aggregates if i.field is not None))
+        stats = {field: [0, 0, None, None] for field in fields}
+        doc_count = 0
+        all_param = AllParam(all=filters_list is None)
+        for values in self.evaluate_values(filters_list, [], all_param, doc_class,
+                                           ['id'] + fields):
+            doc_count += 1
+            for field, value in zip(fields, values[1:]):
+                if value is None:
+                    continue
+                field_stats = stats[field]
+                field_stats[0] += 1
+                if isinstance(value, (int, float)):
+                    field_stats[1] += value
+                if field_stats[2] is None or value < field_stats[2]:
+                    field_stats[2] = value
+                if field_stats[3] is None or value > field_stats[3]:
+                    field_stats[3] = value
+        return doc_count, {field: tuple(i) for field, i in stats.items()}
+
+    def build_compound_indexes(self, doc_class):
+        """
+        Writes the compound index entries of the existing documents of
+        doc_class, for documents saved before Meta.compound_indexes listed
+        the indexes. Reads every document of the class once.
+        """
+        docs = self.iterate(None, [], AllParam(all=True), doc_class,
+                            fields=sorted(doc_class._compound_props))
+        for chunk in chunks(docs, self.get_chunk_size()):
+            self.add_compound_indexes(chunk)
+
+    def add_compound_indexes(self, doc_list):
+        raise NotImplementedError
+
+    def get_raw_keys(self, fields):
+        return ['_id' if key == 'id' else key for key in fields]
+
+    def get_value_loader(self, doc_class, fields):
+        """
+        Returns a function turning the raw values of fields, in order, into
+        the Python values a document would return for them.
+        """
+        converters = [self.parse_id if key == 'id' else
+                      self.get_value_converter(doc_class._base_properties[key])
+                      for key in fields]
+        return lambda values: [convert(value) for convert, value
+                               in zip(converters, values)]
+
+    def get_value_converter(self, prop):
+        def convert(value):
+            # Same coercion as BaseSchema.process_schema_kwargs
+            value = value or prop.get_default_value()
+            try:
+                return prop.get_python_value(value)
+            except ValueError:
+                return value
+        return convert
+
+    def fetch_many(self, doc_class, doc_ids):
+        """
+        Fetches a batch of documents by id. Returns a list in the same order
+        as doc_ids with None in place of the missing documents.
+        """
+        raise NotImplementedError
+
+    def get_many(self, doc_class, doc_ids, missing='skip', batch_size=None):
+        """
+        Yields the documents for doc_ids in input order, fetching batch_size
+        ids per round trip.
+        @param missing: 'skip' leaves missing documents out, 'none' yields
+        None for them and 'raise' raises DocNotFoundError.
+        """
+        for chunk in chunks(doc_ids, batch_size or self.get_chunk_size()):
+            for doc_id, doc in zip(chunk, self.fetch_many(doc_class, chunk)):
+                if doc is None:
+                    if missing == 'raise':
+                        raise DocNotFoundError(doc_id)
+                    if missing == 'skip':
+                        continue
+                yield doc
+
+    def write_many(self, prepared):
+        """
+        Writes a batch of prepared documents. Yields an (index, result)
+        tuple for each item where result is the document or the exception
+        raised while writing it.
+        @param prepared: list of (index, doc_obj, doc) tuples
+        """
+        raise NotImplementedError
+
+    def get_chunk_size(self):
+        return self._kwargs.get('chunk_size', self.chunk_size)
+
+    def get_max_workers(self):
+        return self._kwargs.get('max_workers', self.max_workers)
+
+    def map_concurrent(self, func, iterable):
+        """
+        Applies func to every item on a bounded worker pool and yields the
+        results in input order. Only max_workers * 4 items are in flight at
+        a time so memory stays bounded for long iterables.
+        """
+        max_workers = self.get_max_workers()
+        if max_workers < 2:
+            for i in iterable:
+                yield func(i)
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in chunks(iterable, max_workers * 4):
+                for i in executor.map(func, chunk):
+                    yield i
+
     def parse_id(self, doc_id):
         try:
             return doc_id.split(':')[0]
         except TypeError:
             return doc_id.decode().split(':')[0]
 
+    def get_key_class_name(self, class_name):
+        """Returns class_name as it appears in the keys of the backend."""
+        return class_name
+
     def create_pk(self, doc_obj,doc):
         doc = doc.copy()
         doc['_date'] = str(datetime.datetime.now())
         doc['_uuid'] = str(uuid.uuid4())
         hash_pk = hashlib.md5(bytes(json.dumps(doc),'utf-8')).hexdigest()[:10]
         doc_obj.set_pk(self.doc_id_string.format(doc_id=hash_pk,
-            backend_id=self.backend_id, class_name=doc_obj.get_class_name()))
+            backend_id=self.backend_id,
+            class_name=self.get_key_class_name(doc_obj.get_class_name())))
         return doc_obj
 
-    def check_unique(self, doc_obj, key, value):
-        obj = doc_obj.objects().filter({key: value})
-        if len(obj) == 0:
-            return True
-        if hasattr(doc_obj, '_id') and len(obj) == 1:
-            if doc_obj._id == obj[0]._id:
-                return True
-        raise ValidationException(
+    def incr(self, doc_obj, key, amount):
+        """
+        Adds amount to the numeric property key of the stored document and
+        returns the new value. This is a read-modify-write fallback for
+        backends without server side updates: it loads the document, changes
+        it and saves it, so it is not atomic and an update saved by another
+        client in between is overwritten.
+        """
+        current = self.get(doc_obj.__class__, doc_obj.pk)
+        setattr(current, key, (getattr(current, key) or 0) + amount)
+        self.save(current)
+        return getattr(current, key)
+
+    def set_fields(self, doc_obj, fields):
+        """
+        Sets fields on the stored document and returns their new values.
+        Uses the same non-atomic read-modify-write fallback as incr.
+        """
+        current = self.get(doc_obj.__class__, doc_obj.pk)
+        for key, value in fields.items():
+            setattr(current, key, value)
+        self.save(current)
+        return {key: current._data[key] for key in fields}
+
+    def get_unique_owner(self, doc_obj, key, value):
+        """Returns the id of the document holding the reservation of value."""
+        raise NotImplementedError
+
+    def reserve_unique(self, items):
+        """
+        Atomically reserves the unique values of each (doc_obj, doc) pair.
+        Returns an (error, reserved keys) tuple per pair. error is a
+        ValidationException when a value is held by another document and
+        reserved keys lists the keys newly taken by the document, which
+        have to be released if it can't be written.
+        """
+        raise NotImplementedError
+
+    def release_unique(self, doc_obj, keys):
+        """Releases the reservation keys that are still held by doc_obj."""
+        raise NotImplementedError
+
+    def build_unique_reservations(self, doc_class):
+        """
+        Reserves the unique values of the existing documents of doc_class,
+        for documents saved before values were reserved. Reads every
+        document of the class once. Raises ResourceError, once the other
+        values are reserved, listing the values held by several documents.
+        """
+        if not doc_class._unique_props:
+            return
+        docs = self.iterate(None, [], AllParam(all=True), doc_class,
+                            fields=sorted(doc_class._unique_props))
+        conflicts = []
+        for chunk in chunks(docs, self.get_chunk_size()):
+            for doc_obj, (error, keys) in zip(chunk, self.reserve_unique(
+                    [(doc_obj, doc_obj._data) for doc_obj in chunk])):
+                if error is not None:
+                    conflicts.append('{0} ({1})'.format(error, doc_obj._id))
+        if conflicts:
+            raise ResourceError('Unique values held by several documents: {0}'.format(
+                ', '.join(conflicts)))
+
+    def get_stale_unique_keys(self, doc_obj):
+        """Reservation keys of unique values the document no longer has."""
+        current = set(i[2] for i in doc_obj.get_unique_values())
+        return [i for i in doc_obj._unique_change_list if i not in current]
+
+    def unique_error(self, key, value):
+        return ValidationException(
             'There is already a {key} with the value of {value}'
             .format(key=key, value=value))
 
-    def prep_doc(self, doc_obj):
+    def check_unique(self, doc_obj, key, value):
+        if doc_obj._base_properties[key].get_python_value(value) is None:
+            return True
+        owner = self.get_unique_owner(doc_obj, key, value)
+        if owner is None or owner == getattr(doc_obj, '_id', None):
+            return True
+        raise self.unique_error(key, value)
+
+    def reserve_doc(self, doc_obj, doc):
+        """
+        Reserves the unique values of a single document and returns the
+        newly reserved keys. Raises ValidationException on a conflict.
+        """
+        if not doc_obj.get_unique_props():
+            return []
+        error, reserved = self.reserve_unique(
+            [(doc_obj, self.changed_values(doc_obj, doc))])[0]
+        if error is not None:
+            raise error
+        return reserved
+
+    def prep_doc(self, doc_obj, fields=None):
         """
-        This method Validates, gets the Python value, checks unique indexes, 
-        gets the db value, and then returns the prepared doc dict object. 
+        This method Validates, gets the Python value, gets the db value, and
+        then returns the prepared doc dict object. Unique values are reserved
+        by the backends when the document is written.
         Useful for save and backup functions.
         @param doc_obj: 
+        @param fields: only prepare these properties, for partial updates
         @return: 
         """
-        doc = doc_obj._data.copy()
-        for key, prop in list(doc_obj._base_properties.items()):
+        if fields is not None:
+            # Partial updates only need the fields they write to be loaded
+            if doc_obj._deferred.intersection(fields):
+                doc_obj.load_deferred()
+            doc = {'_id': doc_obj._id}
+            props = [(key, doc_obj._base_properties[key]) for key in fields]
+            for key, prop in props:
+                doc[key] = doc_obj._data.get(key)
+        else:
+            doc_obj.load_deferred()
+            doc = doc_obj._data.copy()
+            props = list(doc_obj._base_properties.items())
+        for key, prop in props:
             prop.validate(doc.get(key), key)
             raw_value = prop.get_python_value(doc.get(key))
-            if prop.unique:
-                self.check_unique(doc_obj, key, raw_value)
             value = prop.get_db_value(raw_value)
             doc[key] = value
 
-        doc['_doc_type'] = get_doc_type(doc_obj.__class__)
+        if fields is None:
+            doc['_doc_type'] = get_doc_type(doc_obj.__class__)
         return doc
 
+    def changed_values(self, doc_obj, doc):
+        """
+        Returns the items of a prepared doc whose values changed since the
+        document was loaded or saved, or the whole doc if that isn't known.
+        """
+        fields = doc_obj.get_changed_fields()
+        if fields is None:
+            return doc
+        return {k: v for k, v in doc.items() if k in fields}
+
+    def make_doc(self, doc_class, data):
+        """
+        Builds a document from data read from the backend. Changes to it
+        are tracked from here on.
+        """
+        doc_obj = doc_class(**data)
+        doc_obj.clear_changes()
+        return doc_obj
+
     def _save(self, doc_obj):
-        doc = self.prep_doc(doc_obj)
+        fields = None
+        if self.partial_updates:
+            fields = doc_obj.get_changed_fields()
+        doc = self.prep_doc(doc_obj, fields)
 
         if '_id' not in doc:
             self.create_pk(doc_obj,doc)
             doc['_id'] = doc_obj._id
         return (doc_obj, doc)
 
+    def check_batch_unique(self, doc_obj, doc, seen):
+        """
+        Checks the unique properties of a document against the other
+        documents of the same batch, which are not in the database yet.
+        """
+        for key, value, unique_name in doc_obj.get_unique_values(doc):
+            if unique_name in seen:
+                raise self.unique_error(key, value)
+            seen.add(unique_name)
+
+    def save_many(self, doc_list):
+        """
+        Validates a batch of documents and writes the valid ones with as few
+        round trips as the backend allows.
+        @param doc_list: list of documents
+        @return: BulkSaveResult
+        """
+        start = time.time()
+        results = [None] * len(doc_list)
+        prepared = []
+        seen = set()
+        for index, doc_obj in enumerate(doc_list):
+            try:
+                doc_obj, doc = self._save(doc_obj)
+                self.check_batch_unique(
+                    doc_obj, self.changed_values(doc_obj, doc), seen)
+            except ValidationException as e:
+                results[index] = e
+                continue
+            prepared.append((index, doc_obj, doc))
+        valid = []
+        reserved = {}
+        for chunk in chunks(prepared, self.get_chunk_size()):
+            reservations = self.reserve_unique(
+                [(doc_obj, self.changed_values(doc_obj, doc))
+                 for index, doc_obj, doc in chunk])
+            for item, (error, keys) in zip(chunk, reservations):
+                if error is not None:
+                    results[item[0]] = error
+                else:
+                    valid.append(item)
+                    reserved[item[0]] = (item[1], keys)
+        for index, result in self.write_many(valid):
+            if isinstance(result, Exception):
+                # The document was not written so its new values are free again
+                self.release_unique(*reserved[index])
+            results[index] = result
+        return BulkSaveResult(results, time.time() - start)
+
     def get_id_list(self, filters_list):
         l = self.parse_filters(filters_list)
         if len(l) == 1:
@@ -98,17 +500,25 @@ class DocDB(object):
 
         return list(s)
 
-    def sort(self, sortingp_list, docs_list, doc_class):
+    def sort(self, sortingp_list, docs_list, doc_class, skip=None, limit=None):
         for sortingp in sortingp_list:
             if sortingp.key not in doc_class._base_properties:
                 raise ValueError("Field '%s' doesn't exists in a document" % sortingp.key)
-        sorted_list = list(docs_list)
         # check if a list can be sorted by serveral attributes with one function call
         if SortingParam.needs_multiple_passes(sortingp_list):
-            for sortingp in sortingp_list:
-                sorted_list = sorted(sorted_list, key=lambda x: getattr(x, sortingp.key),
+            sorted_list = list(docs_list)
+            # The least significant key is sorted first so that the stable
+            # passes leave the list ordered by the first key.
+            for sortingp in reversed(sortingp_list):
+                sorted_list = sorted(sorted_list, key=lambda x, k=sortingp.key: getattr(x, k),
                                      reverse=sortingp.reverse)
+        elif limit is not None:
+            # Only the first skip + limit documents are needed, so a heap
+            # based top-k avoids sorting the whole list.
+            top_k = heapq.nlargest if sortingp_list[0].reverse else heapq.nsmallest
+            sorted_list = top_k((skip or 0) + limit, docs_list,
+                                key=SortingParam.attr_sort(sortingp_list))
         else:
-            sorted_list = sorted(sorted_list, key=SortingParam.attr_sort(sortingp_list),
+            sorted_list = sorted(docs_list, key=SortingParam.attr_sort(sortingp_list),
                                  reverse=sortingp_list[0].reverse)
-        return sorted_list
+        return list(self.paginate(sorted_list, skip, limit))
@@ -1,87 +1,354 @@
+import hashlib
+import json
+import uuid
+
 import redis
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    # redis-py added cluster support in 4.1
+    RedisCluster = None
 
 from kev.backends import DocDB
-from kev.exceptions import DocNotFoundError
+from kev.backends.redis import scripts
+from kev.exceptions import DocNotFoundError, ResourceError
+from kev.properties import FloatProperty, IntegerProperty
+from kev.query import FilterNode, Max, Min, RangeFilter
+from kev.utils import chunks, translate_glob
 
 
 
 class RedisDB(DocDB):
 
     db_class = redis.StrictRedis
+    cluster_class = RedisCluster
     backend_id = 'redis'
+    partial_updates = True
+    # Seconds before a temporary result set expires if it is not cleaned up
+    temp_key_ttl = 600
+    # Seconds an intersection is kept for repeated queries, 0 to store it
+    # for a single query only
+    query_cache_ttl = 30
+    # Seconds a result of an older query version is kept for the readers
+    # still scanning it
+    stale_result_ttl = 5
+    # Largest page read with a single script call, 0 to always load the
+    # documents of a page with pipelines
+    fetch_page_size = 1000
 
     def __init__(self, **kwargs):
-        self._db = self._indexer = self.db_class(
-            kwargs['host'], port=kwargs['port'])
+        self._db = self._indexer = self.connect(
+            self.db_class, kwargs['host'], kwargs['port'], kwargs.get('cluster', False))
         self._kwargs = kwargs
 
+    def connect(self, client_class, host='localhost', port=6379, cluster=False, **kwargs):
+        """
+        Returns a client of the Redis node at host and port, or with
+        cluster=True of the Redis Cluster that node belongs to.
+        """
+        self.cluster = cluster
+        if cluster:
+            if self.cluster_class is None:
+                raise ResourceError('Redis Cluster support needs redis-py 4.1 or later')
+            client_class = self.cluster_class
+        return client_class(host, port=port, **kwargs)
+
     # CRUD Operations
     def save(self, doc_obj):
         doc_obj, doc = self._save(doc_obj)
+        reserved = self.reserve_doc(doc_obj, doc)
         pipe = self._db.pipeline()
-        pipe.hset(doc_obj._id, mapping=doc)
-
-        pipe = self.add_to_model_set(doc_obj, pipe)
-        pipe = self.add_indexes(doc_obj, doc, pipe)
-        pipe = self.remove_indexes(doc_obj, pipe)
-        pipe.execute()
+        pipe = self.write_doc(doc_obj, doc, pipe)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            self.release_unique(doc_obj, reserved)
+            raise
+        doc_obj.clear_changes()
 
         return doc_obj
 
+    def write_doc(self, doc_obj, doc, pipeline):
+        # Redis can't store None, so empty properties are left out of the hash
+        empty_keys = [k for k, v in doc.items() if v is None]
+        pipeline.hset(doc_obj._id, mapping={
+            k: v for k, v in doc.items() if v is not None})
+        if empty_keys:
+            pipeline.hdel(doc_obj._id, *empty_keys)
+        pipeline = self.add_to_model_set(doc_obj, pipeline)
+        pipeline = self.expire_query_results(doc_obj.__class__, pipeline)
+        # Stale index entries go first so a value that was changed and then
+        # changed back is not removed right after being re-added.
+        pipeline = self.remove_indexes(doc_obj, pipeline)
+        pipeline = self.add_indexes(doc_obj, doc, pipeline)
+        pipeline = self.release_unique(
+            doc_obj, self.get_stale_unique_keys(doc_obj), pipeline)
+        return pipeline
+
+    def write_many(self, prepared):
+        for chunk in chunks(prepared, self.get_chunk_size()):
+            pipe = self._db.pipeline(transaction=False)
+            for index, doc_obj, doc in chunk:
+                pipe = self.write_doc(doc_obj, doc, pipe)
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                for index, doc_obj, doc in chunk:
+                    yield index, e
+                continue
+            for index, doc_obj, doc in chunk:
+                doc_obj.clear_changes()
+                yield index, doc_obj
+
     def delete(self, doc_obj):
         pipe = self._db.pipeline()
-        pipe.delete(doc_obj._data['_id'])
-        pipe = self.remove_from_model_set(doc_obj, pipe)
-        doc_obj._index_change_list = doc_obj.get_indexes()
-        pipe = self.remove_indexes(doc_obj, pipe)
+        pipe = self.delete_doc(doc_obj, pipe)
         pipe.execute()
 
-    def all(self, cls, skip, limit):
-        id_list = self._db.smembers('{0}:all'.format(
-            cls.get_class_name()))
-        pipe = self._db.pipeline()
-        for id in id_list:
-            pipe.hgetall(id)
+    def delete_doc(self, doc_obj, pipeline):
+        pipeline.delete(doc_obj._data['_id'])
+        return self.delete_indexes(doc_obj, pipeline)
 
-        raw_docs = pipe.execute()
-        for doc in raw_docs:
-            if skip and skip > 0:
-                skip -= 1
-                continue
-            if limit is not None and limit == 0:
-                break
-            elif limit:
-                limit -= 1
-            yield cls(**{k.decode('utf-8'): v.decode('utf-8') for k, v in doc.items()})
+    def delete_indexes(self, doc_obj, pipeline):
+        pipeline = self.unindex_doc(doc_obj, pipeline)
+        pipeline = self.release_unique(
+            doc_obj, [i[2] for i in doc_obj.get_unique_values()], pipeline)
+        return pipeline
+
+    def unindex_doc(self, doc_obj, pipeline):
+        """
+        Removes the document from the model set and from its index and
+        sorted sets. Its unique values stay reserved.
+        """
+        pipeline = self.remove_from_model_set(doc_obj, pipeline)
+        pipeline = self.expire_query_results(doc_obj.__class__, pipeline)
+        doc_obj._index_change_list = doc_obj.get_indexes()
+        pipeline = self.remove_indexes(doc_obj, pipeline)
+        return self.remove_sort_indexes(doc_obj, pipeline)
+
+    def delete_many(self, doc_list):
+        for chunk in chunks(doc_list, self.get_chunk_size()):
+            pipe = self._db.pipeline(transaction=False)
+            for doc_obj in chunk:
+                pipe = self.delete_doc(doc_obj, pipe)
+            pipe.execute()
+        return len(doc_list)
+
+    def all(self, doc_class, skip, limit, fields=None):
+        # Sorted so that skip and limit page through a stable order, and
+        # windowed before any document is fetched.
+        id_list = sorted(self._indexer.smembers(self.get_model_set_name(doc_class)))
+        return self.load_ids(doc_class, self.paginate(id_list, skip, limit),
+                             fields=fields)
+
+    def incr(self, doc_obj, key, amount):
+        """
+        Adds amount to a numeric property and moves the document between
+        its index sets with one script call.
+        """
+        prop = doc_obj._base_properties[key]
+        if key in doc_obj._compound_props:
+            # Compound index names depend on other fields, which the script
+            # doesn't read
+            return prop.get_python_value(self.update_fields(
+                doc_obj, [key], lambda current: {
+                    key: (getattr(current, key) or 0) + amount})[key])
+        min_value, max_value = prop.get_value_bounds()
+        keys = [doc_obj._id]
+        if prop.sortable:
+            keys.append(doc_obj.get_sort_index_name(key))
+        index_prefix = doc_obj.get_index_name(key, '') if prop.index else ''
+        pipe = self._db.pipeline(transaction=False)
+        self.get_script('incr_field')(keys=keys, args=[
+            key, repr(amount), int(isinstance(prop, FloatProperty)),
+            '' if min_value is None else repr(min_value),
+            '' if max_value is None else repr(max_value),
+            doc_obj._id, index_prefix,
+            self.get_index_registry(index_prefix)[0] if prop.index else ''],
+            client=pipe)
+        if prop.index or prop.sortable:
+            pipe = self.expire_query_results(doc_obj.__class__, pipe)
+        reply = pipe.execute()[0]
+        if reply[0] == -1:
+            raise DocNotFoundError(doc_obj._id)
+        value = prop.get_python_value(reply[1].decode())
+        if reply[0] == -2:
+            # Raises the validator's error for the rejected value
+            prop.validate(value, key)
+        return value
+
+    def set_fields(self, doc_obj, fields):
+        """
+        Writes fields and their index changes in a MULTI/EXEC transaction
+        that is retried if the document changes after its old values are
+        read.
+        """
+        return self.update_fields(doc_obj, list(fields), lambda current: fields)
 
-    def get(self, doc_obj, doc_id):
+    def update_fields(self, doc_obj, keys, get_fields):
+        """
+        Sets the fields returned by get_fields for the stored values of keys
+        in a WATCH transaction and returns their new values.
+        """
+        keys = ['_id'] + keys + sorted(doc_obj.get_compound_props(keys) - set(keys))
+        reserved = []
+
+        def update(pipe):
+            values = pipe.hmget(doc_obj._id, keys)
+            if values[0] is None:
+                raise DocNotFoundError(doc_obj._id)
+            current = self.make_doc(doc_obj.__class__, {
+                k: v.decode() for k, v in zip(keys, values) if v is not None})
+            fields = get_fields(current)
+            for key, value in fields.items():
+                setattr(current, key, value)
+            doc = self.prep_doc(current, current.get_changed_fields())
+            reserved.extend(self.reserve_doc(current, doc))
+            pipe.multi()
+            self.write_doc(current, doc, pipe)
+            return {key: current._data[key] for key in fields}
+
+        try:
+            return self._db.transaction(update, doc_obj._id, value_from_callable=True)
+        except (redis.RedisError, DocNotFoundError):
+            self.release_unique(doc_obj, reserved)
+            raise
+
+    def get(self, doc_obj, doc_id, fields=None):
+        if fields is not None:
+            doc = self.load_fields(doc_obj, self._db.hmget(
+                doc_obj.get_doc_id(doc_id), self.get_field_keys(fields)), fields)
+            if doc is None:
+                raise DocNotFoundError
+            return doc
         doc = self._db.hgetall(doc_obj.get_doc_id(doc_id))
         if len(list(doc.keys())) == 0:
             raise DocNotFoundError
 
-        return doc_obj(**{k.decode(): v.decode() for k, v in doc.items()})
+        return self.load_doc(doc_obj, doc)
+
+    def fetch_many(self, doc_class, doc_ids):
+        pipe = self._db.pipeline(transaction=False)
+        for doc_id in doc_ids:
+            pipe.hgetall(doc_class.get_doc_id(doc_id))
+        return [self.load_doc(doc_class, doc) if doc else None
+                for doc in pipe.execute()]
+
+    def load_doc(self, doc_class, raw_doc):
+        return self.make_doc(doc_class, {k.decode(): v.decode() for k, v in raw_doc.items()})
+
+    def load_ids(self, doc_class, id_list, chunk_size=None, fields=None):
+        for chunk in chunks(id_list, chunk_size or self.get_chunk_size()):
+            pipe = self._db.pipeline(transaction=False)
+            for id in chunk:
+                if fields is not None:
+                    pipe.hmget(id, self.get_field_keys(fields))
+                else:
+                    pipe.hgetall(id)
+            for doc in pipe.execute():
+                if fields is not None:
+                    doc = self.load_fields(doc_class, doc, fields)
+                    if doc is not None:
+                        yield doc
+                elif doc:
+                    yield self.load_doc(doc_class, doc)
+
+    def load_values(self, doc_class, id_list, fields):
+        load = self.get_value_loader(doc_class, fields)
+        keys = ['_id'] + self.get_raw_keys(fields)
+        for chunk in chunks(id_list, self.get_chunk_size()):
+            pipe = self._db.pipeline(transaction=False)
+            for id in chunk:
+                pipe.hmget(id, keys)
+            for values in pipe.execute():
+                if values[0] is not None:
+                    yield load([v.decode() if v is not None else None
+                                for v in values[1:]])
+
+    def get_field_keys(self, fields):
+        return ['_id'] + list(fields)
+
+    def load_fields(self, doc_class, values, fields):
+        """
+        Builds a partial document from the HMGET reply for fields, or
+        returns None if the hash doesn't exist.
+        """
+        if values[0] is None:
+            return None
+        doc = self.make_doc(doc_class, {k: v.decode() for k, v in zip(
+            self.get_field_keys(fields), values) if v is not None})
+        doc.set_deferred(set(doc_class._base_properties) - set(fields))
+        return doc
 
     def flush_db(self):
         self._db.flushdb()
 
     # Indexing Methods
+    def get_model_set_name(self, doc_class):
+        return '{0}:all'.format(self.get_key_class_name(doc_class.get_class_name()))
+
+    def get_key_class_name(self, class_name):
+        # Multi-key commands, scripts and transactions need every key they
+        # touch in one hash slot, so on a cluster all the keys of a class
+        # share its name as a hash tag
+        if self.cluster:
+            return '{%s}' % class_name.lower()
+        return class_name
+
+    def get_script(self, name):
+        """
+        Returns the Lua script called name from kev.backends.redis.scripts
+        registered with the indexer.
+        """
+        if getattr(self, '_scripts', None) is None:
+            self._scripts = {}
+        if name not in self._scripts:
+            self._scripts[name] = self._indexer.register_script(
+                getattr(scripts, name.upper()))
+            if self.cluster:
+                # Cluster pipelines can't load a script on a NOSCRIPT reply
+                self._indexer.script_load(self._scripts[name].script)
+        return self._scripts[name]
+
+    def get_temp_key(self, doc_class):
+        return '{0}:{1}:tmp:{2}'.format(
+            self.backend_id, self.get_key_class_name(doc_class.get_class_name()),
+            uuid.uuid4().hex)
+
+    def get_query_version_key(self, doc_class):
+        return '{0}:{1}:version'.format(
+            self.backend_id, self.get_key_class_name(doc_class.get_class_name()))
+
+    def expire_query_results(self, doc_class, pipeline):
+        # Stored intersections are named after this counter, so bumping it
+        # makes the next query compute a fresh one
+        self.get_script('expire_results')(
+            keys=[self.get_query_version_key(doc_class)], args=[self.stale_result_ttl],
+            client=pipeline)
+        return pipeline
+
     def add_to_model_set(self, doc_obj, pipeline):
-        pipeline.sadd(
-            '{0}:all'.format(
-                doc_obj.__class__.__name__.lower()),
-            doc_obj._id)
+        pipeline.sadd(self.get_model_set_name(doc_obj.__class__), doc_obj._id)
         return pipeline
 
     def remove_from_model_set(self, doc_obj, pipeline):
-        pipeline.srem(
-            '{0}:all'.format(
-                doc_obj.__class__.__name__.lower()),
-            doc_obj._id)
+        pipeline.srem(self.get_model_set_name(doc_obj.__class__), doc_obj._id)
         return pipeline
 
+    def get_index_registry(self, index_name):
+        """
+        Returns the key of the sorted set listing the indexed values of the
+        property of index_name, and the value of index_name.
+        """
+        prefix, sep, rest = index_name.partition(':indexes:')
+        prop, sep, value = rest.partition(':')
+        return '{0}:values:{1}'.format(prefix, prop), value
+
     def remove_indexes(self, doc_obj, pipeline):
         for index_v in doc_obj._index_change_list:
-            pipeline.srem(index_v, doc_obj._id)
+            registry, value = self.get_index_registry(index_v)
+            self.get_script('remove_index')(
+                keys=[index_v, registry], args=[doc_obj._id, value], client=pipeline)
         return pipeline
 
     def add_indexes(self, doc_obj, doc, pipeline):
@@ -89,30 +356,464 @@ class RedisDB(DocDB):
         for prop in index_list:
             index_value = doc.get(prop)
             if index_value:
-                pipeline.sadd(doc_obj.get_index_name(prop, index_value),
-                              doc_obj._id)
+                index_name = doc_obj.get_index_name(prop, index_value)
+                registry, value = self.get_index_registry(index_name)
+                pipeline.sadd(index_name, doc_obj._id)
+                pipeline.zadd(registry, {value: 0})
+        for index_name in doc_obj.get_compound_indexes(doc):
+            pipeline.sadd(index_name, doc_obj._id)
+        for prop in doc_obj.get_sortable_props():
+            # Partial updates only carry the changed properties
+            if prop not in doc:
+                continue
+            pipeline.zadd(doc_obj.get_sort_index_name(prop), {
+                doc_obj._id: doc_obj._base_properties[prop].get_score(doc.get(prop))})
+        return pipeline
+
+    def get_unique_owner(self, doc_obj, key, value):
+        owner = self._indexer.get(doc_obj.get_unique_name(key, value))
+        if owner is not None:
+            return owner.decode()
+
+    def reserve_unique(self, items):
+        return self.reserve_unique_values(
+            [(doc_obj, doc_obj.get_unique_values(doc)) for doc_obj, doc in items])
+
+    def reserve_unique_values(self, items):
+        """
+        Reserves the (key, value, unique name) tuples of each (doc_obj,
+        unique list) pair and returns what reserve_unique does.
+        """
+        pipe = self._indexer.pipeline(transaction=False)
+        unique_lists = []
+        for doc_obj, unique_list in items:
+            unique_lists.append(unique_list)
+            if unique_list:
+                self.get_script('reserve_unique')(
+                    keys=[i[2] for i in unique_list], args=[doc_obj._id], client=pipe)
+        replies = iter(pipe.execute())
+        results = []
+        for unique_list in unique_lists:
+            reply = next(replies) if unique_list else [0]
+            if reply[0]:
+                key, value, unique_name = unique_list[reply[0] - 1]
+                results.append((self.unique_error(key, value), []))
+            else:
+                results.append((None, [unique_list[i - 1][2] for i in reply[1:]]))
+        return results
+
+    def release_unique(self, doc_obj, keys, pipeline=None):
+        if keys:
+            self.get_script('release_unique')(
+                keys=keys, args=[doc_obj._id],
+                client=pipeline if pipeline is not None else self._indexer)
+        return pipeline
+
+    def remove_sort_indexes(self, doc_obj, pipeline):
+        for prop in doc_obj.get_sortable_props():
+            pipeline.zrem(doc_obj.get_sort_index_name(prop), doc_obj._id)
         return pipeline
 
-    def evaluate(self, filters_list, sortingp_list, all_param, doc_class):
-        if all_param.all and len(sortingp_list) > 0:
-            docs_list = list(self.all(doc_class, skip=all_param.skip, limit=all_param.limit))
-            for doc in self.sort(sortingp_list, docs_list, doc_class):
-                yield doc
-        elif all_param.all:
-            for doc in self.all(doc_class, skip=all_param.skip, limit=all_param.limit):
-                yield doc
+    def parse_filters(self, filters):
+        """
+        Replaces wildcard filters with the index sets of the matching values.
+        A '*' makes a filter a wildcard, which then follows the Redis glob
+        syntax (*, ?, [...] and backslash escapes); other values are exact.
+        The values are looked up in the registry of the property with
+        ZRANGEBYLEX from the part of the pattern before the first wildcard,
+        so the cost depends on the number of values with that prefix rather
+        than on the size of the keyspace.
+        """
+        s = set()
+        for f in filters:
+            if '*' not in f:
+                s.add(f)
+                continue
+            registry, pattern = self.get_index_registry(f)
+            prefix, match = translate_glob(pattern)
+            prefix = prefix.encode()
+            values = self._indexer.zrangebylex(
+                registry, b'[' + prefix, b'(' + prefix + b'\xff') if prefix else \
+                self._indexer.zrangebylex(registry, '-', '+')
+            index_prefix = f[:len(f) - len(pattern)]
+            matched = [index_prefix + value.decode() for value in values
+                       if match.fullmatch(value.decode())]
+            # Without a match the pattern stays in and intersects to nothing
+            s.update(matched or [f])
+
+        if not s:
+            return filters
+
+        return list(s)
+
+    def build_index_registry(self, doc_class):
+        """
+        Lists the values of the existing index sets of doc_class in their
+        registries, for documents indexed before wildcard filters were
+        answered from them. Walks the keyspace once with SCAN.
+        """
+        index_names = self._indexer.scan_iter(
+            '{0}:indexes:*'.format(doc_class.get_key_prefix()),
+            count=self.get_chunk_size())
+        for chunk in chunks(index_names, self.get_chunk_size()):
+            pipe = self._indexer.pipeline(transaction=False)
+            for index_name in chunk:
+                registry, value = self.get_index_registry(index_name.decode())
+                pipe.zadd(registry, {value: 0})
+            pipe.execute()
+
+    def add_compound_indexes(self, doc_list):
+        pipe = self._indexer.pipeline(transaction=False)
+        for doc_obj in doc_list:
+            for index_name in doc_obj.get_compound_indexes():
+                pipe.sadd(index_name, doc_obj._id)
+        for doc_class in set(doc_obj.__class__ for doc_obj in doc_list):
+            pipe = self.expire_query_results(doc_class, pipe)
+        pipe.execute()
+
+    def compile_filter(self, item):
+        """
+        Returns the plan_query program of a filter as a list of operations,
+        with the names of the keys in place of their positions.
+        """
+        if isinstance(item, RangeFilter):
+            return [('range', item.index_name) + item.get_score_range()]
+        if isinstance(item, FilterNode):
+            program = []
+            for child in item.children:
+                program.extend(self.compile_filter(child))
+            if item.op == FilterNode.NOT:
+                return program + [(item.op,)]
+            return program + [(item.op, len(item.children))]
+        keys = self.parse_filters([item])
+        program = [('set', key) for key in keys]
+        if len(keys) > 1:
+            # A wildcard matches any of its values
+            program.append((FilterNode.OR, len(keys)))
+        return program
+
+    def plan_query(self, filters_list, doc_class):
+        """
+        Evaluates filters_list on the server with the plan_query script and
+        returns a (key, count, stored) tuple. key holds the matching ids, or
+        is None if there are none. stored is False when key is an index set
+        of the query; otherwise it is a result set that is kept for
+        query_cache_ttl seconds, or until a document of the class is
+        written, and has to be released with release_query_result.
+        """
+        keys, args = self.get_plan_args(filters_list, doc_class)
+        return self.parse_plan(self.get_script('plan_query')(keys=keys, args=args))
+
+    def parse_plan(self, reply):
+        key, count, stored = reply[:3]
+        return key.decode() or None, count, bool(stored)
+
+    def get_plan_args(self, filters_list, doc_class):
+        """
+        Returns the keys and arguments of the query planner script for
+        filters_list, or only the fixed ones if filters_list is None.
+        """
+        keys = [self.get_query_version_key(doc_class), None,
+                self.get_model_set_name(doc_class)]
+        args = [self.query_cache_ttl or self.temp_key_ttl]
+        if filters_list is None:
+            return keys, args
+        # Sorted so the same filters in another order share a result
+        pieces = sorted((self.compile_filter(f) for f in filters_list), key=repr)
+        program = [op for piece in pieces for op in piece] + [
+            (FilterNode.AND, len(pieces))]
+        if self.query_cache_ttl:
+            digest = hashlib.md5(json.dumps(program).encode()).hexdigest()
+            keys[1] = '{0}:{1}:query:{2}'.format(
+                self.backend_id, self.get_key_class_name(doc_class.get_class_name()),
+                digest)
+        else:
+            keys[1] = self.get_temp_key(doc_class)
+        positions = {}
+        for op in program:
+            if op[0] in ('set', 'range'):
+                if op[1] not in positions:
+                    keys.append(op[1])
+                    positions[op[1]] = len(keys)
+                op = (op[0], positions[op[1]]) + op[2:]
+            args.extend(op)
+        return keys, args
+
+    def facets(self, filters_list, doc_class, props):
+        keys, args = self.get_plan_args(filters_list, doc_class)
+        # The planner has nothing to store when there are no filters
+        keys[1] = keys[1] or self.get_temp_key(doc_class)
+        args.append('end')
+        for prop in props:
+            index_prefix = doc_class.get_index_name(prop, '')
+            keys.append(self.get_index_registry(index_prefix)[0])
+            args.extend([len(keys), index_prefix])
+        reply = self.get_script('facet_counts')(keys=keys, args=args)
+        key, count, stored = self.parse_plan(reply)
+        if key is not None:
+            self.release_query_result(key, stored)
+        reply = iter(reply[3:])
+        facets = {}
+        for prop in props:
+            convert = self.get_value_converter(doc_class._base_properties[prop])
+            facets[prop] = {convert(next(reply).decode()): next(reply)
+                            for i in range(next(reply, 0))}
+        return facets
+
+    def aggregate(self, filters_list, doc_class, aggregates):
+        """
+        Computes the statistics in a script. The minimum and maximum of a
+        sortable field that no other aggregate needs are read from its
+        sorted index, and its count and sum are left as None.
+        """
+        fields = sorted(set(i.field for i in aggregates if i.field is not None))
+        props = {field: doc_class._base_properties[field] for field in fields}
+        sorted_fields = [field for field in fields
+                         if getattr(props[field], 'sortable', False) and all(
+                             isinstance(i, (Min, Max)) for i in aggregates if i.field == field)]
+        fields = [field for field in fields if field not in sorted_fields]
+        if not all(isinstance(props[field], (IntegerProperty, FloatProperty))
+                   for field in fields):
+            # The script only compares numbers
+            return super(RedisDB, self).aggregate(filters_list, doc_class, aggregates)
+        keys, args = self.get_plan_args(filters_list, doc_class)
+        keys[1] = keys[1] or self.get_temp_key(doc_class)
+        args.append('end')
+        args.extend(self.get_raw_keys(fields))
+        args.append('sorted')
+        for field in sorted_fields:
+            keys.append(doc_class.get_sort_index_name(field))
+            args.extend([field, len(keys)])
+        reply = self.get_script('aggregate')(keys=keys, args=args)
+        key, count, stored = self.parse_plan(reply)
+        if key is not None:
+            self.release_query_result(key, stored)
+        if len(reply) == 3:
+            # Nothing matched the filters
+            stats = {field: (0, 0, None, None) for field in fields}
+            stats.update((field, (None, None, None, None)) for field in sorted_fields)
+            return 0, stats
+        if not reply[3]:
+            # A sorted index doesn't cover every document of the class yet
+            return super(RedisDB, self).aggregate(filters_list, doc_class, aggregates)
+        reply = iter(reply[4:])
+        doc_count = next(reply)
+        stats = {}
+        for field in fields:
+            prop = props[field]
+            convert = self.get_value_converter(prop)
+            count, total, min_value, max_value = [next(reply) for i in range(4)]
+            total = float(total)
+            if isinstance(prop, IntegerProperty):
+                total = int(total)
+            stats[field] = (count, total,
+                            convert(min_value.decode()) if count else None,
+                            convert(max_value.decode()) if count else None)
+        for field in sorted_fields:
+            convert = self.get_value_converter(props[field])
+            min_value, max_value = next(reply), next(reply)
+            stats[field] = (None, None,
+                            convert(min_value.decode()) if min_value else None,
+                            convert(max_value.decode()) if max_value else None)
+        return doc_count, stats
+
+    def release_query_result(self, key, stored):
+        if stored and not self.query_cache_ttl:
+            self._indexer.delete(key)
+
+    def get_id_list(self, filters_list, doc_class):
+        key, count, stored = self.plan_query(filters_list, doc_class)
+        if key is None:
+            return set()
+        try:
+            return self._indexer.smembers(key)
+        finally:
+            self.release_query_result(key, stored)
+
+    def count(self, filters_list, all_param, doc_class):
+        if all_param.all:
+            total = self._indexer.scard(self.get_model_set_name(doc_class))
+            return self.window_count(total, all_param)
+        key, total, stored = self.plan_query(filters_list, doc_class)
+        if key is not None:
+            self.release_query_result(key, stored)
+        return self.window_count(total, all_param)
+
+    def iterate(self, filters_list, sortingp_list, all_param, doc_class,
+                chunk_size=None, fields=None):
+        """
+        Walks the ids with SSCAN and pipelines chunk_size hashes at a time.
+        Like SSCAN, a document can be yielded twice if the set is resized
+        during the scan. Sorted and windowed queries need an ordered id
+        list and go through evaluate instead.
+        """
+        if sortingp_list or all_param.skip or all_param.limit is not None:
+            return self.evaluate(filters_list, sortingp_list, all_param, doc_class,
+                                 fields=fields)
+        chunk_size = chunk_size or self.get_chunk_size()
+        if all_param.all:
+            return self.load_ids(doc_class, self._indexer.sscan_iter(
+                self.get_model_set_name(doc_class), count=chunk_size), chunk_size,
+                fields=fields)
+        return self.iterate_filtered(filters_list, doc_class, chunk_size, fields)
+
+    def iterate_filtered(self, filters_list, doc_class, chunk_size, fields=None):
+        # The intersection is stored on the server and scanned from there so
+        # the full id list never has to be held by the client.
+        key, count, stored = self.plan_query(filters_list, doc_class)
+        if key is None:
+            return
+        ttl = self.query_cache_ttl or self.temp_key_ttl
+        try:
+            for chunk in chunks(self._indexer.sscan_iter(key, count=chunk_size), chunk_size):
+                if stored:
+                    self._indexer.expire(key, ttl)
+                for doc in self.load_ids(doc_class, chunk, chunk_size, fields=fields):
+                    yield doc
+        finally:
+            self.release_query_result(key, stored)
+
+    def get_sorted_id_list(self, filters_list, sortingp_list, all_param, doc_class):
+        """
+        Returns the ids of the requested window ordered by the sorted index
+        of the sort key, or None when the query can't be answered from a
+        sorted index: several sort keys, a key without a sorted index, or an
+        index that does not cover every document of the class yet.
+        """
+        if len(sortingp_list) != 1 or not getattr(
+                doc_class._base_properties.get(sortingp_list[0].key), 'sortable', False):
+            return None
+        if all_param.limit == 0:
+            return []
+        sortingp = sortingp_list[0]
+        sort_key = doc_class.get_sort_index_name(sortingp.key)
+        start = all_param.skip or 0
+        end = start + all_param.limit - 1 if all_param.limit is not None else -1
+        range_key = sort_key
+        if not all_param.all:
+            key, count, stored = self.plan_query(filters_list, doc_class)
+            if key is None:
+                return []
+        pipe = self._indexer.pipeline()
+        pipe.zcard(sort_key)
+        pipe.scard(self.get_model_set_name(doc_class))
+        if not all_param.all:
+            range_key = self.get_temp_key(doc_class)
+            pipe.zinterstore(range_key, {key: 0, sort_key: 1})
+        if sortingp.reverse:
+            pipe.zrevrange(range_key, start, end)
+        else:
+            pipe.zrange(range_key, start, end)
+        if not all_param.all:
+            pipe.delete(range_key)
+            results = pipe.execute()[:-1]
+            self.release_query_result(key, stored)
+        else:
+            results = pipe.execute()
+        if results[0] < results[1]:
+            return None
+        return results[-1]
+
+    def get_window_ids(self, filters_list, sortingp_list, all_param, doc_class):
+        """
+        Returns the ids of the requested window in order, or None when the
+        documents have to be sorted in Python.
+        """
+        if len(sortingp_list) > 0:
+            return self.get_sorted_id_list(
+                filters_list, sortingp_list, all_param, doc_class)
+        if all_param.all:
+            id_list = sorted(self._indexer.smembers(self.get_model_set_name(doc_class)))
+            return self.paginate(id_list, all_param.skip, all_param.limit)
+        key, count, stored = self.plan_query(filters_list, doc_class)
+        if key is None:
+            return []
+        try:
+            # Only the requested page of the stored result is sent back
+            return self._indexer.sort(key, start=all_param.skip or 0,
+                                      num=count if all_param.limit is None
+                                      else all_param.limit, alpha=True)
+        finally:
+            self.release_query_result(key, stored)
+
+    def fetch_page(self, filters_list, sortingp_list, all_param, doc_class, keys=None):
+        """
+        Runs the query, orders and slices the ids and reads the hashes of the
+        page on the server, so a paged list costs one round trip. Returns the
+        HMGET reply for keys, or the HGETALL reply, of each document of the
+        page, or None when the page has to be read another way: no limit or
+        one over fetch_page_size, or a sort the sorted indexes can't answer.
+        """
+        if (not self.fetch_page_size or all_param.limit is None
+                or all_param.limit > self.fetch_page_size):
+            return None
+        if sortingp_list and (len(sortingp_list) != 1 or not getattr(
+                doc_class._base_properties.get(sortingp_list[0].key), 'sortable', False)):
+            return None
+        if all_param.limit == 0:
+            return []
+        keys_list, args = self.get_plan_args(
+            None if all_param.all else filters_list, doc_class)
+        keys_list[1] = keys_list[1] or self.get_temp_key(doc_class)
+        sort_index = reverse = 0
+        if sortingp_list:
+            keys_list.append(doc_class.get_sort_index_name(sortingp_list[0].key))
+            sort_index = len(keys_list)
+            reverse = int(sortingp_list[0].reverse)
+        args.extend(['end', sort_index, reverse, all_param.skip or 0, all_param.limit])
+        args.extend(keys or [])
+        reply = self.get_script('fetch_page')(keys=keys_list, args=args)
+        key, count, stored = self.parse_plan(reply)
+        if key is not None:
+            self.release_query_result(key, stored)
+        if len(reply) == 3:
+            return []
+        if not reply[3]:
+            return None
+        return reply[4:]
+
+    def evaluate_values(self, filters_list, sortingp_list, all_param, doc_class,
+                        fields):
+        page = self.fetch_page(filters_list, sortingp_list, all_param, doc_class,
+                               ['_id'] + self.get_raw_keys(fields))
+        if page is not None:
+            load = self.get_value_loader(doc_class, fields)
+            return (load([v.decode() if v is not None else None for v in values[1:]])
+                    for values in page if values[0] is not None)
+        id_list = self.get_window_ids(filters_list, sortingp_list, all_param, doc_class)
+        if id_list is None:
+            return super(RedisDB, self).evaluate_values(
+                filters_list, sortingp_list, all_param, doc_class, fields)
+        return self.load_values(doc_class, id_list, fields)
+
+    def evaluate(self, filters_list, sortingp_list, all_param, doc_class,
+                 fields=None):
+        page = self.fetch_page(filters_list, sortingp_list, all_param, doc_class,
+                               None if fields is None else self.get_field_keys(fields))
+        if page is not None:
+            for values in page:
+                if fields is not None:
+                    doc = self.load_fields(doc_class, values, fields)
+                    if doc is not None:
+                        yield doc
+                elif values:
+                    yield self.load_doc(doc_class, dict(zip(values[::2], values[1::2])))
+            return
+        id_list = self.get_window_ids(filters_list, sortingp_list, all_param, doc_class)
+        if id_list is not None:
+            docs = self.load_ids(doc_class, id_list, fields=fields)
         else:
-            id_list = self.get_id_list(filters_list)
-            pipe = self._db.pipeline()
-            for id in id_list:
-                pipe.hgetall(id)
-            raw_docs = pipe.execute()
-            if len(sortingp_list) > 0:
-                docs_list = [doc_class(**{k.decode(): v.decode() for k, v in doc.items()})\
-                             for doc in raw_docs]
-                sorted_list = self.sort(sortingp_list, docs_list, doc_class)
-                for doc in sorted_list:
-                      yield doc
+            # Sorting in Python needs the sort keys of a projection
+            sort_fields = fields
+            if fields is not None:
+                sort_fields = list(fields) + [i.key for i in sortingp_list
+                                              if i.key not in fields]
+            if all_param.all:
+                docs_list = self.all(doc_class, None, None, fields=sort_fields)
             else:
-                for doc in raw_docs:
-                    yield doc_class(**{k.decode(): v.decode() for k, v in doc.items()})
+                docs_list = self.load_ids(doc_class, self.get_id_list(filters_list, doc_class),
+                                          fields=sort_fields)
+            docs = self.sort(sortingp_list, docs_list, doc_class,
+                             all_param.skip, all_param.limit)
+        for doc in docs:
+            yield doc
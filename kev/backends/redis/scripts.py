@@ -0,0 +1,557 @@
+"""
+Lua scripts used by the Redis backends. They are registered lazily with
+RedisDB.get_script and run with EVALSHA, so each one costs a single round
+trip and runs atomically.
+
+Besides KEYS, the scripts use keys they only learn or build at run time:
+the documents listed in index sets, the index set of a value (a prefix
+from ARGV joined with the value) and keys named after KEYS[1] and KEYS[2].
+Redis Cluster doesn't check those, so they work because every key of a
+class carries the same '{class}' hash tag in cluster mode (see
+RedisDB.get_key_class_name) and hashes to the slot of the declared keys.
+A script must not touch a key outside the class of its KEYS.
+"""
+
+# Defines plan_query(last), shared by the scripts that filter documents.
+# It evaluates a filter expression and stores its result in KEYS[2] .. ':'
+# .. the counter KEYS[1], which writes to the class increment. The result
+# expires after ARGV[1] seconds and a result still stored for the same
+# counter is returned as is. Stored results are listed in KEYS[1] ..
+# ':results' for EXPIRE_RESULTS. KEYS[3] is the set of all the documents of the
+# class. ARGV[2] to ARGV[last] is the expression in postfix order:
+#   'set', i              the index set KEYS[i]
+#   'range', i, min, max  the members of the sorted index KEYS[i] with a
+#                         score between min and max in the ZRANGEBYSCORE
+#                         syntax
+#   'and', n / 'or', n    the intersection / union of the last n operands
+#   'not'                 the documents not in the last operand
+# Inputs are counted first so an empty one ends an intersection, which
+# starts from its smallest input, checks larger ranges member by member with
+# ZSCORE instead of copying them and removes negated operands with SDIFF.
+# Returns {key, count, stored} where stored is 0 when key is an index set
+# of the query, or {'', 0, 0} if nothing matches.
+QUERY_PLANNER = """
+local function parse_bound(arg)
+    local exclusive = string.sub(arg, 1, 1) == '('
+    if exclusive then
+        arg = string.sub(arg, 2)
+    end
+    if arg == 'inf' or arg == '+inf' then
+        return math.huge, exclusive
+    elseif arg == '-inf' then
+        return -math.huge, exclusive
+    end
+    return tonumber(arg), exclusive
+end
+
+local function in_range(range, score)
+    if not score then
+        return false
+    end
+    score = parse_bound(score)
+    if score < range.min or (range.min_exclusive and score == range.min) then
+        return false
+    end
+    return score < range.max or (not range.max_exclusive and score == range.max)
+end
+
+local function plan_query(last)
+    local result = KEYS[2] .. ':' .. (redis.call('GET', KEYS[1]) or '0')
+    local size = redis.call('SCARD', result)
+    if size > 0 then
+        redis.call('EXPIRE', result, ARGV[1])
+        redis.call('EXPIRE', KEYS[1] .. ':results', ARGV[1])
+        return {result, size, 1}
+    end
+
+    local EMPTY = {kind = 'set', size = 0}
+    local temps = {}
+
+    local function set_operand(key, temp)
+        return {kind = 'set', key = key, temp = temp, size = redis.call('SCARD', key)}
+    end
+
+    local function temp_key()
+        table.insert(temps, result .. ':' .. #temps)
+        return temps[#temps]
+    end
+
+    local function add_members(key, ids)
+        for i = 1, #ids, 1000 do
+            redis.call('SADD', key, unpack(ids, i, math.min(i + 999, #ids)))
+        end
+    end
+
+    local function filter_members(key, range, keep)
+        local removed = {}
+        for _, id in ipairs(redis.call('SMEMBERS', key)) do
+            if in_range(range, redis.call('ZSCORE', range.key, id)) ~= keep then
+                table.insert(removed, id)
+            end
+        end
+        for i = 1, #removed, 1000 do
+            redis.call('SREM', key, unpack(removed, i, math.min(i + 999, #removed)))
+        end
+    end
+
+    -- Returns a set operand with the members of any operand
+    local function materialize(operand)
+        if operand.kind == 'set' then
+            return operand
+        end
+        local key = temp_key()
+        if operand.kind == 'range' then
+            add_members(key, redis.call(
+                'ZRANGEBYSCORE', operand.key, operand.min_arg, operand.max_arg))
+        else
+            local inner = materialize(operand.operand)
+            if inner.size > 0 then
+                redis.call('SDIFFSTORE', key, KEYS[3], inner.key)
+            else
+                redis.call('SUNIONSTORE', key, KEYS[3])
+            end
+        end
+        return set_operand(key, true)
+    end
+
+    local function union(operands)
+        local keys = {}
+        for _, operand in ipairs(operands) do
+            operand = materialize(operand)
+            if operand.size > 0 then
+                table.insert(keys, operand.key)
+            end
+        end
+        if #keys == 0 then
+            return EMPTY
+        elseif #keys == 1 then
+            return set_operand(keys[1], false)
+        end
+        local key = temp_key()
+        redis.call('SUNIONSTORE', key, unpack(keys))
+        return set_operand(key, true)
+    end
+
+    local function intersect(operands)
+        local sets, ranges, negated = {}, {}, {}
+        for _, operand in ipairs(operands) do
+            if operand.kind == 'not' then
+                table.insert(negated, operand.operand)
+            elseif operand.size == 0 then
+                return EMPTY
+            elseif operand.kind == 'range' then
+                table.insert(ranges, operand)
+            else
+                table.insert(sets, operand)
+            end
+        end
+        if #sets == 0 and #ranges == 0 then
+            table.insert(sets, set_operand(KEYS[3], false))
+        end
+        if #sets == 1 and #ranges == 0 and #negated == 0 then
+            return sets[1]
+        end
+        local by_size = function(a, b) return a.size < b.size end
+        table.sort(sets, by_size)
+        table.sort(ranges, by_size)
+        local key = temp_key()
+        if #sets == 0 or (ranges[1] and ranges[1].size < sets[1].size) then
+            local range = table.remove(ranges, 1)
+            add_members(key, redis.call('ZRANGEBYSCORE', range.key, range.min_arg, range.max_arg))
+        else
+            redis.call('SUNIONSTORE', key, table.remove(sets, 1).key)
+        end
+        if #sets > 0 then
+            local keys = {key}
+            for _, set in ipairs(sets) do
+                table.insert(keys, set.key)
+            end
+            redis.call('SINTERSTORE', key, unpack(keys))
+        end
+        for _, range in ipairs(ranges) do
+            filter_members(key, range, true)
+        end
+        for _, operand in ipairs(negated) do
+            if operand.kind == 'range' then
+                filter_members(key, operand, false)
+            else
+                operand = materialize(operand)
+                if operand.size > 0 then
+                    redis.call('SDIFFSTORE', key, key, operand.key)
+                end
+            end
+        end
+        return set_operand(key, true)
+    end
+
+    local stack = {}
+    local i = 2
+    while i <= last do
+        local op = ARGV[i]
+        if op == 'set' then
+            table.insert(stack, set_operand(KEYS[tonumber(ARGV[i + 1])], false))
+            i = i + 2
+        elseif op == 'range' then
+            local range = {kind = 'range', key = KEYS[tonumber(ARGV[i + 1])],
+                           min_arg = ARGV[i + 2], max_arg = ARGV[i + 3]}
+            range.min, range.min_exclusive = parse_bound(range.min_arg)
+            range.max, range.max_exclusive = parse_bound(range.max_arg)
+            range.size = redis.call('ZCOUNT', range.key, range.min_arg, range.max_arg)
+            table.insert(stack, range)
+            i = i + 4
+        elseif op == 'not' then
+            stack[#stack] = {kind = 'not', operand = stack[#stack]}
+            i = i + 1
+        else
+            local n = tonumber(ARGV[i + 1])
+            local operands = {}
+            for j = #stack - n + 1, #stack do
+                table.insert(operands, stack[j])
+            end
+            for j = 1, n do
+                table.remove(stack)
+            end
+            if op == 'and' then
+                table.insert(stack, intersect(operands))
+            else
+                table.insert(stack, union(operands))
+            end
+            i = i + 2
+        end
+    end
+
+    local operand = stack[1]
+    local reply = {'', 0, 0}
+    if operand.size > 0 and not operand.temp then
+        reply = {operand.key, operand.size, 0}
+    elseif operand.size > 0 then
+        redis.call('RENAME', operand.key, result)
+        redis.call('EXPIRE', result, ARGV[1])
+        redis.call('SADD', KEYS[1] .. ':results', result)
+        redis.call('EXPIRE', KEYS[1] .. ':results', ARGV[1])
+        reply = {result, operand.size, 1}
+    end
+    for _, key in ipairs(temps) do
+        if key ~= operand.key then
+            redis.call('DEL', key)
+        end
+    end
+    return reply
+end
+"""
+
+PLAN_QUERY = QUERY_PLANNER + """
+return plan_query(#ARGV)
+"""
+
+# Counts the documents per indexed value of properties. ARGV holds the
+# plan_query arguments, or only ARGV[1] for every document of the class,
+# then 'end' and an (i, prefix) pair per property: KEYS[i] is the registry
+# of its values and prefix .. value the index set of a value. Returns the
+# plan_query reply, or {'', 0, 0}, then for each property the number of
+# values followed by value, count pairs. Values without a match are left
+# out.
+FACET_COUNTS = QUERY_PLANNER + """
+local last = 1
+while ARGV[last + 1] ~= 'end' do
+    last = last + 1
+end
+local reply = {'', 0, 0}
+if last > 1 then
+    reply = plan_query(last)
+    if reply[1] == '' then
+        return reply
+    end
+end
+for i = last + 2, #ARGV, 2 do
+    local counts = {}
+    for _, value in ipairs(redis.call('ZRANGE', KEYS[tonumber(ARGV[i])], 0, -1)) do
+        local index = ARGV[i + 1] .. value
+        local count
+        if last == 1 then
+            count = redis.call('SCARD', index)
+        else
+            local ok, cardinality = pcall(redis.call, 'SINTERCARD', 2, reply[1], index)
+            if ok then
+                count = cardinality
+            else
+                -- SINTERCARD is new in Redis 7.0
+                count = #redis.call('SINTER', reply[1], index)
+            end
+        end
+        if count > 0 then
+            table.insert(counts, value)
+            table.insert(counts, count)
+        end
+    end
+    table.insert(reply, #counts / 2)
+    for _, item in ipairs(counts) do
+        table.insert(reply, item)
+    end
+end
+return reply
+"""
+
+# Reads the numeric fields ARGV[last + 2] on of the documents matching a
+# query, where ARGV[last + 1] is 'end' and the ARGV before it are the
+# plan_query arguments, or only ARGV[1] for every document of the class.
+# The fields are followed by 'sorted' and pairs of a field and the position
+# in KEYS of its sorted index, for fields that only need a minimum and a
+# maximum. Those are read from the ends of the index, skipping the ids the
+# query doesn't match, instead of from every document.
+# Returns {'', 0, 0, 0} if a sorted index doesn't cover every document of the
+# class yet. Otherwise returns the plan_query reply, or {'', 0, 0}, then 1,
+# the number of documents, for each numeric field the number of documents
+# with a value and the sum, minimum and maximum of the values, and for each
+# sorted field the minimum and maximum.
+# The sum is a '%.17g' string and the minimum and maximum are returned as
+# stored ('' when there is none).
+AGGREGATE = QUERY_PLANNER + """
+local last = 1
+while ARGV[last + 1] ~= 'end' do
+    last = last + 1
+end
+local fields = {}
+local stats = {}
+local i = last + 2
+while ARGV[i] ~= 'sorted' do
+    table.insert(fields, ARGV[i])
+    table.insert(stats, {count = 0, sum = 0})
+    i = i + 1
+end
+local sorted = {}
+for j = i + 1, #ARGV, 2 do
+    local key = KEYS[tonumber(ARGV[j + 1])]
+    if redis.call('ZCARD', key) < redis.call('SCARD', KEYS[3]) then
+        return {'', 0, 0, 0}
+    end
+    table.insert(sorted, {field = ARGV[j], key = key})
+end
+local ids_key = KEYS[3]
+local reply = {'', 0, 0}
+if last > 1 then
+    reply = plan_query(last)
+    if reply[1] == '' then
+        return reply
+    end
+    ids_key = reply[1]
+end
+table.insert(reply, 1)
+table.insert(reply, redis.call('SCARD', ids_key))
+if #fields > 0 then
+    for _, id in ipairs(redis.call('SMEMBERS', ids_key)) do
+        local values = redis.call('HMGET', id, unpack(fields))
+        for i, value in ipairs(stats) do
+            local number = tonumber(values[i])
+            if number then
+                value.count = value.count + 1
+                value.sum = value.sum + number
+                if not value.min or number < value.min_number then
+                    value.min, value.min_number = values[i], number
+                end
+                if not value.max or number > value.max_number then
+                    value.max, value.max_number = values[i], number
+                end
+            end
+        end
+    end
+end
+for _, value in ipairs(stats) do
+    table.insert(reply, value.count)
+    table.insert(reply, string.format('%.17g', value.sum))
+    table.insert(reply, value.min or '')
+    table.insert(reply, value.max or '')
+end
+-- Documents without a value have a score of -inf and come first
+local function first_value(field, key, range, start, stop)
+    while start <= stop do
+        for _, id in ipairs(redis.call(range, key, start, math.min(start + 99, stop))) do
+            if last == 1 or redis.call('SISMEMBER', ids_key, id) == 1 then
+                return redis.call('HGET', id, field) or ''
+            end
+        end
+        start = start + 100
+    end
+    return ''
+end
+for _, index in ipairs(sorted) do
+    local missing = redis.call('ZCOUNT', index.key, '-inf', '-inf')
+    local stop = redis.call('ZCARD', index.key) - 1
+    table.insert(reply, first_value(index.field, index.key, 'ZRANGE', missing, stop))
+    table.insert(reply, first_value(index.field, index.key, 'ZREVRANGE', 0, stop - missing))
+end
+return reply
+"""
+
+# Increments the query version counter KEYS[1] and shortens the lifetime of
+# the results stored for the previous version to ARGV[1] seconds, so they
+# don't pile up under heavy writes while readers still scanning one can
+# finish.
+EXPIRE_RESULTS = """
+redis.call('INCR', KEYS[1])
+local results = KEYS[1] .. ':results'
+for _, key in ipairs(redis.call('SMEMBERS', results)) do
+    local ttl = redis.call('TTL', key)
+    if ttl < 0 or ttl > tonumber(ARGV[1]) then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+end
+redis.call('DEL', results)
+"""
+
+# Reads one page of the documents matching a query. ARGV[last + 1] is 'end'
+# and the ARGV before it are the plan_query arguments, or only ARGV[1] for
+# every document of the class. After 'end' come the position in KEYS of the
+# sorted index to order by (0 to order the ids alphabetically), '1' for a
+# descending order, the offset and size of the page, then the hash fields to
+# read (every field when there are none).
+# Returns the plan_query reply, or {'', 0, 0}, then 0 if the sorted index
+# doesn't cover every document of the class yet, or 1 followed by the HMGET
+# or HGETALL reply of each document of the page.
+FETCH_PAGE = QUERY_PLANNER + """
+local last = 1
+while ARGV[last + 1] ~= 'end' do
+    last = last + 1
+end
+local sort_index = tonumber(ARGV[last + 2])
+local range = ARGV[last + 3] == '1' and 'ZREVRANGE' or 'ZRANGE'
+local start = tonumber(ARGV[last + 4])
+local num = tonumber(ARGV[last + 5])
+local fields = {}
+for i = last + 6, #ARGV do
+    table.insert(fields, ARGV[i])
+end
+local ids_key = KEYS[3]
+local reply = {'', 0, 0}
+if last > 1 then
+    reply = plan_query(last)
+    if reply[1] == '' then
+        return reply
+    end
+    ids_key = reply[1]
+end
+local ids
+if sort_index > 0 then
+    local sort_key = KEYS[sort_index]
+    if redis.call('ZCARD', sort_key) < redis.call('SCARD', KEYS[3]) then
+        table.insert(reply, 0)
+        return reply
+    end
+    if last == 1 then
+        ids = redis.call(range, sort_key, start, start + num - 1)
+    else
+        local sorted = ids_key .. ':sorted'
+        redis.call('ZINTERSTORE', sorted, 2, ids_key, sort_key, 'WEIGHTS', 0, 1)
+        ids = redis.call(range, sorted, start, start + num - 1)
+        redis.call('DEL', sorted)
+    end
+else
+    ids = redis.call('SORT', ids_key, 'LIMIT', start, num, 'ALPHA')
+end
+table.insert(reply, 1)
+for _, id in ipairs(ids) do
+    if #fields > 0 then
+        table.insert(reply, redis.call('HMGET', id, unpack(fields)))
+    else
+        table.insert(reply, redis.call('HGETALL', id))
+    end
+end
+return reply
+"""
+
+# Reserves the unique value keys KEYS for the document id ARGV[1]. Nothing
+# is written unless every key is free or already held by the document.
+# Returns {i} with the 1-based position of the first conflicting key, or
+# {0, ...} followed by the positions of the keys that were newly taken.
+RESERVE_UNIQUE = """
+local taken = {0}
+for i, key in ipairs(KEYS) do
+    local owner = redis.call('GET', key)
+    if owner and owner ~= ARGV[1] then
+        return {i}
+    end
+    if not owner then
+        table.insert(taken, i)
+    end
+end
+for i = 2, #taken do
+    redis.call('SET', KEYS[taken[i]], ARGV[1])
+end
+return taken
+"""
+
+# Deletes the unique value keys KEYS that are still held by ARGV[1].
+RELEASE_UNIQUE = """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+# Adds ARGV[2] to the numeric field ARGV[1] of the hash KEYS[1] and moves the
+# document ARGV[6] between the index sets prefixed ARGV[7], if any, whose
+# values are listed in the registry ARGV[8], and in the sorted index
+# KEYS[2], if given. ARGV[3] is '1' for float fields, whose
+# values are written with the shortest repr that reads back the same, like
+# Python does. ARGV[4] and ARGV[5] are the min and max values or ''; like
+# valley's validators they let 0 through. Returns {0, new value}, {-1} if
+# the hash doesn't exist or {-2, rejected value} without writing anything.
+INCR_FIELD = """
+local function format_float(n)
+    if n == math.floor(n) and math.abs(n) < 1e16 then
+        return string.format('%d', n) .. '.0'
+    end
+    for p = 1, 17 do
+        local s = string.format('%.' .. p .. 'g', n)
+        if tonumber(s) == n then
+            return s
+        end
+    end
+end
+
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1}
+end
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+local new = (tonumber(old) or 0) + tonumber(ARGV[2])
+local value
+if ARGV[3] == '1' then
+    value = format_float(new)
+else
+    value = string.format('%d', new)
+end
+if new ~= 0 and ((ARGV[4] ~= '' and new < tonumber(ARGV[4])) or
+        (ARGV[5] ~= '' and new > tonumber(ARGV[5]))) then
+    return {-2, value}
+end
+redis.call('HSET', KEYS[1], ARGV[1], value)
+if ARGV[7] ~= '' then
+    if old then
+        redis.call('SREM', ARGV[7] .. old, ARGV[6])
+        if redis.call('SCARD', ARGV[7] .. old) == 0 then
+            redis.call('ZREM', ARGV[8], old)
+        end
+    end
+    if new ~= 0 then
+        redis.call('SADD', ARGV[7] .. value, ARGV[6])
+        redis.call('ZADD', ARGV[8], 0, value)
+    end
+end
+if KEYS[2] then
+    redis.call('ZADD', KEYS[2], string.format('%.17g', new), ARGV[6])
+end
+return {0, value}
+"""
+
+# Removes the document ARGV[1] from the index set KEYS[1] and drops the
+# value ARGV[2] from the registry KEYS[2] once no document has it.
+REMOVE_INDEX = """
+redis.call('SREM', KEYS[1], ARGV[1])
+if redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+"""
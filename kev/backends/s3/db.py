@@ -1,26 +1,113 @@
 import boto3
 import json
 import re
+from botocore.exceptions import BotoCoreError, ClientError
 
 from kev.backends import DocDB
+from kev.exceptions import ResourceError
+from kev.query import FilterNode, RangeFilter
+from kev.utils import chunks, encode_score
 
 
-class S3DB(DocDB):
+class S3ObjectMixin(object):
+    """
+    Reads and writes documents stored as JSON objects in an S3 bucket, for
+    the backends that keep them there.
+    """
+    session_kwargs = ['aws_secret_access_key', 'aws_access_key_id', 'endpoint_url']
+    # Most keys a DeleteObjects request takes
+    delete_batch_size = 1000
+
+    def connect_s3(self, kwargs):
+        session_kwargs = {k: v for k, v in kwargs.items() if k in
+                          self.session_kwargs}
+        self.bucket = kwargs['bucket']
+        return boto3.resource('s3', **session_kwargs)
+
+    def get_object_key(self, doc_class, doc_id):
+        """Returns the key of the object of the document doc_id."""
+        raise NotImplementedError
+
+    def put_object(self, key, doc):
+        # Uses the client rather than the resource so it can be shared by
+        # worker threads.
+        self._db.meta.client.put_object(
+            Bucket=self.bucket, Key=key, Body=json.dumps(doc))
+
+    def get(self, doc_class, doc_id, fields=None):
+        # Documents are single objects, so projections load them in full
+        doc = json.loads(self._db.Object(
+            self.bucket, self.get_object_key(doc_class, doc_id)).get().get(
+            'Body').read().decode())
+        return self.make_doc(doc_class, doc)
+
+    def get_object(self, key):
+        """
+        Returns the decoded JSON object stored under key, or None if there
+        is no such key.
+        """
+        try:
+            response = self._db.meta.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read().decode())
+
+    def fetch_many(self, doc_class, doc_ids):
+        keys = [self.get_object_key(doc_class, doc_id) for doc_id in doc_ids]
+        return [self.make_doc(doc_class, doc) if doc is not None else None
+                for doc in self.map_concurrent(self.get_object, keys)]
+
+    def list_keys(self, prefix, start_after=None):
+        """
+        Yields the keys under prefix in lexicographic order, starting after
+        start_after when it is given.
+        """
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        paginator = self._db.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def delete_keys(self, keys):
+        """
+        Deletes keys with DeleteObjects, delete_batch_size keys per request
+        and several requests at a time.
+        """
+        def delete(batch):
+            response = self._db.meta.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            return response.get('Errors', [])
+
+        for errors in self.map_concurrent(delete, chunks(keys, self.delete_batch_size)):
+            if errors:
+                raise ResourceError('Could not delete {Key}: {Message}'.format(**errors[0]))
+
+
+class S3DB(S3ObjectMixin, DocDB):
     db_class = boto3.resource
     backend_id = 's3'
     doc_id_string = '{doc_id}:id:{backend_id}:{class_name}'
     index_pattern = r'^(?P<backend_id>[-\w]+):(?P<class_name>[-\w]+)' \
-                    ':indexes:(?P<index_name>[-\w]+):(?P<index_value>' \
+                    ':indexes:(?P<index_name>[^:]+):(?P<index_value>' \
                     '[-\W\w\s]+)/(?P<doc_id>[-\w]+):id:' \
                     '(?P<backend_id_b>[-\w]+):(?P<class_name_b>[-\w]+)$'
-    session_kwargs = ['aws_secret_access_key', 'aws_access_key_id', 'endpoint_url']
+    # Page boundaries remembered per listing prefix, 0 to remember none.
+    # They are only forgotten by writes made through this connection, so
+    # turn them on only where it is the single writer of the bucket.
+    page_cursor_size = 0
+    # Keys returned per list_objects_v2 request
+    list_page_size = 1000
+    # Candidates of a multi filter query that are few enough to be checked
+    # with HEAD requests instead of listing the remaining index prefixes
+    verify_size = 100
 
     def __init__(self, **kwargs):
-        session_kwargs = {k: v for k, v in kwargs.items() if k in
-                          self.session_kwargs}
-
-        self._db = boto3.resource('s3', **session_kwargs)
-        self.bucket = kwargs['bucket']
+        self._db = self.connect_s3(kwargs)
         self._indexer = self._db.Bucket(self.bucket)
         self._kwargs = kwargs
 
@@ -33,51 +120,109 @@ class S3DB(DocDB):
     def get_full_id(self, doc_class, doc_id):
         return '{}{}'.format(self.all_prefix(doc_class), doc_id)
 
+    def get_object_key(self, doc_class, doc_id):
+        return self.get_full_id(doc_class, doc_class.get_doc_id(doc_id))
+
     def save(self, doc_obj):
         doc_obj, doc = self._save(doc_obj)
-        self._db.Object(self.bucket, self.get_full_id(
-            doc_obj.__class__, doc_obj._id)).put(
-            Body=json.dumps(doc))
-        self.add_indexes(doc_obj, doc)
-        self.remove_indexes(doc_obj)
+        reserved = self.reserve_doc(doc_obj, doc)
+        try:
+            self.write_doc(doc_obj, doc)
+        except (BotoCoreError, ClientError):
+            self.release_unique(doc_obj, reserved)
+            raise
         return doc_obj
 
-    def get(self, doc_class, doc_id):
-        doc = json.loads(self._db.Object(
-            self.bucket, self.get_full_id(doc_class,
-                                          doc_class.get_doc_id(doc_id))).get().get('Body').read().decode())
-        return doc_class(**doc)
+    def write_doc(self, doc_obj, doc):
+        self.put_object(self.get_full_id(doc_obj.__class__, doc_obj._id), doc)
+        self.remove_indexes(doc_obj)
+        self.add_indexes(doc_obj, self.changed_values(doc_obj, doc))
+        self.release_unique(doc_obj, self.get_stale_unique_keys(doc_obj))
+        self.clear_page_cursors(doc_obj.__class__)
+        doc_obj.clear_changes()
+
+    def write_many(self, prepared):
+        def write(item):
+            try:
+                self.write_doc(item[1], item[2])
+            except (BotoCoreError, ClientError) as e:
+                return e
+            return item[1]
+
+        for item, result in zip(prepared, self.map_concurrent(write, prepared)):
+            yield item[0], result
 
     def get_raw(self, doc_class, doc_id):
         doc = json.loads(self._db.Object(self.bucket, doc_id).get().get(
             'Body').read().decode())
-        return doc_class(**doc)
+        return self.make_doc(doc_class, doc)
 
     def flush_db(self):
-        obj_list = self._db.Bucket(self.bucket).objects.all()
-        for i in obj_list:
-            i.delete()
+        self.delete_keys(self.list_keys(''))
+        self._page_cursors = None
 
     def delete(self, doc_obj):
-        self._db.Object(
-            self.bucket,
-            self.get_full_id(doc_obj.__class__, doc_obj._id)).delete()
-        self.remove_from_model_set(doc_obj)
-        doc_obj._index_change_list = doc_obj.get_indexes()
-        self.remove_indexes(doc_obj)
+        self.delete_many([doc_obj])
+
+    def delete_many(self, doc_list):
+        """
+        Deletes the objects and index keys of the documents with batched
+        DeleteObjects requests, then releases their unique values.
+        """
+        keys = []
+        for doc_obj in doc_list:
+            keys.append(self.get_full_id(doc_obj.__class__, doc_obj._id))
+            keys.extend('{0}/{1}'.format(index_v, doc_obj._id) for index_v in
+                        doc_obj.get_indexes() + doc_obj.get_range_indexes())
+        self.delete_keys(keys)
+        for doc_obj in self.map_concurrent(self.release_doc_unique, doc_list):
+            self.clear_page_cursors(doc_obj.__class__)
+        return len(doc_list)
+
+    def release_doc_unique(self, doc_obj):
+        self.release_unique(doc_obj, [i[2] for i in doc_obj.get_unique_values()])
+        return doc_obj
 
     def all(self, doc_class, skip, limit):
-        all_prefix = self.all_prefix(doc_class)
-        if limit is None:
-            response = self._indexer.objects.filter(Prefix=all_prefix)
-        else:
-            response = self._indexer.objects.filter(Prefix=all_prefix).limit(limit)
-        id_list = [id.key for id in response]
-        for id in id_list:
-            if skip and skip > 0:
-                skip -= 1
-                continue
-            yield self.get_raw(doc_class, id)
+        key_list = self.list_window(doc_class, self.all_prefix(doc_class), skip, limit)
+        for doc in self.map_concurrent(self.get_object, key_list):
+            if doc is not None:
+                yield self.make_doc(doc_class, doc)
+
+    def list_window(self, doc_class, prefix, skip=None, limit=None):
+        """
+        Yields the keys under prefix in the skip/limit window. The last key
+        of each window read in full is remembered, so a later page starting
+        at or after it resumes the listing with StartAfter instead of listing
+        from the first key. Saves and deletes made through this connection
+        forget the remembered pages of their class. Nothing is remembered
+        unless page_cursor_size is set.
+        """
+        if not self.page_cursor_size:
+            return self.paginate(self.list_keys(prefix), skip, limit)
+        return self.list_cursor_window(doc_class, prefix, skip, limit)
+
+    def list_cursor_window(self, doc_class, prefix, skip, limit):
+        cursors = self.get_page_cursors(doc_class).setdefault(prefix, {})
+        skip = skip or 0
+        offset = max([i for i in cursors if i <= skip] or [0])
+        key = None
+        count = 0
+        for key in self.paginate(self.list_keys(prefix, cursors.get(offset)),
+                                 skip - offset, limit):
+            count += 1
+            yield key
+        if key is not None and len(cursors) < self.page_cursor_size:
+            cursors[skip + count] = key
+
+    def get_page_cursors(self, doc_class):
+        if getattr(self, '_page_cursors', None) is None:
+            self._page_cursors = {}
+        return self._page_cursors.setdefault(doc_class.get_class_name(), {})
+
+    def clear_page_cursors(self, doc_class):
+        if getattr(self, '_page_cursors', None):
+            self._page_cursors.pop(doc_class.get_class_name(), None)
 
     # Indexing Methods
 
@@ -86,39 +231,272 @@ class S3DB(DocDB):
             doc_obj.__class__, doc_obj._id)).delete()
 
     def remove_indexes(self, doc_obj):
-        for index_v in doc_obj._index_change_list:
-            self._db.Object(self.bucket, '{0}/{1}'.format(index_v, doc_obj._id)).delete()
+        for index_v in doc_obj._index_change_list + doc_obj._sort_change_list:
+            self._db.meta.client.delete_object(
+                Bucket=self.bucket, Key='{0}/{1}'.format(index_v, doc_obj._id))
 
     def add_indexes(self, doc_obj, doc):
         index_list = doc_obj.get_indexed_props()
         for prop in index_list:
+            # Index keys of unchanged values already exist
+            if prop not in doc:
+                continue
             index_value = doc.get(prop)
             # if index_value:
-            self._db.Object(self.bucket, '{0}/{1}'.format(
-                doc_obj.get_index_name(prop, index_value),
-                doc_obj._id)).put(Body='')
+            self._db.meta.client.put_object(
+                Bucket=self.bucket, Key='{0}/{1}'.format(
+                    doc_obj.get_index_name(prop, index_value),
+                    doc_obj._id), Body='')
+        for index_name in doc_obj.get_compound_indexes(doc):
+            self._db.meta.client.put_object(
+                Bucket=self.bucket, Key='{0}/{1}'.format(index_name, doc_obj._id),
+                Body='')
+        # Sorted indexes are kept as keys whose encoded score sorts in
+        # numeric order, so range lookups are a single prefix listing.
+        for prop in doc_obj.get_sortable_props():
+            if prop not in doc:
+                continue
+            self._db.meta.client.put_object(
+                Bucket=self.bucket, Key='{0}/{1}'.format(
+                    doc_obj.get_range_index_name(prop, doc.get(prop)),
+                    doc_obj._id), Body='')
+
+    def add_compound_indexes(self, doc_list):
+        keys = ['{0}/{1}'.format(index_name, doc_obj._id) for doc_obj in doc_list
+                for index_name in doc_obj.get_compound_indexes()]
+        list(self.map_concurrent(lambda key: self._db.meta.client.put_object(
+            Bucket=self.bucket, Key=key, Body=''), keys))
+
+    # Unique value reservations are marker objects holding the id of their
+    # document, created with a conditional put so only one writer wins.
+
+    def get_marker(self, key):
+        try:
+            response = self._db.meta.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read().decode()
+
+    def get_unique_owner(self, doc_obj, key, value):
+        return self.get_marker(doc_obj.get_unique_name(key, value))
+
+    def reserve_keys(self, doc_obj, unique_list):
+        taken = []
+        for key, value, unique_name in unique_list:
+            try:
+                self._db.meta.client.put_object(
+                    Bucket=self.bucket, Key=unique_name, Body=doc_obj._id,
+                    IfNoneMatch='*')
+                taken.append(unique_name)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in (
+                        'PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                if self.get_marker(unique_name) != doc_obj._id:
+                    self.release_unique(doc_obj, taken)
+                    return self.unique_error(key, value), []
+        return None, taken
+
+    def reserve_unique(self, items):
+        return list(self.map_concurrent(
+            lambda item: self.reserve_keys(item[0], item[0].get_unique_values(item[1])),
+            items))
+
+    def release_unique(self, doc_obj, keys):
+        for key in keys:
+            if self.get_marker(key) == doc_obj._id:
+                self._db.meta.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def get_id_list(self, filters_list):
+        nodes = [f for f in filters_list if isinstance(f, FilterNode)]
+        if nodes:
+            return iter(sorted(self.get_node_ids(FilterNode(
+                nodes[0].doc_class, FilterNode.AND, filters_list))))
+        if len(filters_list) == 1 and isinstance(filters_list[0], RangeFilter):
+            return self.get_range_id_list(filters_list[0])
+        elif len(filters_list) == 1:
+            filter_value = '{}/'.format(filters_list[0])
+            return (re.match(self.index_pattern, key).groupdict()['doc_id']
+                    for key in self.list_keys(filter_value))
+        else:
+            return iter(sorted(self.intersect_filters(filters_list)))
+
+    def intersect_filters(self, filters_list):
+        """
+        Returns the set of ids matching every filter. The listings of the
+        filters are read concurrently a page at a time. The first one to end
+        is the smallest and its ids become the candidates; after that only
+        candidates are kept from the other listings. Once there are at most
+        verify_size candidates, equality filters whose listing hasn't ended
+        are checked with HEAD requests on the candidates' index keys instead.
+        """
+        pages = {i: chunks(self.get_id_list([f]), self.list_page_size)
+                 for i, f in enumerate(filters_list)}
+        seen = {i: set() for i in pages}
+        candidates = None
+
+        def read_page(i):
+            return i, next(pages[i], [])
+
+        while pages:
+            for i, page in list(self.map_concurrent(read_page, list(pages))):
+                if candidates is not None:
+                    page = [doc_id for doc_id in page if doc_id in candidates]
+                seen[i].update(page)
+                if len(page) < self.list_page_size:
+                    del pages[i]
+                    ids = seen.pop(i)
+                    candidates = ids if candidates is None else candidates & ids
+            if candidates is not None:
+                if not candidates:
+                    return candidates
+                if len(candidates) <= self.verify_size and not any(
+                        isinstance(filters_list[i], RangeFilter) for i in pages):
+                    break
+        for i in pages:
+            unseen = list(candidates - seen[i])
+            found = self.map_concurrent(
+                lambda doc_id, f=filters_list[i]: self.index_key_exists(f, doc_id), unseen)
+            candidates = (candidates & seen[i]) | set(
+                doc_id for doc_id, exists in zip(unseen, found) if exists)
+        return candidates
 
-    def evaluate(self, filters_list, sortingp_list, all_param, doc_class):
+    def get_node_ids(self, node):
+        """
+        Returns the set of ids matching a FilterNode. The listings of its
+        children are read concurrently and combined in memory; the plain
+        filters of an AND node are intersected with intersect_filters.
+        """
+        def get_ids(item):
+            if isinstance(item, FilterNode):
+                return self.get_node_ids(item)
+            return set(self.get_id_list([item]))
+
+        if node.op == FilterNode.NOT:
+            return self.get_all_ids(node.doc_class) - get_ids(node.children[0])
+        if node.op == FilterNode.OR:
+            return set().union(*self.map_concurrent(get_ids, node.children))
+        plain = [f for f in node.children if not isinstance(f, FilterNode)]
+        nodes = [f for f in node.children if isinstance(f, FilterNode)]
+        negated = [f.children[0] for f in nodes if f.op == FilterNode.NOT]
+        nodes = [f for f in nodes if f.op != FilterNode.NOT]
+        ids = self.intersect_filters(plain) if plain else None
+        for node_ids in self.map_concurrent(get_ids, nodes):
+            ids = node_ids if ids is None else ids & node_ids
+        if ids is None:
+            # Only negated filters, which are taken out of every document
+            ids = self.get_all_ids(node.doc_class)
+        for node_ids in self.map_concurrent(get_ids, negated):
+            ids -= node_ids
+        return ids
+
+    def facets(self, filters_list, doc_class, props):
+        # Each property's index keys are listed once and counted for the
+        # ids matching the filters
+        ids = None if filters_list is None else set(self.get_id_list(filters_list))
+
+        def count(prop):
+            prefix = doc_class.get_index_name(prop, '')
+            convert = self.get_value_converter(doc_class._base_properties[prop])
+            counts = {}
+            for key in self.list_keys(prefix):
+                value, doc_id = key[len(prefix):].rsplit('/', 1)
+                if ids is None or self.parse_id(doc_id) in ids:
+                    value = convert(value)
+                    counts[value] = counts.get(value, 0) + 1
+            return counts
+
+        return dict(zip(props, self.map_concurrent(count, props)))
+
+    def get_all_ids(self, doc_class):
+        prefix = self.all_prefix(doc_class)
+        return set(self.parse_id(key[len(prefix):]) for key in self.list_keys(prefix))
+
+    def index_key_exists(self, index_name, doc_id):
+        # Index keys end with the full id of their document
+        key = '{0}/{1}'.format(index_name, self.doc_id_string.format(
+            doc_id=doc_id, backend_id=self.backend_id,
+            class_name=index_name.split(':')[1]))
+        try:
+            self._db.meta.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        return True
+
+    def get_index_id_list(self, doc_class, index_name, skip=None, limit=None):
+        keys = self.list_window(doc_class, '{}/'.format(index_name), skip, limit)
+        return (re.match(self.index_pattern, key).groupdict()['doc_id'] for key in keys)
+
+    def count(self, filters_list, all_param, doc_class):
+        if all_param.all:
+            keys = self.list_keys(self.all_prefix(doc_class))
+        else:
+            keys = self.get_id_list(filters_list)
+        return sum(1 for i in self.paginate(keys, all_param.skip, all_param.limit))
+
+    def get_range_id_list(self, range_filter):
+        prefix = '{0}:'.format(range_filter.index_name)
+        min_score = encode_score(range_filter.min_score)
+        max_score = encode_score(range_filter.max_score)
+        # '/' sorts before the hex digits, so appending '0' skips every key
+        # of the excluded minimum score.
+        start_after = prefix + min_score + ('' if range_filter.min_inclusive else '0')
+        for key in self.list_keys(prefix, start_after):
+            score, doc_id = key[len(prefix):].split('/', 1)
+            if score > max_score or (score == max_score and not range_filter.max_inclusive):
+                break
+            yield self.parse_id(doc_id)
+
+    def evaluate(self, filters_list, sortingp_list, all_param, doc_class,
+                 fields=None):
         if all_param.all and len(sortingp_list) > 0:
-            docs_list = list(self.all(doc_class, skip=all_param.skip, limit=all_param.limit))
-            for doc in self.sort(sortingp_list, docs_list, doc_class):
+            docs_list = self.all(doc_class, None, None)
+            for doc in self.sort(sortingp_list, docs_list, doc_class,
+                                 all_param.skip, all_param.limit):
                 yield doc
         elif all_param.all:
             for doc in self.all(doc_class, skip=all_param.skip, limit=all_param.limit):
                 yield doc
         else:
-            if len(filters_list) == 1:
-                filter_value = '{}/'.format(filters_list[0])
-                raw_id_list = self._indexer.objects.filter(Prefix=filter_value)
-                id_list = [re.match(self.index_pattern, id.key).groupdict()['doc_id'] \
-                           for id in raw_id_list]
-            else:
-                raise ValueError('There should only be one filter for S3 backends')
             if len(sortingp_list) > 0:
-                docs_list = [doc_class.get(id) for id in id_list]
-                sorted_list = self.sort(sortingp_list, docs_list, doc_class)
+                docs_list = self.get_many(doc_class, self.get_id_list(filters_list))
+                sorted_list = self.sort(sortingp_list, docs_list, doc_class,
+                                        all_param.skip, all_param.limit)
                 for doc in sorted_list:
                     yield doc
             else:
-                for id in id_list:
-                    yield self.get(doc_class, id)
+                id_list = self.get_window_ids(filters_list, all_param, doc_class)
+                for doc in self.get_many(doc_class, id_list):
+                    yield doc
+
+    def get_window_ids(self, filters_list, all_param, doc_class):
+        if len(filters_list) > 1 or isinstance(filters_list[0], (FilterNode, RangeFilter)):
+            return self.paginate(self.get_id_list(filters_list),
+                                 all_param.skip, all_param.limit)
+        return self.get_index_id_list(
+            doc_class, filters_list[0], all_param.skip, all_param.limit)
+
+    def evaluate_values(self, filters_list, sortingp_list, all_param, doc_class,
+                        fields):
+        if len(sortingp_list) > 0:
+            return super(S3DB, self).evaluate_values(
+                filters_list, sortingp_list, all_param, doc_class, fields)
+        if all_param.all:
+            keys = self.list_window(doc_class, self.all_prefix(doc_class),
+                                    all_param.skip, all_param.limit)
+        else:
+            keys = (self.get_full_id(doc_class, doc_class.get_doc_id(doc_id)) for doc_id
+                    in self.get_window_ids(filters_list, all_param, doc_class))
+        return self.load_values(doc_class, keys, fields)
+
+    def load_values(self, doc_class, keys, fields):
+        # The JSON objects are converted without building documents
+        load = self.get_value_loader(doc_class, fields)
+        raw_keys = self.get_raw_keys(fields)
+        for doc in self.map_concurrent(self.get_object, keys):
+            if doc is not None:
+                yield load([doc.get(key) for key in raw_keys])
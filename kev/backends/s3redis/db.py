@@ -1,92 +1,135 @@
 import boto3
-import json
 import redis
+from botocore.exceptions import BotoCoreError, ClientError
 
+from kev.backends import DocDB
 from kev.backends.redis.db import RedisDB
-from kev.exceptions import QueryError
+from kev.backends.s3.db import S3ObjectMixin
+from kev.utils import chunks
 
 
-class S3RedisDB(RedisDB):
+class S3RedisDB(S3ObjectMixin, RedisDB):
 
     db_class = boto3.resource
     indexer_class = redis.StrictRedis
     backend_id = 's3redis'
-    session_kwargs = ['aws_secret_access_key', 'aws_access_key_id', 'endpoint_url']
+    # Documents are whole S3 objects, so they are always written in full
+    partial_updates = False
+    # The documents are in S3, so pages are always loaded from there
+    fetch_page_size = 0
     
     def __init__(self, **kwargs):
-
-        session_kwargs = {k: v for k, v in kwargs.items() if k in
-                          self.session_kwargs}
-
-        self._db = boto3.resource('s3', **session_kwargs)
-        self.bucket = kwargs['bucket']
+        self._db = self.connect_s3(kwargs)
         self._kwargs = kwargs
-        self._indexer = self.indexer_class(**kwargs['indexer'])
+        self._indexer = self.connect(self.indexer_class, **kwargs['indexer'])
 
     #CRUD Operation Methods
 
     def save(self,doc_obj):
+        new = '_id' not in doc_obj._data
         doc_obj, doc = self._save(doc_obj)
-
-        self._db.Object(self.bucket, doc_obj._id).put(
-                Body=json.dumps(doc))
+        reserved = self.reserve_doc(doc_obj, doc)
+        try:
+            self.put_doc(doc_obj, doc)
+        except (BotoCoreError, ClientError):
+            self.release_unique(doc_obj, reserved)
+            raise
         pipe = self._indexer.pipeline()
-        pipe = self.add_to_model_set(doc_obj, pipe)
-        pipe = self.add_indexes(doc_obj, doc, pipe)
-        pipe = self.remove_indexes(doc_obj, pipe)
-        pipe.execute()
+        pipe = self.write_indexes(doc_obj, doc, pipe)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            self.release_unique(doc_obj, reserved)
+            if new:
+                # A new object without index entries could only be found by
+                # its id, so it is removed again
+                self.delete_keys([doc_obj._id])
+            raise
+        doc_obj.clear_changes()
 
         return doc_obj
 
-    def get(self,doc_class,doc_id):
-        doc = json.loads(self._db.Object(
-                self.bucket, doc_class.get_doc_id(
-                doc_id)).get().get('Body').read().decode())
-        return doc_class(**doc)
+    def put_doc(self, doc_obj, doc):
+        self.put_object(doc_obj._id, doc)
+
+    def get_object_key(self, doc_class, doc_id):
+        return doc_class.get_doc_id(doc_id)
+
+    def write_indexes(self, doc_obj, doc, pipeline):
+        pipeline = self.add_to_model_set(doc_obj, pipeline)
+        pipeline = self.expire_query_results(doc_obj.__class__, pipeline)
+        pipeline = self.remove_indexes(doc_obj, pipeline)
+        pipeline = self.add_indexes(doc_obj, self.changed_values(doc_obj, doc), pipeline)
+        pipeline = self.release_unique(
+            doc_obj, self.get_stale_unique_keys(doc_obj), pipeline)
+        return pipeline
+
+    def write_many(self, prepared):
+        def put(item):
+            try:
+                self.put_doc(item[1], item[2])
+            except (BotoCoreError, ClientError) as e:
+                return e
+
+        errors = self.map_concurrent(put, prepared)
+        written = []
+        for item, error in zip(prepared, errors):
+            if error is not None:
+                yield item[0], error
+            else:
+                written.append(item)
+        for chunk in chunks(written, self.get_chunk_size()):
+            pipe = self._indexer.pipeline(transaction=False)
+            for index, doc_obj, doc in chunk:
+                pipe = self.write_indexes(doc_obj, doc, pipe)
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                for index, doc_obj, doc in chunk:
+                    yield index, e
+                continue
+            for index, doc_obj, doc in chunk:
+                doc_obj.clear_changes()
+                yield index, doc_obj
+
+    # Documents live in S3 rather than in Redis hashes, so field updates
+    # use the read-modify-write fallback.
+
+    def incr(self, doc_obj, key, amount):
+        return DocDB.incr(self, doc_obj, key, amount)
+
+    def set_fields(self, doc_obj, fields):
+        return DocDB.set_fields(self, doc_obj, fields)
+
+    def aggregate(self, filters_list, doc_class, aggregates):
+        # The values are in S3, out of reach of the Redis script
+        return DocDB.aggregate(self, filters_list, doc_class, aggregates)
 
     def flush_db(self):
         self._indexer.flushdb()
-        obj_list = self._db.Bucket(self.bucket).objects.all()
-        for i in obj_list:
-            i.delete()
+        self.delete_keys(self.list_keys(''))
 
     def delete(self, doc_obj):
-        self._db.Object(self.bucket,doc_obj._id).delete()
-        pipe = self._indexer.pipeline()
-        pipe = self.remove_from_model_set(doc_obj, pipe)
-        doc_obj._index_change_list = doc_obj.get_indexes()
-        pipe = self.remove_indexes(doc_obj, pipe)
-        pipe.execute()
-
-    def all(self, doc_class, skip, limit):
-        id_list = [self.parse_id(id) for id in self._indexer.smembers(
-            '{0}:all'.format(
-            doc_class.get_class_name()))]
-        for id in id_list:
-            if skip and skip > 0:
-                skip -= 1
-                continue
-            if limit is not None and limit == 0:
-                break
-            elif limit:
-                limit -= 1
-            yield self.get(doc_class,id)
-
-    def evaluate(self, filters_list, sortingp_list, all_param, doc_class):
-        if all_param.all and len(sortingp_list) > 0:
-            docs_list = list(self.all(doc_class, skip=all_param.skip, limit=all_param.limit))
-            for doc in self.sort(sortingp_list, docs_list, doc_class):
-                yield doc
-        elif all_param.all:
-            for doc in self.all(doc_class, skip=all_param.skip, limit=all_param.limit):
-                yield doc
-        else:
-            id_list = self.get_id_list(filters_list)
-            if len(sortingp_list) > 0:
-                docs_list = [doc_class.get(self.parse_id(id)) for id in id_list]
-                sorted_list = self.sort(sortingp_list, docs_list, doc_class)
-                for doc in sorted_list:
-                    yield doc
-            else:
-                for id in id_list:
-                    yield doc_class.get(self.parse_id(id))
+        self.delete_many([doc_obj])
+
+    def delete_many(self, doc_list):
+        for chunk in chunks(doc_list, self.get_chunk_size()):
+            self.delete_keys([doc_obj._id for doc_obj in chunk])
+            pipe = self._indexer.pipeline(transaction=False)
+            for doc_obj in chunk:
+                pipe = self.delete_indexes(doc_obj, pipe)
+            pipe.execute()
+        return len(doc_list)
+
+    def load_values(self, doc_class, id_list, fields):
+        # The JSON objects are converted without building documents
+        load = self.get_value_loader(doc_class, fields)
+        raw_keys = self.get_raw_keys(fields)
+        keys = (doc_class.get_doc_id(self.parse_id(id)) for id in id_list)
+        for doc in self.map_concurrent(self.get_object, keys):
+            if doc is not None:
+                yield load([doc.get(key) for key in raw_keys])
+
+    def load_ids(self, doc_class, id_list, chunk_size=None, fields=None):
+        return self.get_many(doc_class, (self.parse_id(id) for id in id_list),
+                             batch_size=chunk_size)
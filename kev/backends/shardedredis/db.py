@@ -0,0 +1,466 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+
+import redis
+
+from kev.backends import DocDB
+from kev.backends.redis.db import RedisDB
+from kev.exceptions import DocNotFoundError, ResourceError
+from kev.query import AllParam
+from kev.utils import chunks
+
+
+class HashRing(object):
+    """
+    Consistent hash ring that places each node at replicas points, so
+    adding a node to N others only moves about 1/(N + 1) of the keys.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted((self.hash('{0}#{1}'.format(node, i)), node)
+                        for node in nodes for i in range(replicas))
+        self._points = [i[0] for i in points]
+        self._nodes = [i[1] for i in points]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self._points, self.hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class ShardPipeline(redis.client.Pipeline):
+    """
+    Pipeline that runs the functions added to callbacks once its commands
+    went through. They are dropped if it fails or is reset.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ShardPipeline, self).__init__(*args, **kwargs)
+        self.callbacks = []
+
+    def reset(self):
+        super(ShardPipeline, self).reset()
+        self.callbacks = []
+
+    def execute(self, raise_on_error=True):
+        callbacks = self.callbacks
+        result = super(ShardPipeline, self).execute(raise_on_error)
+        for func in callbacks:
+            func()
+        return result
+
+
+class ShardClient(redis.StrictRedis):
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardPipeline(self.connection_pool, self.response_callbacks,
+                             transaction, shard_hint)
+
+
+class RedisShard(RedisDB):
+    """
+    One node of a ShardedRedisDB. Its documents and their indexes are kept
+    as on a RedisDB, while unique values are reserved through the sharded
+    database, which places each reservation by its own key.
+    """
+
+    db_class = ShardClient
+
+    def __init__(self, router, name, **kwargs):
+        self.router = router
+        self.name = name
+        self._db = self._indexer = self.connect(self.db_class, **kwargs)
+        self._kwargs = router._kwargs
+
+    def get_unique_owner(self, doc_obj, key, value):
+        return self.router.get_unique_owner(doc_obj, key, value)
+
+    def reserve_unique(self, items):
+        return self.router.reserve_unique(items)
+
+    def release_unique(self, doc_obj, keys, pipeline=None):
+        if pipeline is None:
+            self.router.release_unique(doc_obj, keys)
+        elif keys:
+            # The keys can be on other nodes, so they are released once the
+            # writes of the pipeline went through
+            pipeline.callbacks.append(lambda: self.router.release_unique(doc_obj, keys))
+        return pipeline
+
+
+class ShardedRedisDB(DocDB):
+    """
+    Spreads one database over several Redis nodes. A document and its
+    index entries live on the node its id hashes to on a consistent hash
+    ring, and queries run on every node in parallel and merge the results.
+    """
+
+    shard_class = RedisShard
+    backend_id = 'redis'
+    # Saves write whole documents so a document is complete on its new node
+    # even when a rebalance moves it at the same time
+    partial_updates = False
+    # Points each node gets on the hash ring
+    ring_replicas = 100
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._shards = {}
+        for node in kwargs['nodes']:
+            node = dict(node)
+            # The ring places nodes by name, so a node keeps its keys as
+            # long as its name doesn't change
+            name = node.pop('name', None) or '{0}:{1}/{2}'.format(
+                node.get('host', 'localhost'), node.get('port', 6379), node.get('db', 0))
+            self._shards[name] = self.shard_class(self, name, **node)
+        self._ring = HashRing(list(self._shards),
+                              kwargs.get('ring_replicas', self.ring_replicas))
+
+    def get_shards(self):
+        return list(self._shards.values())
+
+    def get_shard(self, key):
+        """Returns the node that key hashes to."""
+        return self._shards[self._ring.get_node(key)]
+
+    def get_doc_shard(self, doc_id):
+        return self.get_shard(self.parse_id(doc_id))
+
+    def group_by_shard(self, items, get_shard):
+        """Returns (node, items) pairs for the nodes get_shard picks for items."""
+        groups = {}
+        for item in items:
+            groups.setdefault(get_shard(item), []).append(item)
+        return list(groups.items())
+
+    def scatter(self, func):
+        """Calls func with every node in parallel and returns the results."""
+        return list(self.map_concurrent(func, self.get_shards()))
+
+    def locate(self, doc_id):
+        """
+        Returns the node holding doc_id, which is the node it hashes to
+        unless a rebalance hasn't moved it there yet, or None.
+        """
+        owner = self.get_doc_shard(doc_id)
+        for shard in [owner] + [i for i in self.get_shards() if i is not owner]:
+            if shard._db.exists(doc_id):
+                return shard
+
+    def move_misplaced(self, doc_list):
+        """
+        Moves the documents of doc_list that a rebalance hasn't moved yet to
+        the node they hash to, so writing them there leaves no stale copy.
+        """
+        for shard, docs in self.group_by_shard(
+                doc_list, lambda doc_obj: self.get_doc_shard(doc_obj._id)):
+            # Documents are looked for on their own node first, which is
+            # the only request unless a rebalance is pending
+            for source in [shard] + [i for i in self.get_shards() if i is not shard]:
+                pipe = source._db.pipeline(transaction=False)
+                for doc_obj in docs:
+                    pipe.exists(doc_obj._id)
+                found = pipe.execute()
+                if source is not shard:
+                    for doc_obj in [i for i, exists in zip(docs, found) if exists]:
+                        self.move_doc(doc_obj.__class__, doc_obj._id, source)
+                docs = [i for i, exists in zip(docs, found) if not exists]
+                if not docs:
+                    break
+
+    # CRUD Operations
+    def save(self, doc_obj):
+        new = '_id' not in doc_obj._data
+        doc_obj, doc = self._save(doc_obj)
+        if not new:
+            self.move_misplaced([doc_obj])
+        reserved = self.reserve_doc(doc_obj, doc)
+        shard = self.get_doc_shard(doc_obj._id)
+        pipe = shard._db.pipeline()
+        pipe = shard.write_doc(doc_obj, doc, pipe)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            self.release_unique(doc_obj, reserved)
+            raise
+        doc_obj.clear_changes()
+        return doc_obj
+
+    def write_many(self, prepared):
+        self.move_misplaced([item[1] for item in prepared])
+        groups = self.group_by_shard(prepared, lambda item: self.get_doc_shard(item[1]._id))
+        for results in self.map_concurrent(
+                lambda group: list(group[0].write_many(group[1])), groups):
+            for result in results:
+                yield result
+
+    def delete(self, doc_obj):
+        self.delete_many([doc_obj])
+
+    def delete_many(self, doc_list):
+        def delete(group):
+            shard, docs = group
+            missing = []
+            for chunk in chunks(docs, self.get_chunk_size()):
+                pipe = shard._db.pipeline(transaction=False)
+                positions = []
+                for doc_obj in chunk:
+                    positions.append(len(pipe))
+                    pipe = shard.delete_doc(doc_obj, pipe)
+                replies = pipe.execute()
+                missing.extend(doc_obj for doc_obj, i in zip(chunk, positions)
+                               if not replies[i])
+            return missing
+
+        groups = self.group_by_shard(doc_list, lambda doc_obj: self.get_doc_shard(doc_obj._id))
+        for missing in self.map_concurrent(delete, groups):
+            for doc_obj in missing:
+                # The document is still on the node it was on before a rebalance
+                shard = self.locate(doc_obj._id)
+                if shard is not None:
+                    shard.delete(doc_obj)
+        return len(doc_list)
+
+    def get(self, doc_obj, doc_id, fields=None):
+        try:
+            return self.get_doc_shard(doc_id).get(doc_obj, doc_id, fields)
+        except DocNotFoundError:
+            shard = self.locate(doc_obj.get_doc_id(doc_id))
+            if shard is None:
+                raise
+            return shard.get(doc_obj, doc_id, fields)
+
+    def fetch_many(self, doc_class, doc_ids):
+        groups = self.group_by_shard(doc_ids, self.get_doc_shard)
+        docs = {}
+        for (shard, ids), found in zip(groups, self.map_concurrent(
+                lambda group: group[0].fetch_many(doc_class, group[1]), groups)):
+            docs.update(zip(ids, found))
+        results = []
+        for doc_id in doc_ids:
+            doc = docs.get(doc_id)
+            if doc is None:
+                shard = self.locate(doc_class.get_doc_id(doc_id))
+                if shard is not None:
+                    doc = shard.fetch_many(doc_class, [doc_id])[0]
+            results.append(doc)
+        return results
+
+    def incr(self, doc_obj, key, amount):
+        return self.on_doc_shard(doc_obj, lambda shard: shard.incr(doc_obj, key, amount))
+
+    def set_fields(self, doc_obj, fields):
+        return self.on_doc_shard(doc_obj, lambda shard: shard.set_fields(doc_obj, fields))
+
+    def on_doc_shard(self, doc_obj, func):
+        """
+        Calls func with the node of doc_obj, first moving the document there
+        if a rebalance hasn't yet.
+        """
+        try:
+            return func(self.get_doc_shard(doc_obj._id))
+        except DocNotFoundError:
+            if not self.move_doc(doc_obj.__class__, doc_obj._id):
+                raise
+            return func(self.get_doc_shard(doc_obj._id))
+
+    def flush_db(self):
+        self.scatter(lambda shard: shard.flush_db())
+
+    # Unique Reservations
+    def get_unique_owner(self, doc_obj, key, value):
+        shard = self.get_shard(doc_obj.get_unique_name(key, value))
+        return RedisDB.get_unique_owner(shard, doc_obj, key, value)
+
+    def reserve_unique(self, items):
+        # The reservations of a document can be on several nodes. Each node
+        # takes its part atomically, and the keys a document took are
+        # released again if another node holds one of its values.
+        unique_lists = [doc_obj.get_unique_values(doc) for doc_obj, doc in items]
+        groups = {}
+        for position, unique_list in enumerate(unique_lists):
+            for item in unique_list:
+                groups.setdefault(self.get_shard(item[2]), {}).setdefault(
+                    position, []).append(item)
+
+        def reserve(group):
+            shard, lists = group
+            return zip(lists, shard.reserve_unique_values(
+                [(items[position][0], unique_list)
+                 for position, unique_list in lists.items()]))
+
+        errors = [None] * len(items)
+        reserved = [[] for i in items]
+        for replies in self.map_concurrent(reserve, list(groups.items())):
+            for position, (error, keys) in replies:
+                errors[position] = errors[position] or error
+                reserved[position].extend(keys)
+        results = []
+        for (doc_obj, doc), error, keys in zip(items, errors, reserved):
+            if error is not None:
+                self.release_unique(doc_obj, keys)
+                keys = []
+            results.append((error, keys))
+        return results
+
+    def release_unique(self, doc_obj, keys, pipeline=None):
+        for shard, shard_keys in self.group_by_shard(keys, self.get_shard):
+            RedisDB.release_unique(shard, doc_obj, shard_keys)
+        return pipeline
+
+    # Querying Methods
+    def get_id_list(self, filters_list, doc_class):
+        return set().union(*self.scatter(
+            lambda shard: shard.get_id_list(filters_list, doc_class)))
+
+    def count(self, filters_list, all_param, doc_class):
+        unwindowed = AllParam(all=all_param.all)
+        total = sum(self.scatter(
+            lambda shard: shard.count(filters_list, unwindowed, doc_class)))
+        return self.window_count(total, all_param)
+
+    def all(self, doc_class, skip, limit, fields=None):
+        return self.evaluate(None, [], AllParam(all=True, skip=skip, limit=limit),
+                             doc_class, fields=fields)
+
+    def iterate(self, filters_list, sortingp_list, all_param, doc_class,
+                chunk_size=None, fields=None):
+        if sortingp_list or all_param.skip or all_param.limit is not None:
+            return self.evaluate(filters_list, sortingp_list, all_param, doc_class,
+                                 fields=fields)
+        # Without an order the nodes are streamed one after the other
+        return itertools.chain.from_iterable(
+            shard.iterate(filters_list, [], all_param, doc_class, chunk_size, fields)
+            for shard in self.get_shards())
+
+    def evaluate(self, filters_list, sortingp_list, all_param, doc_class,
+                 fields=None):
+        # Every node returns the first skip + limit documents in order and
+        # the pages are merged here
+        limit = None
+        if all_param.limit is not None:
+            limit = (all_param.skip or 0) + all_param.limit
+        window = AllParam(all=all_param.all, limit=limit)
+        if sortingp_list:
+            sort_fields = fields
+            if fields is not None:
+                sort_fields = list(fields) + [i.key for i in sortingp_list
+                                              if i.key not in fields]
+            pages = self.scatter(lambda shard: list(shard.evaluate(
+                filters_list, sortingp_list, window, doc_class, fields=sort_fields)))
+            return iter(self.sort(sortingp_list, itertools.chain.from_iterable(pages),
+                                  doc_class, all_param.skip, all_param.limit))
+        if limit is not None:
+            pages = self.scatter(lambda shard: list(shard.evaluate(
+                filters_list, [], window, doc_class, fields=fields)))
+        else:
+            pages = [shard.evaluate(filters_list, [], window, doc_class, fields=fields)
+                     for shard in self.get_shards()]
+        # Unsorted results come back ordered by id from every node
+        return self.paginate(heapq.merge(*pages, key=lambda doc: doc._id),
+                             all_param.skip, all_param.limit)
+
+    def facets(self, filters_list, doc_class, props):
+        facets = {prop: {} for prop in props}
+        for shard_facets in self.scatter(
+                lambda shard: shard.facets(filters_list, doc_class, props)):
+            for prop, counts in shard_facets.items():
+                for value, count in counts.items():
+                    facets[prop][value] = facets[prop].get(value, 0) + count
+        return facets
+
+    def aggregate(self, filters_list, doc_class, aggregates):
+        doc_count = 0
+        stats = {}
+        for shard_count, shard_stats in self.scatter(
+                lambda shard: shard.aggregate(filters_list, doc_class, aggregates)):
+            doc_count += shard_count
+            for field, (count, total, min_value, max_value) in shard_stats.items():
+                if field not in stats:
+                    stats[field] = (count, total, min_value, max_value)
+                    continue
+                merged = stats[field]
+                values = [i for i in (merged[2], min_value) if i is not None]
+                min_value = min(values) if values else None
+                values = [i for i in (merged[3], max_value) if i is not None]
+                max_value = max(values) if values else None
+                # Fields read from a sorted index have no count or sum
+                stats[field] = (None if count is None else merged[0] + count,
+                                None if total is None else merged[1] + total,
+                                min_value, max_value)
+        return doc_count, stats
+
+    def add_compound_indexes(self, doc_list):
+        for shard, docs in self.group_by_shard(
+                doc_list, lambda doc_obj: self.get_doc_shard(doc_obj._id)):
+            shard.add_compound_indexes(docs)
+
+    # Rebalancing
+    def move_doc(self, doc_class, doc_id, source=None):
+        """
+        Moves a document from source, or from the node holding it, to the
+        node it hashes to. Returns whether it was moved.
+        """
+        target = self.get_doc_shard(doc_id)
+        source = source or self.locate(doc_id)
+        if source is None or source is target:
+            return False
+        raw_doc = source._db.hgetall(doc_id)
+        if not raw_doc:
+            return False
+        doc_obj = source.load_doc(doc_class, raw_doc)
+        # A save since the node was added has already written the current
+        # version of the document to its new node
+        if not target._db.exists(doc_id):
+            pipe = target._db.pipeline()
+            pipe = target.write_doc(doc_obj, self.prep_doc(doc_obj), pipe)
+            pipe.execute()
+        pipe = source._db.pipeline()
+        pipe.delete(doc_id)
+        pipe = source.unindex_doc(doc_obj, pipe)
+        pipe.execute()
+        return True
+
+    def rebalance(self, doc_class, chunk_size=None):
+        """
+        Moves the documents of doc_class, and the reservations of their
+        unique values, that are not on the node they hash to, like the
+        share of keys a new node takes over. The database stays usable in
+        the meantime: reads by id fall back to the other nodes and a
+        document that is written to is moved first. Returns the number of
+        documents moved. Raises ResourceError, once everything else has
+        moved, if a value is reserved for different documents on its old
+        and new node; the old reservation is kept so it can be resolved.
+        """
+        chunk_size = chunk_size or self.get_chunk_size()
+        unique_pattern = '{0}:unique:*'.format(doc_class.get_key_prefix())
+        moved = 0
+        conflicts = []
+        for source in self.get_shards():
+            # Reservations go first so values stay taken while documents move
+            for key in source._indexer.scan_iter(unique_pattern, count=chunk_size):
+                target = self.get_shard(key.decode())
+                if target is source:
+                    continue
+                owner = source._indexer.get(key)
+                if owner is not None and not target._indexer.set(key, owner, nx=True):
+                    held = target._indexer.get(key)
+                    if held is not None and held != owner:
+                        conflicts.append('{0} ({1}, {2})'.format(
+                            key.decode(), owner.decode(), held.decode()))
+                        continue
+                source._indexer.delete(key)
+            for doc_id in source._indexer.sscan_iter(
+                    source.get_model_set_name(doc_class), count=chunk_size):
+                doc_id = doc_id.decode()
+                if self.get_doc_shard(doc_id) is not source:
+                    moved += self.move_doc(doc_class, doc_id, source)
+        if conflicts:
+            raise ResourceError('Unique values reserved for two documents: {0}'.format(
+                ', '.join(conflicts)))
+        return moved
@@ -7,8 +7,9 @@ from valley.declarative import DeclaredVars as DV, \
 from valley.exceptions import ValidationException
 from valley.schema import BaseSchema
 
-from .properties import BaseProperty
+from .properties import BaseProperty, FloatProperty, IntegerProperty
 from .query import QueryManager
+from .utils import encode_score
 
 try:
     import brotli
@@ -17,6 +18,53 @@ except ImportError:
     BROTLI_ENABLED = False
 
 
+class CompoundIndex(object):
+    """
+    Index on a combination of properties, declared in Meta.compound_indexes
+    as a tuple of property names or as a dict with the 'fields' tuple and a
+    'where' dict of property values. With 'where' only the documents having
+    those values are indexed (a partial index).
+    """
+
+    def __init__(self, fields, where=None):
+        self.fields = tuple(fields)
+        self.where = dict(where or {})
+        self.props = frozenset(self.fields) | frozenset(self.where)
+        self.name = '+'.join(i.lower() for i in self.fields)
+        if self.where:
+            self.name += '@' + '+'.join('{0}={1}'.format(k.lower(), v) for k, v
+                                        in sorted(self.where.items()))
+
+    @classmethod
+    def from_meta(cls, index):
+        if isinstance(index, dict):
+            return cls(index['fields'], index.get('where'))
+        return cls(index)
+
+    def __repr__(self):
+        return "%s(fields=%s, where=%s)" % (self.__class__, self.fields, self.where)
+
+    def get_value(self, doc_class, key, value):
+        # Stored and queried values are compared the way they are written
+        prop = doc_class._base_properties[key]
+        value = prop.get_db_value(prop.get_python_value(value))
+        return value.lower() if isinstance(value, str) else value
+
+    def get_values(self, doc_class, data):
+        """
+        Returns the indexed values of data in the order of fields, or None
+        when data has no value for one of them or doesn't match where.
+        """
+        for key, value in self.where.items():
+            if self.get_value(doc_class, key, data.get(key)) != \
+                    self.get_value(doc_class, key, value):
+                return None
+        values = [self.get_value(doc_class, key, data.get(key)) for key in self.fields]
+        if any(value is None for value in values):
+            return None
+        return values
+
+
 class DeclaredVars(DV):
     base_field_class = BaseProperty
     base_field_type = '_base_properties'
@@ -25,22 +73,56 @@ class DeclaredVars(DV):
 class DeclarativeVariablesMetaclass(DVM):
     declared_vars_class = DeclaredVars
 
+    def __new__(cls, name, bases, attrs):
+        new_class = super(DeclarativeVariablesMetaclass, cls).__new__(
+            cls, name, bases, attrs)
+        # Property lookups done on every attribute access and save are
+        # worked out once per class.
+        props = new_class._base_properties
+        new_class._property_names = frozenset(props)
+        new_class._indexed_props = tuple(k for k, p in props.items() if p.index)
+        new_class._unique_props = tuple(k for k, p in props.items() if p.unique)
+        new_class._sortable_props = tuple(k for k, p in props.items() if p.sortable)
+        new_class._auto_now_props = frozenset(
+            k for k, p in props.items() if getattr(p, 'auto_now', False))
+        meta = getattr(new_class, 'Meta', None)
+        new_class._compound_indexes = tuple(
+            CompoundIndex.from_meta(i) for i in getattr(meta, 'compound_indexes', ()))
+        new_class._compound_props = frozenset().union(
+            *[i.props for i in new_class._compound_indexes])
+        return new_class
+
 
 class BaseDocument(BaseSchema):
     """
     Base class for all Kev Documents classes.
     """
     BUILTIN_DOC_ATTRS = ('_id', '_doc_type')
+    _property_names = frozenset()
+    _indexed_props = ()
+    _unique_props = ()
+    _sortable_props = ()
+    _auto_now_props = frozenset()
+    _compound_indexes = ()
+    _compound_props = frozenset()
 
     def __init__(self, **kwargs):
-        self._data = self.process_schema_kwargs(kwargs)
-        self._db = self.get_db()
+        # None of these are properties, so they skip __setattr__
+        set_attr = object.__setattr__
+        set_attr(self, '_data', self.process_schema_kwargs(kwargs))
+        set_attr(self, '_db', self.get_db())
         self._create_error_dict = kwargs.get('create_error_dict') or self._create_error_dict
         if self._create_error_dict:
-            self._errors = {}
+            set_attr(self, '_errors', {})
+        set_attr(self, '_index_change_list', [])
+        set_attr(self, '_sort_change_list', [])
+        set_attr(self, '_unique_change_list', [])
+        set_attr(self, '_deferred', set())
+        # None until the document is loaded or saved, then the names of the
+        # properties changed since
+        set_attr(self, '_changed_fields', None)
         if '_id' in self._data:
             self.set_pk(self._data['_id'])
-        self._index_change_list = []
 
     def _s3(self):
         return boto3.resource('s3', **self.get_restore_kwargs())
@@ -50,15 +132,68 @@ class BaseDocument(BaseSchema):
             class_name=self.__class__.__name__, uni=self.__unicode__(),
             id=self.pk)
 
+    def __getattr__(self, name):
+        if name in self._property_names:
+            if name in self.__dict__.get('_deferred', ()):
+                self.load_deferred()
+            return self._base_properties[name].get_python_value(self._data.get(name))
+        return super(BaseDocument, self).__getattr__(name)
+
     def __setattr__(self, name, value):
-        if name in list(self._base_properties.keys()):
-            if name in self.get_indexed_props() and value \
-                    != self._data.get(name) and self._data.get(name) is not None:
-                self._index_change_list.append(
-                    self.get_index_name(name, self._data[name]))
+        if name in self._property_names:
+            if name in self._deferred or (
+                    self._deferred and name in self._compound_props):
+                self.load_deferred()
+            old_value = self._data.get(name)
+            if value != old_value:
+                if self._changed_fields is not None:
+                    self._changed_fields.add(name)
+                if name in self._compound_props:
+                    self._index_change_list.extend(self.get_compound_indexes([name]))
+                if old_value is not None and name in self._indexed_props:
+                    self._index_change_list.append(
+                        self.get_index_name(name, old_value))
+                if name in self._sortable_props:
+                    self._sort_change_list.append(
+                        self.get_range_index_name(name, old_value))
+                if old_value is not None and name in self._unique_props:
+                    self._unique_change_list.append(
+                        self.get_unique_name(name, old_value))
             self._data[name] = value
         else:
-            super(BaseDocument, self).__setattr__(name, value)
+            object.__setattr__(self, name, value)
+
+    def clear_changes(self):
+        self._index_change_list = []
+        self._sort_change_list = []
+        self._unique_change_list = []
+        self._changed_fields = set()
+
+    def get_changed_fields(self):
+        """
+        Returns the properties to write on the next save, or None when the
+        whole document has to be written. auto_now properties change on
+        every save.
+        """
+        if self._changed_fields is None:
+            return None
+        return self._changed_fields | self._auto_now_props
+
+    def set_deferred(self, fields):
+        """
+        Marks fields as not loaded by a projection. They are fetched from
+        the database the first time one of them is used.
+        """
+        self._deferred = set(fields)
+        for name in self._deferred:
+            self._data.pop(name, None)
+
+    def load_deferred(self):
+        if self._deferred:
+            doc = self._db.get(self.__class__, self.pk)
+            for name in self._deferred:
+                self._data[name] = doc._data.get(name)
+            self._deferred = set()
 
     def set_pk(self, pk):
         self._data['_id'] = pk
@@ -67,17 +202,22 @@ class BaseDocument(BaseSchema):
         self.pk = self.id
 
     def get_indexed_props(self):
-        index_list = []
-        for key, prop in list(self._base_properties.items()):
-            if prop.index:
-                index_list.append(key)
-        return index_list
+        return list(self._indexed_props)
 
     def get_unique_props(self):
+        return list(self._unique_props)
+
+    def get_unique_values(self, doc=None):
+        """
+        Returns (prop, value, reservation key) tuples for the unique
+        properties that have a value, read from doc or the document data.
+        """
+        doc = self._data if doc is None else doc
         unique_list = []
-        for key, prop in list(self._base_properties.items()):
-            if prop.unique:
-                unique_list.append(key)
+        for key in self.get_unique_props():
+            value = doc.get(key)
+            if self._base_properties[key].get_python_value(value) is not None:
+                unique_list.append((key, value, self.get_unique_name(key, value)))
         return unique_list
 
     def check_unique(self):
@@ -98,12 +238,47 @@ class BaseDocument(BaseSchema):
                 index_list.append(self.get_index_name(i, self._data[i]))
             except KeyError:
                 pass
+        return index_list + self.get_compound_indexes()
+
+    @classmethod
+    def get_compound_props(cls, fields):
+        """Returns the properties of the compound indexes on any of fields."""
+        return frozenset().union(*[index.props for index in cls._compound_indexes
+                                   if not index.props.isdisjoint(fields)])
+
+    def get_compound_indexes(self, props=None):
+        """
+        Returns the compound index names of the document, only those of the
+        indexes on one of props if it is given.
+        """
+        index_list = []
+        for index in self._compound_indexes:
+            if props is not None and index.props.isdisjoint(props):
+                continue
+            values = index.get_values(self.__class__, self._data)
+            if values is not None:
+                index_list.append(self.get_compound_index_name(index, values))
         return index_list
 
+    def get_range_indexes(self):
+        return [self.get_range_index_name(i, self._data.get(i))
+                for i in self.get_sortable_props()]
+
     @classmethod
     def get_db(cls):
         raise NotImplementedError
 
+    @classmethod
+    def get_key_prefix(cls):
+        """Returns the '{backend}:{class}' prefix of the index keys."""
+        db = cls.get_db()
+        cached = cls.__dict__.get('_key_prefix')
+        if cached is None or cached[0] is not db:
+            cached = (db, '{0}:{1}'.format(db.backend_id.lower(), db.get_key_class_name(
+                cls.get_class_name().lower())))
+            cls._key_prefix = cached
+        return cached[1]
+
     def get_restore_kwargs(self):
         raise NotImplementedError
 
@@ -113,26 +288,86 @@ class BaseDocument(BaseSchema):
 
     @classmethod
     def get_doc_id(cls,id):
-        return cls.get_db().doc_id_string.format(
-            doc_id=id,backend_id=cls.get_db().backend_id,class_name=cls.get_class_name())
+        db = cls.get_db()
+        return db.doc_id_string.format(
+            doc_id=id,backend_id=db.backend_id,
+            class_name=db.get_key_class_name(cls.get_class_name()))
 
     @classmethod
     def get_index_name(cls, prop, index_value):
-        if cls.get_db().backend_id != 'dynamodb' and cls.get_db().backend_id != 'cloudant':
-            if isinstance(index_value,str):
-                index_value = index_value.lower()
-        return '{0}:{1}:indexes:{2}:{3}'.format(
-            cls.get_db().backend_id.lower(),
-            cls.get_class_name().lower(),
+        if isinstance(index_value, str) and \
+                cls.get_db().backend_id not in ('dynamodb', 'cloudant'):
+            index_value = index_value.lower()
+        return '{0}:indexes:{1}:{2}'.format(
+            cls.get_key_prefix(),
             prop.lower(),
             index_value)
 
+    @classmethod
+    def get_compound_index_name(cls, index, values):
+        # JSON keeps values that contain the separators apart
+        return '{0}:indexes:{1}:{2}'.format(
+            cls.get_key_prefix(), index.name,
+            json.dumps([str(i) for i in values], separators=(',', ':')))
+
+    @classmethod
+    def get_unique_name(cls, prop, value):
+        """Key that reserves value for the unique property prop."""
+        value = cls._base_properties[prop].get_python_value(value)
+        if isinstance(value, str):
+            value = value.lower()
+        return '{0}:unique:{1}:{2}'.format(
+            cls.get_key_prefix(),
+            prop.lower(),
+            value)
+
+    @classmethod
+    def get_sort_index_name(cls, prop):
+        return '{0}:sorted:{1}'.format(
+            cls.get_key_prefix(),
+            prop.lower())
+
+    @classmethod
+    def get_range_index_name(cls, prop, value):
+        """
+        Key prefix of a value in a sorted index for backends that keep it as
+        lexicographically ordered keys instead of a sorted set.
+        """
+        return '{0}:{1}'.format(
+            cls.get_sort_index_name(prop),
+            encode_score(cls._base_properties[prop].get_score(value)))
+
+    @classmethod
+    def get_sortable_props(cls):
+        return list(cls._sortable_props)
+
+    @classmethod
+    def check_fields(cls, fields):
+        for key in fields:
+            if key not in cls._base_properties:
+                raise ValueError("Field '%s' doesn't exists in a document" % key)
+
     # Basic Operations
 
     @classmethod
-    def get(cls, doc_id):
+    def get(cls, doc_id, fields=None):
+        if fields is not None:
+            cls.check_fields(fields)
+            return cls.get_db().get(cls, doc_id, fields=fields)
         return cls.get_db().get(cls, doc_id)
 
+    @classmethod
+    def get_many(cls, doc_ids, missing='skip', batch_size=None):
+        if missing not in ('skip', 'none', 'raise'):
+            raise ValueError("missing should be one of 'skip', 'none' or 'raise'")
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size should be a positive integer")
+        return cls.get_db().get_many(cls, doc_ids, missing, batch_size)
+
+    @classmethod
+    def save_many(cls, doc_list):
+        return cls.get_db().save_many(doc_list)
+
     @classmethod
     def all(cls, skip=None, limit=None):
         if skip and skip < 0:
@@ -141,10 +376,47 @@ class BaseDocument(BaseSchema):
             raise AttributeError("limit value should be an positive integer, valid range 1-inf")
         return cls.get_db().all(cls, skip, limit)
 
+    def incr(self, key, amount=1):
+        """
+        Adds amount to the stored value of a numeric property without
+        saving the rest of the document and returns the new value. Atomic
+        on Redis; see DocDB.incr for the other backends.
+        """
+        prop = self._base_properties.get(key)
+        if not isinstance(prop, (IntegerProperty, FloatProperty)):
+            raise ValueError("'%s' is not an integer or float property" % key)
+        if prop.unique:
+            raise ValueError("incr doesn't support unique properties")
+        if isinstance(prop, IntegerProperty) and not isinstance(amount, int):
+            raise ValueError("Integer properties can only be incremented by integers")
+        value = self._db.incr(self, key, amount)
+        self.set_saved(key, value)
+        return value
+
+    def decr(self, key, amount=1):
+        return self.incr(key, -amount)
+
+    def set_fields(self, **fields):
+        """
+        Writes only the given properties, and their index changes, to the
+        stored document. Atomic on Redis; see DocDB.set_fields for the other
+        backends.
+        """
+        self.check_fields(fields)
+        for key, value in self._db.set_fields(self, fields).items():
+            self.set_saved(key, value)
+
+    def set_saved(self, key, value):
+        # The value is already stored, so it isn't a change to save
+        self._data[key] = value
+        if self._changed_fields is not None:
+            self._changed_fields.discard(key)
+
     def flush_db(self):
         self._db.flush_db()
 
     def delete(self):
+        self.load_deferred()
         self._db.delete(self)
 
     def save(self):
@@ -216,7 +488,15 @@ class Document(BaseDocument,metaclass=DeclarativeVariablesMetaclass):
 
     @classmethod
     def get_db(cls):
-        return cls.Meta.handler.get_db(cls.Meta.use_db)
+        # The backend is looked up once per class and handler
+        meta = cls.Meta
+        cached = cls.__dict__.get('_resolved_db')
+        if cached is None or cached[0] is not meta.handler \
+                or cached[1] != meta.use_db:
+            cached = (meta.handler, meta.use_db,
+                      meta.handler.get_db(meta.use_db))
+            cls._resolved_db = cached
+        return cached[2]
 
     def get_restore_kwargs(self):
         return self.get_db()._kwargs.get('restore')
@@ -2,14 +2,19 @@
 Redis document property classes. Much of the date and time property
 code was borrowed or inspired by Benoit Chesneau's CouchDBKit library.
 """
+import calendar
+import datetime
 
 from valley.mixins import CharVariableMixin, IntegerVariableMixin, \
     FloatVariableMixin, SlugVariableMixin, \
     EmailVariableMixin, BooleanMixin, DateMixin, DateTimeMixin
 from valley.properties import BaseProperty as VBaseProperty
+from valley.validators import MaxValueValidator, MinValueValidator
 
 
 class BaseProperty(VBaseProperty):
+    # Set on properties whose values can be turned into a numeric score
+    scored = False
 
     def __init__(
         self,
@@ -17,6 +22,7 @@ class BaseProperty(VBaseProperty):
         required=False,
         index=False,
         unique=False,
+        sortable=False,
         validators=[],
         verbose_name=None,
         **kwargs
@@ -30,6 +36,45 @@ class BaseProperty(VBaseProperty):
         self.unique = unique
         if unique:
             self.index = True
+        if sortable and not self.scored:
+            raise ValueError('{0} does not support sortable=True'.format(
+                self.__class__.__name__))
+        # Only opted in properties keep a sorted index, which sorting and
+        # range lookups read
+        self.sortable = sortable
+
+    def get_score(self, value):
+        raise NotImplementedError
+
+    def get_value_bounds(self):
+        """
+        Returns the (min_value, max_value) checked by the validators, with
+        None for a missing bound.
+        """
+        min_value = max_value = None
+        for validator in self.validators:
+            if isinstance(validator, MinValueValidator):
+                min_value = validator.compare_value
+            elif isinstance(validator, MaxValueValidator):
+                max_value = validator.compare_value
+        return min_value, max_value
+
+
+class ScoreMixin(object):
+    """
+    Maps property values to the float scores used by sorted indexes.
+    Documents without a value sort first.
+    """
+    scored = True
+
+    def get_score(self, value):
+        value = self.get_python_value(value)
+        if value is None:
+            return float('-inf')
+        return self.to_score(value)
+
+    def to_score(self, value):
+        return float(value)
 
 
 class CharProperty(CharVariableMixin,BaseProperty):
@@ -44,11 +89,11 @@ class EmailProperty(EmailVariableMixin,BaseProperty):
     pass
 
 
-class IntegerProperty(IntegerVariableMixin, BaseProperty):
+class IntegerProperty(ScoreMixin, IntegerVariableMixin, BaseProperty):
     pass
 
 
-class FloatProperty(FloatVariableMixin, BaseProperty):
+class FloatProperty(ScoreMixin, FloatVariableMixin, BaseProperty):
     pass
 
 
@@ -58,7 +103,7 @@ class BooleanProperty(BooleanMixin, BaseProperty):
         return int(value)
 
 
-class DateProperty(DateMixin, BaseProperty):
+class DateProperty(ScoreMixin, DateMixin, BaseProperty):
 
     def __init__(
             self,
@@ -81,8 +126,11 @@ class DateProperty(DateMixin, BaseProperty):
         self.auto_now = auto_now
         self.auto_now_add = auto_now_add
 
+    def to_score(self, value):
+        return float(value.toordinal())
 
-class DateTimeProperty(DateTimeMixin, BaseProperty):
+
+class DateTimeProperty(ScoreMixin, DateTimeMixin, BaseProperty):
 
     def __init__(
             self,
@@ -104,3 +152,9 @@ class DateTimeProperty(DateTimeMixin, BaseProperty):
             **kwargs)
         self.auto_now = auto_now
         self.auto_now_add = auto_now_add
+
+    def to_score(self, value):
+        if isinstance(value, datetime.date) and \
+                not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
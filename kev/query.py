@@ -1,4 +1,6 @@
 from .exceptions import QueryError
+from .properties import FloatProperty, IntegerProperty
+from .utils import chunks
 
 REPR_OUTPUT_SIZE = 20
 
@@ -37,10 +39,13 @@ class QuerySetMixin(object):
         self.parent_q = parent_q
         self._result_cache = None
         self._doc_class = doc_class
-        self.q = q
+        self.q = Q.to_dict(q)
         self.sortingp_list = [sorting_p] if sorting_p is not None else []
         self.evaluated = False
         self.all_param = all_param if all_param else AllParam()
+        self.fields = None
+        self.values_fields = None
+        self.values_type = None
         self._db = self._doc_class.get_db()
         if q and parent_q:
             self.q = self.combine_qs()
@@ -51,20 +56,17 @@ class QuerySetMixin(object):
         return combine_dicts(self.parent_q, self.q)
 
     def prepare_filters(self):
-        filter_list = []
-        for k, v in list(self.q.items()):
-            if isinstance(v, list):
-                for index_v in v:
-                    filter_list.append(
-                        self._doc_class.get_index_name(
-                            k, index_v))
+        filter_list, q = route_compound_indexes(self._doc_class, self.q)
+        for k, v in list(q.items()):
+            if k == Q.filter_key:
+                for q in (v if isinstance(v, list) else [v]):
+                    filter_list.append(q.compile(self._doc_class))
             else:
-                filter_list.append(self._doc_class.get_index_name(k, v))
+                filter_list.extend(make_filters(self._doc_class, k, v))
         return filter_list
 
     def __len__(self):
-        self._fetch_all()
-        return len(self._result_cache)
+        return self.count()
 
     def __repr__(self):  # pragma: no cover
         data = list(self[:REPR_OUTPUT_SIZE + 1])
@@ -81,41 +83,214 @@ class QuerySetMixin(object):
             self._result_cache = list(self.evaluate())
 
     def count(self):
-        return len(list(self.evaluate()))
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return self.evaluate_count()
+
+    def iterator(self, chunk_size=None):
+        """
+        Streams the documents chunk_size at a time without caching them on
+        the QuerySet, so memory stays bounded on large scans.
+        """
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("chunk_size should be a positive integer")
+        return self.evaluate_iterator(chunk_size)
+
+    def delete(self):
+        """
+        Deletes the matching documents a chunk at a time and returns how
+        many were deleted.
+        """
+        qs = self._clone(self.all_param)
+        qs.fields = qs.values_fields = qs.values_type = None
+        count = 0
+        for chunk in chunks(qs.iterator(), self._db.get_chunk_size()):
+            count += self._db.delete_many(chunk)
+        self._result_cache = None
+        return count
+
+    def facets(self, *props):
+        """
+        Returns {prop: {value: count}} with the number of documents matching
+        the filters for each value of the indexed properties props. Values
+        are read from the indexes, so strings are lowercase, and slicing is
+        ignored.
+        """
+        self._doc_class.check_fields(props)
+        for prop in props:
+            if not self._doc_class._base_properties[prop].index:
+                raise QueryError("Facets need indexed properties, '{0}' isn't one".format(
+                    prop))
+        return self.evaluate_facets(props)
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Returns a dict with the value of each aggregate over the documents
+        matching the filters. Positional aggregates are named
+        '<field>__<aggregate>', like 'gpa__avg'. Slicing is ignored.
+
+        >>> TestDocument.objects().filter({'state': 'NC'}).aggregate(Avg('gpa'), total=Count())
+        {'gpa__avg': 3.1, 'total': 2}
+        """
+        aggregates = dict(kwargs)
+        for aggregate in args:
+            aggregates[aggregate.get_alias()] = aggregate
+        for aggregate in aggregates.values():
+            aggregate.check(self._doc_class)
+        doc_count, stats = self.evaluate_aggregate(list(aggregates.values()))
+        return {alias: aggregate.resolve(doc_count, stats.get(aggregate.field))
+                for alias, aggregate in aggregates.items()}
+
+    def update(self, **fields):
+        """
+        Sets fields on the matching documents and saves them a chunk at a
+        time. Returns how many documents were updated. Raises the first
+        error a save runs into; earlier chunks stay updated.
+        """
+        self._doc_class.check_fields(fields)
+        for key, value in fields.items():
+            self._doc_class._base_properties[key].validate(value, key)
+        qs = self._clone(self.all_param)
+        qs.values_fields = qs.values_type = None
+        # Only the written fields are loaded where the backend allows it
+        qs.fields = list(set(fields) | self._doc_class._auto_now_props |
+                         self._doc_class.get_compound_props(fields))
+        count = 0
+        for chunk in chunks(qs.iterator(), self._db.get_chunk_size()):
+            for doc in chunk:
+                for key, value in fields.items():
+                    setattr(doc, key, value)
+            result = self._db.save_many(chunk)
+            if result.errors:
+                raise list(result.errors.values())[0]
+            count += len(result.saved)
+        self._result_cache = None
+        return count
+
+    def exists(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self[:1].count() > 0
+
+    def first(self):
+        if self._result_cache is not None:
+            return self._result_cache[0] if self._result_cache else None
+        docs = list(self[:1])
+        return docs[0] if docs else None
 
     def __bool__(self):
-        self._fetch_all()
-        return bool(self._result_cache)
+        return self.exists()
 
     def __getitem__(self, index):
+        if self._result_cache is None and isinstance(index, slice) \
+                and index.step is None and (index.start or 0) >= 0 \
+                and (index.stop is None or index.stop >= 0):
+            # Slicing an unevaluated QuerySet narrows its window so the
+            # backend only fetches the documents of the requested page.
+            return self._clone(all_param=self.all_param.narrow(
+                index.start, index.stop))
+        if self._result_cache is None and isinstance(index, int):
+            # A single document is fetched as a one item window
+            if index < 0:
+                index += self.count()
+            docs = list(self[index:index + 1]) if index >= 0 else []
+            if not docs:
+                raise IndexError('QuerySet index out of range')
+            return docs[0]
         if self._result_cache is not None:
             return self._result_cache[index]
         else:
             self._fetch_all()
             return self._result_cache[index]
 
+    def _clone(self, all_param):
+        qs = self.__class__(self._doc_class, self.q, all_param=all_param)
+        qs.sortingp_list = list(self.sortingp_list)
+        return self._copy_options(qs)
+
+    def _copy_options(self, qs):
+        qs.fields = self.fields
+        qs.values_fields = self.values_fields
+        qs.values_type = self.values_type
+        return qs
+
+    def only(self, *fields):
+        """
+        Loads only the given fields. The other fields of the documents are
+        fetched one document at a time when they are first used.
+        """
+        self._doc_class.check_fields(fields)
+        qs = self._clone(self.all_param)
+        qs.fields = list(fields)
+        return qs
+
+    def values(self, *fields):
+        """
+        Returns dicts of the Python values of fields, all of them by default,
+        read straight from the backend without building documents.
+        """
+        return self._values_clone(fields, dict)
+
+    def values_list(self, *fields, flat=False):
+        """
+        Like values() but returns tuples, or single values if flat is True.
+        """
+        if flat and len(fields) != 1:
+            raise ValueError("values_list with flat=True takes exactly one field")
+        return self._values_clone(fields, 'flat' if flat else tuple)
+
+    def _values_clone(self, fields, values_type):
+        fields = list(fields) or ['id'] + list(self._doc_class._base_properties)
+        self._doc_class.check_fields([key for key in fields if key != 'id'])
+        qs = self._clone(self.all_param)
+        qs.values_fields = fields
+        qs.values_type = values_type
+        return qs
+
+    def make_row(self, values):
+        if self.values_type is dict:
+            return dict(zip(self.values_fields, values))
+        if self.values_type is tuple:
+            return tuple(values)
+        return values[0]
+
     def evaluate(self):
         raise NotImplementedError
 
+    def evaluate_count(self):
+        raise NotImplementedError
+
+    def evaluate_iterator(self, chunk_size):
+        raise NotImplementedError
+
+    def evaluate_facets(self, props):
+        raise NotImplementedError
+
+    def evaluate_aggregate(self, aggregates):
+        raise NotImplementedError
+
 
 class QuerySet(QuerySetMixin):
 
     def filter(self, q):
-        return QuerySet(self._doc_class, q, self.q)
+        return self._copy_options(QuerySet(self._doc_class, q, self.q))
 
     def sort_by(self, key, reverse=False):
+        self._doc_class.check_fields([key])
         sorting_p = SortingParam(key, reverse)
-        return QuerySet(self._doc_class, self.q, None, sorting_p, self.sortingp_list, all_param=self.all_param)
+        return self._copy_options(QuerySet(self._doc_class, self.q, None, sorting_p,
+                                           self.sortingp_list, all_param=self.all_param))
 
     def get(self, q):
-        qs = QuerySet(self._doc_class, q, self.q)
-        if len(qs) > 1:
+        qs = self._copy_options(QuerySet(self._doc_class, q, self.q))
+        docs = list(qs[:2])
+        if len(docs) > 1:
             raise QueryError(
                 'This query should return exactly one result. Your query returned {0}'.format(
-                    len(qs)))
-        if len(qs) == 0:
+                    qs.count()))
+        if len(docs) == 0:
             raise QueryError('This query did not return a result.')
-        return qs[0]
+        return docs[0]
 
     def all(self, skip=None, limit=None):
         all_param = AllParam(all=True, skip=skip, limit=limit)
@@ -125,8 +300,44 @@ class QuerySet(QuerySetMixin):
         filters_list = None
         if not self.all_param.all:
             filters_list = self.prepare_filters()
+        if self.values_fields is not None:
+            return (self.make_row(values) for values in
+                    self._doc_class.get_db().evaluate_values(
+                        filters_list, self.sortingp_list, self.all_param,
+                        self._doc_class, self.values_fields))
         return self._doc_class.get_db().evaluate(filters_list, self.sortingp_list,
-                                                 self.all_param, self._doc_class)
+                                                 self.all_param, self._doc_class,
+                                                 fields=self.fields)
+
+    def evaluate_count(self):
+        filters_list = None
+        if not self.all_param.all:
+            filters_list = self.prepare_filters()
+        return self._doc_class.get_db().count(filters_list, self.all_param,
+                                              self._doc_class)
+
+    def evaluate_iterator(self, chunk_size):
+        if self.values_fields is not None:
+            return self.evaluate()
+        filters_list = None
+        if not self.all_param.all:
+            filters_list = self.prepare_filters()
+        return self._doc_class.get_db().iterate(filters_list, self.sortingp_list,
+                                                self.all_param, self._doc_class,
+                                                chunk_size, fields=self.fields)
+
+    def evaluate_facets(self, props):
+        filters_list = None
+        if not self.all_param.all:
+            filters_list = self.prepare_filters()
+        return self._doc_class.get_db().facets(filters_list, self._doc_class, props)
+
+    def evaluate_aggregate(self, aggregates):
+        filters_list = None
+        if not self.all_param.all:
+            filters_list = self.prepare_filters()
+        return self._doc_class.get_db().aggregate(filters_list, self._doc_class,
+                                                  aggregates)
 
 
 class QueryManager(object):
@@ -134,10 +345,106 @@ class QueryManager(object):
     def __init__(self, cls):
         self._doc_class = cls
 
-        self.filter = QuerySet(self._doc_class).filter
-        self.get = QuerySet(self._doc_class).get
-        self.sort_by = QuerySet(self._doc_class).sort_by
-        self.all = QuerySet(self._doc_class).all
+    # QuerySets are only built for the method that is called
+
+    def filter(self, q):
+        return QuerySet(self._doc_class).filter(q)
+
+    def get(self, q):
+        return QuerySet(self._doc_class).get(q)
+
+    def sort_by(self, key, reverse=False):
+        return QuerySet(self._doc_class).sort_by(key, reverse)
+
+    def all(self, skip=None, limit=None):
+        return QuerySet(self._doc_class).all(skip, limit)
+
+
+class Aggregate(object):
+    """
+    Base class of the aggregates taken by QuerySet.aggregate. Backends
+    collect (count, sum, min, max) statistics of the values of field, and
+    resolve turns them into the value of the aggregate.
+    """
+    name = None
+    # Whether the aggregate needs an integer or float property
+    numeric = False
+
+    def __init__(self, field):
+        self.field = field
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.field)
+
+    def get_alias(self):
+        return '{0}__{1}'.format(self.field, self.name)
+
+    def check(self, doc_class):
+        doc_class.check_fields([self.field])
+        prop = doc_class._base_properties[self.field]
+        if self.numeric and not isinstance(prop, (IntegerProperty, FloatProperty)):
+            raise QueryError("{0} needs an integer or float property, '{1}' isn't one".format(
+                self.__class__.__name__, self.field))
+        self.prop = prop
+
+    def resolve(self, doc_count, stats):
+        raise NotImplementedError
+
+
+class Count(Aggregate):
+    """Number of documents, or of documents with a value for field."""
+    name = 'count'
+
+    def __init__(self, field=None):
+        super(Count, self).__init__(field)
+
+    def get_alias(self):
+        return '{0}__count'.format(self.field) if self.field else 'count'
+
+    def check(self, doc_class):
+        if self.field is not None:
+            super(Count, self).check(doc_class)
+
+    def resolve(self, doc_count, stats):
+        if self.field is None:
+            return doc_count
+        return stats[0]
+
+
+class Sum(Aggregate):
+    name = 'sum'
+    numeric = True
+
+    def resolve(self, doc_count, stats):
+        if not stats[0]:
+            return None
+        if isinstance(self.prop, IntegerProperty):
+            return int(stats[1])
+        return stats[1]
+
+
+class Avg(Aggregate):
+    name = 'avg'
+    numeric = True
+
+    def resolve(self, doc_count, stats):
+        if not stats[0]:
+            return None
+        return stats[1] / stats[0]
+
+
+class Min(Aggregate):
+    name = 'min'
+
+    def resolve(self, doc_count, stats):
+        return stats[2]
+
+
+class Max(Aggregate):
+    name = 'max'
+
+    def resolve(self, doc_count, stats):
+        return stats[3]
 
 
 class SortingParam(object):
@@ -173,6 +480,212 @@ class AllParam(object):
         self.skip = skip
         self.limit = limit
 
+    def narrow(self, start, stop):
+        """Returns a new AllParam for the start:stop slice of this window."""
+        start = start or 0
+        skip = (self.skip or 0) + start
+        limit = self.limit
+        if stop is not None:
+            limit = max(stop - start, 0) if limit is None \
+                else max(min(stop, limit) - start, 0)
+        elif limit is not None:
+            limit = max(limit - start, 0)
+        return AllParam(all=self.all, skip=skip or None, limit=limit)
+
     def __repr__(self):
         return "%s(all='%s', skip='%s', limit=%s)" % (self.__class__, self.all,self.skip,
                                                       self.limit)
+
+
+def route_compound_indexes(doc_class, q):
+    """
+    Replaces the equality filters of q that a compound index covers with
+    the name of that index. Returns the index names and the rest of q.
+    Indexes covering more filters are tried first. Wildcard values are
+    left to the single property indexes, which expand them.
+    """
+    equal = {k: v for k, v in q.items() if k in doc_class._compound_props
+             and not isinstance(v, list)
+             and not (isinstance(v, str) and '*' in v)}
+    index_list = []
+    for index in sorted(doc_class._compound_indexes, key=lambda i: -len(i.props)):
+        if not index.props.issubset(equal):
+            continue
+        values = index.get_values(doc_class, equal)
+        if values is not None:
+            index_list.append(doc_class.get_compound_index_name(index, values))
+            equal = {k: v for k, v in equal.items() if k not in index.props}
+    if not index_list:
+        return [], q
+    return index_list, {k: v for k, v in q.items()
+                        if k not in doc_class._compound_props or k in equal
+                        or isinstance(v, list)}
+
+
+def make_filters(doc_class, k, v):
+    """
+    Returns the filters that the filter dict item k: v stands for. They all
+    have to match.
+    """
+    key, lookup = RangeFilter.split_lookup(k)
+    if lookup:
+        return RangeFilter.from_lookup(doc_class, key, lookup, v)
+    if k.endswith('__in'):
+        return [FilterNode(doc_class, FilterNode.OR, [
+            doc_class.get_index_name(k[:-len('__in')], index_v) for index_v in v])]
+    if isinstance(v, list):
+        return [doc_class.get_index_name(k, index_v) for index_v in v]
+    return [doc_class.get_index_name(k, v)]
+
+
+class Q(object):
+    """
+    Filter conditions that are combined with | (or), & (and) and ~ (not)
+    and passed to filter() or get(). The keyword arguments, or the items of
+    a filter dict, all have to match.
+
+    >>> TestDocument.objects().filter(Q(state='NC') | ~Q(is_active=True))
+    """
+    # Key of the Q objects in the filter dict of a QuerySet
+    filter_key = '__q'
+
+    def __init__(self, q=None, **kwargs):
+        self.connector = FilterNode.AND
+        self.negated = False
+        self.children = list((q or {}).items()) + list(kwargs.items())
+
+    def __repr__(self):
+        return "%s(%s%s: %s)" % (self.__class__.__name__, 'not ' if self.negated else '',
+                                 self.connector, self.children)
+
+    @classmethod
+    def to_dict(cls, q):
+        """
+        Returns the filter dict for q. Q objects and __in lookups are kept
+        under filter_key so that chained filters AND them.
+        """
+        if isinstance(q, cls):
+            return {cls.filter_key: q}
+        if not q or not any(k.endswith('__in') for k in q):
+            return q
+        q = q.copy()
+        q[cls.filter_key] = cls({k: q.pop(k) for k in list(q) if k.endswith('__in')})
+        return q
+
+    def combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError("Q objects can only be combined with other Q objects")
+        q = Q()
+        q.connector = connector
+        q.children = [self, other]
+        return q
+
+    def __or__(self, other):
+        return self.combine(other, FilterNode.OR)
+
+    def __and__(self, other):
+        return self.combine(other, FilterNode.AND)
+
+    def __invert__(self):
+        q = Q()
+        q.connector = self.connector
+        q.children = list(self.children)
+        q.negated = not self.negated
+        return q
+
+    def compile(self, doc_class):
+        """Returns the FilterNode of this Q object for doc_class."""
+        children = []
+        for child in self.children:
+            if isinstance(child, Q):
+                children.append(child.compile(doc_class))
+                continue
+            filters = make_filters(doc_class, *child)
+            children.append(filters[0] if len(filters) == 1
+                            else FilterNode(doc_class, FilterNode.AND, filters))
+        node = FilterNode(doc_class, self.connector, children)
+        if self.negated:
+            node = FilterNode(doc_class, FilterNode.NOT, [node])
+        return node
+
+
+class FilterNode(object):
+    """
+    Combination of filters built from Q objects and __in lookups. Children
+    are index names, RangeFilters or other FilterNodes; a NOT node has a
+    single child and matches the documents of doc_class it doesn't match.
+    """
+    AND = 'and'
+    OR = 'or'
+    NOT = 'not'
+
+    def __init__(self, doc_class, op, children):
+        self.doc_class = doc_class
+        self.op = op
+        self.children = children
+
+    def __repr__(self):
+        return "%s(op='%s', children=%s)" % (self.__class__, self.op, self.children)
+
+
+class RangeFilter(object):
+    """
+    Range lookup on a property with a sorted index, built from the __gt,
+    __gte, __lt, __lte and __between filter suffixes. Bounds are kept as
+    the property scores.
+    """
+    lookups = ('gt', 'gte', 'lt', 'lte', 'between')
+
+    def __init__(self, doc_class, key, min_value=None, max_value=None,
+                 min_inclusive=True, max_inclusive=True):
+        prop = doc_class._base_properties.get(key)
+        if prop is None or not prop.sortable:
+            raise QueryError(
+                "Range lookups on '{0}' need a numeric or date property "
+                "declared with sortable=True".format(key))
+        self.key = key
+        self.index_name = doc_class.get_sort_index_name(key)
+        # Without a lower bound documents without a value (-inf) are left out
+        if min_value is None:
+            self.min_score, self.min_inclusive = float('-inf'), False
+        else:
+            self.min_score, self.min_inclusive = prop.get_score(min_value), min_inclusive
+        if max_value is None:
+            self.max_score, self.max_inclusive = float('inf'), True
+        else:
+            self.max_score, self.max_inclusive = prop.get_score(max_value), max_inclusive
+
+    def __repr__(self):
+        return "%s(key='%s', min=%s, max=%s)" % (self.__class__, self.key,
+                                                 self.get_score_range()[0],
+                                                 self.get_score_range()[1])
+
+    @classmethod
+    def split_lookup(cls, key):
+        prop, sep, lookup = key.rpartition('__')
+        if sep and lookup in cls.lookups:
+            return prop, lookup
+        return key, None
+
+    @classmethod
+    def from_lookup(cls, doc_class, key, lookup, value):
+        if lookup == 'between':
+            # Chained filters combine between pairs into one flat list
+            values = list(value)
+            if len(values) % 2:
+                raise QueryError("__between lookups take a (min, max) pair")
+            return [cls(doc_class, key, values[i], values[i + 1])
+                    for i in range(0, len(values), 2)]
+        values = value if isinstance(value, list) else [value]
+        kwargs = {
+            'gt': lambda v: {'min_value': v, 'min_inclusive': False},
+            'gte': lambda v: {'min_value': v},
+            'lt': lambda v: {'max_value': v, 'max_inclusive': False},
+            'lte': lambda v: {'max_value': v},
+        }[lookup]
+        return [cls(doc_class, key, **kwargs(v)) for v in values]
+
+    def get_score_range(self):
+        """Returns the bounds in the ZRANGEBYSCORE min/max syntax."""
+        return ('{0}{1!r}'.format('' if self.min_inclusive else '(', self.min_score),
+                '{0}{1!r}'.format('' if self.max_inclusive else '(', self.max_score))
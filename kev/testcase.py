@@ -6,7 +6,7 @@ from envs import env
 bucket_a = env('S3_BUCKET_TEST', 'kevtest')
 bucket_b = env('S3_BUCKET_TEST_B', 'kevtestb')
 
-kev_handler = KevHandler({
+databases = {
     's3redis': {
         'backend': 'kev.backends.s3redis.db.S3RedisDB',
         'connection': {
@@ -41,7 +41,34 @@ kev_handler = KevHandler({
             }
         }
     },
-})
+    'shardedredis': {
+        'backend': 'kev.backends.shardedredis.db.ShardedRedisDB',
+        'connection': {
+            'nodes': [{
+                'host': env('REDIS_HOST_TEST', 'redis'),
+                'port': env('REDIS_PORT_TEST', 6379, var_type='integer'),
+                'db': db,
+            } for db in (1, 2, 3)],
+            'restore': {
+                'endpoint_url': 'http://localstack:4566'
+            }
+        }
+    },
+}
+
+if env('REDIS_CLUSTER_HOST_TEST', None):
+    # Needs a running Redis Cluster, like the redis-cluster service of
+    # docker-compose.yaml
+    databases['rediscluster'] = {
+        'backend': 'kev.backends.redis.db.RedisDB',
+        'connection': {
+            'host': env('REDIS_CLUSTER_HOST_TEST'),
+            'port': env('REDIS_CLUSTER_PORT_TEST', 7000, var_type='integer'),
+            'cluster': True,
+        }
+    }
+
+kev_handler = KevHandler(databases)
 
 session = boto3.session.Session()
 
@@ -3,15 +3,19 @@ import os
 import unittest
 import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import redis
 from botocore.exceptions import ClientError
 from envs import env
 
 from kev import (Document,CharProperty,DateTimeProperty,
                  DateProperty,BooleanProperty,IntegerProperty,
-                 FloatProperty)
-from kev.exceptions import QueryError
-from kev.query import combine_list, combine_dicts
+                 FloatProperty, Q, Avg, Count, Max, Min, Sum)
+from kev.exceptions import QueryError, DocNotFoundError, ResourceError
+from kev.backends.redis.db import RedisDB
+from kev.backends.shardedredis.db import HashRing, ShardedRedisDB
+from kev.query import AllParam, SortingParam, combine_list, combine_dicts
 from kev.testcase import kev_handler,KevTestCase
 from valley.exceptions import ValidationException
 
@@ -37,21 +41,28 @@ class TestDocument(Document):
         handler = kev_handler
 
 
+COMPOUND_INDEXES = [('city', 'rank'),
+                    {'fields': ('city',), 'where': {'is_active': True}}]
+
+
 class BaseTestDocumentSlug(TestDocument):
     slug = CharProperty(required=True, unique=True)
     email = CharProperty(required=True, unique=True)
     city = CharProperty(required=True, index=True)
+    rank = IntegerProperty(sortable=True)
 
 class S3TestDocumentSlug(BaseTestDocumentSlug):
 
     class Meta:
         use_db = 's3'
         handler = kev_handler
+        compound_indexes = COMPOUND_INDEXES
 
 class S3RedisTestDocumentSlug(BaseTestDocumentSlug):
     class Meta:
         use_db = 's3redis'
         handler = kev_handler
+        compound_indexes = COMPOUND_INDEXES
 
 
 class RedisTestDocumentSlug(BaseTestDocumentSlug):
@@ -59,6 +70,35 @@ class RedisTestDocumentSlug(BaseTestDocumentSlug):
     class Meta:
         use_db = 'redis'
         handler = kev_handler
+        compound_indexes = COMPOUND_INDEXES
+
+
+class ShardedRedisTestDocumentSlug(BaseTestDocumentSlug):
+
+    class Meta:
+        use_db = 'shardedredis'
+        handler = kev_handler
+        compound_indexes = COMPOUND_INDEXES
+
+
+class RedisClusterTestDocumentSlug(BaseTestDocumentSlug):
+
+    class Meta:
+        use_db = 'rediscluster'
+        handler = kev_handler
+        compound_indexes = COMPOUND_INDEXES
+
+
+class RedisCompoundTestDocument(Document):
+    city = CharProperty(required=True, index=True)
+    rank = IntegerProperty(index=True)
+    state = CharProperty(index=True)
+
+    class Meta:
+        use_db = 'redis'
+        handler = kev_handler
+        compound_indexes = [('city', 'rank'),
+                            {'fields': ('city',), 'where': {'state': 'open'}}]
 
 
 class DocumentTestCase(KevTestCase):
@@ -81,6 +121,17 @@ class DocumentTestCase(KevTestCase):
                                  city='Greensboro',gpa=4.0)
         self.assertEqual(obj.get_unique_props().sort(),['name','slug','email'].sort())
 
+    def test_class_schema(self):
+        self.assertEqual(set(['name', 'slug', 'email', 'city']),
+                         set(RedisTestDocumentSlug._indexed_props))
+        self.assertEqual(('rank',), RedisTestDocumentSlug._sortable_props)
+        self.assertEqual(kev_handler.get_db('redis'), RedisTestDocumentSlug.get_db())
+        self.assertEqual(kev_handler.get_db('s3'), S3TestDocumentSlug.get_db())
+        self.assertEqual('redis:redistestdocumentslug:indexes:city:durham',
+                         RedisTestDocumentSlug.get_index_name('city', 'Durham'))
+        self.assertEqual('s3:s3testdocumentslug:sorted:rank',
+                         S3TestDocumentSlug.get_sort_index_name('rank'))
+
     def test_set_indexed_prop(self):
         obj = S3RedisTestDocumentSlug(name='Brian', slug='brian', email='brian@host.com',
                                  city='Greensboro', gpa=4.0)
@@ -147,15 +198,15 @@ class S3RedisQueryTestCase(KevTestCase):
 
     def setUp(self):
         self.t1 = self.doc_class(name='Goo and Sons', slug='goo-sons', gpa=3.0,
-                                 email='goo@sons.com', city="Durham")
+                                 email='goo@sons.com', city="Durham", rank=3)
         self.t1.save()
         self.t2 = self.doc_class(
             name='Great Mountain', slug='great-mountain',
-            gpa=3.1, email='great@mountain.com', city='Charlotte')
+            gpa=3.1, email='great@mountain.com', city='Charlotte', rank=2)
         self.t2.save()
         self.t3 = self.doc_class(
             name='Lakewoood YMCA', slug='lakewood-ymca', gpa=3.2,
-            email='lakewood@ymca.com', city='Durham')
+            email='lakewood@ymca.com', city='Durham', rank=1)
         self.t3.save()
 
     def test_non_unique_filter(self):
@@ -166,6 +217,152 @@ class S3RedisQueryTestCase(KevTestCase):
         qs = self.doc_class.objects().filter({'city': 'du*ham'})
         self.assertEqual(2, qs.count())
 
+    def test_range_filters(self):
+        qs = self.doc_class.objects().filter({'rank__gt': 1})
+        self.assertEqual({self.t1.name, self.t2.name}, {doc.name for doc in qs})
+        self.assertEqual(2, self.doc_class.objects().filter({'rank__lte': 2}).count())
+        self.assertEqual([self.t3.name],
+                         [doc.name for doc in self.doc_class.objects().filter({'rank__lt': 2})])
+        self.assertEqual(2, self.doc_class.objects().filter({'rank__between': (2, 3)}).count())
+        self.t1.rank = 5
+        self.t1.save()
+        self.assertEqual(0, self.doc_class.objects().filter({'rank__between': (3, 4)}).count())
+        self.assertEqual([self.t1.name],
+                         [doc.name for doc in self.doc_class.objects().filter({'rank__gte': 5})])
+        with self.assertRaises(QueryError):
+            self.doc_class.objects().filter({'gpa__gt': 3.0}).count()
+
+    def test_range_filter_chaining(self):
+        qs = self.doc_class.objects().filter({'rank__gte': 1, 'city': 'durham'}).filter(
+            {'rank__lt': 3})
+        self.assertEqual([self.t3.name], [doc.name for doc in qs])
+        qs = self.doc_class.objects().filter({'rank__gte': 1, 'city': 'durham'}).sort_by('rank')
+        self.assertEqual([self.t3.name, self.t1.name], [doc.name for doc in qs])
+
+    def test_q_objects(self):
+        names = lambda qs: sorted(doc.name for doc in qs)
+        qs = self.doc_class.objects().filter(Q(city='charlotte') | Q(city='durham'))
+        self.assertEqual(3, qs.count())
+        qs = self.doc_class.objects().filter({'city__in': ['Charlotte', 'nowhere']})
+        self.assertEqual([self.t2.name], names(qs))
+        self.assertEqual(0, self.doc_class.objects().filter({'city__in': []}).count())
+        qs = self.doc_class.objects().filter({'city__in': ['durham', 'charlotte']}).filter(
+            {'city__in': ['charlotte']})
+        self.assertEqual([self.t2.name], names(qs))
+        self.assertEqual([self.t2.name], names(
+            self.doc_class.objects().filter(~Q(city='durham'))))
+        qs = self.doc_class.objects().filter({'city': 'durham'}).filter(~Q(rank__lte=1))
+        self.assertEqual([self.t1.name], names(qs))
+        qs = self.doc_class.objects().filter(
+            Q(city='charlotte') | Q(rank__gte=3)).sort_by('rank')
+        self.assertEqual([self.t2.name, self.t1.name], [doc.name for doc in qs])
+        qs = self.doc_class.objects().filter(~Q(city='charlotte') & Q(rank__gte=2))
+        self.assertEqual([self.t1.id], list(qs.values_list('id', flat=True)))
+        # rank has no equality index, so nothing is taken out for it
+        qs = self.doc_class.objects().filter(~(Q(city='charlotte') | Q(rank=1, city='durham')))
+        self.assertEqual(2, qs.count())
+        qs = self.doc_class.objects().filter(~(Q(city='charlotte') | Q(rank__lt=2)))
+        self.assertEqual([self.t1.name], names(qs))
+        self.assertEqual(self.t3.name, self.doc_class.objects().get(
+            Q(rank__lt=2) | Q(city='nowhere')).name)
+        with self.assertRaises(TypeError):
+            Q(city='durham') | {'city': 'charlotte'}
+
+    def test_compound_indexes(self):
+        qs = self.doc_class.objects().filter({'city': 'Durham', 'rank': 3})
+        self.assertEqual([self.doc_class.get_compound_index_name(
+            self.doc_class._compound_indexes[0], ['durham', 3])], qs.prepare_filters())
+        self.assertEqual([self.t1.name], [doc.name for doc in qs])
+        self.t1.rank = 4
+        self.t1.save()
+        self.assertEqual(0, self.doc_class.objects().filter(
+            {'city': 'Durham', 'rank': 3}).count())
+        self.assertEqual(1, self.doc_class.objects().filter(
+            {'city': 'durham', 'rank': 4, 'name': self.t1.name}).count())
+        active = lambda: self.doc_class.objects().filter({'city': 'durham', 'is_active': True})
+        self.assertEqual(1, len(active().prepare_filters()))
+        self.assertEqual(2, active().count())
+        self.t3.is_active = False
+        self.t3.save()
+        self.assertEqual([self.t1.name], [doc.name for doc in active()])
+        self.t3.incr('rank')
+        self.assertEqual([self.t3.name], [doc.name for doc in self.doc_class.objects().filter(
+            {'city': 'durham', 'rank': 2})])
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'durham'}).update(rank=7))
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'durham', 'rank': 7}).count())
+        self.doc_class.objects().filter({'city': 'durham', 'rank': 7}).delete()
+        self.assertEqual(0, self.doc_class.objects().filter({'city': 'durham', 'rank': 7}).count())
+        self.assertEqual(0, active().count())
+
+    def test_build_unique_reservations(self):
+        db = self.doc_class.get_db()
+        key = self.t1.get_unique_name('slug', self.t1.slug)
+        # Documents saved before values were reserved have no reservations
+        db.release_unique(self.t1, [key])
+        self.assertIsNone(db.get_unique_owner(self.t1, 'slug', self.t1.slug))
+        db.build_unique_reservations(self.doc_class)
+        self.assertEqual(self.t1._id, db.get_unique_owner(self.t1, 'slug', self.t1.slug))
+        with self.assertRaises(ValidationException):
+            self.doc_class(name='Goo Twice', slug=self.t1.slug, email='goo@twice.com',
+                           city='Durham').save()
+        db.release_unique(self.t1, [key])
+        self.doc_class(name='Goo Twice', slug=self.t1.slug, email='goo@twice.com',
+                       city='Durham').save()
+        with self.assertRaises(ResourceError):
+            db.build_unique_reservations(self.doc_class)
+
+    def test_build_compound_indexes(self):
+        # Documents saved before the indexes were declared have no entries
+        compound_indexes = self.doc_class._compound_indexes
+        self.doc_class._compound_indexes = ()
+        try:
+            self.doc_class(name='Raleigh Inc', slug='raleigh-inc', email='r@inc.com',
+                           city='Raleigh', rank=9).save()
+        finally:
+            self.doc_class._compound_indexes = compound_indexes
+        qs = lambda: self.doc_class.objects().filter({'city': 'raleigh', 'rank': 9})
+        self.assertEqual(0, qs().count())
+        self.doc_class.get_db().build_compound_indexes(self.doc_class)
+        self.assertEqual(1, qs().count())
+        self.assertEqual(1, self.doc_class.objects().filter(
+            {'city': 'raleigh', 'is_active': True}).count())
+
+    def test_facets(self):
+        self.assertEqual({'city': {'durham': 2, 'charlotte': 1}},
+                         self.doc_class.objects().all().facets('city'))
+        facets = self.doc_class.objects().filter({'rank__gte': 2}).facets('city', 'slug')
+        self.assertEqual({'durham': 1, 'charlotte': 1}, facets['city'])
+        self.assertEqual({self.t1.slug: 1, self.t2.slug: 1}, facets['slug'])
+        self.assertEqual({'city': {'durham': 2}}, self.doc_class.objects().filter(
+            ~Q(city='charlotte')).facets('city'))
+        self.assertEqual({'city': {}}, self.doc_class.objects().filter(
+            {'city': 'nowhere'}).facets('city'))
+        with self.assertRaises(QueryError):
+            self.doc_class.objects().all().facets('gpa')
+
+    def test_aggregate(self):
+        result = self.doc_class.objects().all().aggregate(
+            Avg('gpa'), Min('rank'), Max('gpa'), Count(), total=Sum('rank'))
+        self.assertEqual({'gpa__avg', 'rank__min', 'gpa__max', 'count', 'total'},
+                         set(result))
+        self.assertAlmostEqual(3.1, result['gpa__avg'])
+        self.assertEqual(1, result['rank__min'])
+        self.assertEqual(3.2, result['gpa__max'])
+        self.assertEqual(3, result['count'])
+        self.assertEqual(6, result['total'])
+        result = self.doc_class.objects().filter({'city': 'durham'}).aggregate(
+            Sum('gpa'), Max('rank'), Count('rank'), Min('name'))
+        self.assertAlmostEqual(6.2, result['gpa__sum'])
+        self.assertEqual(3, result['rank__max'])
+        self.assertEqual(2, result['rank__count'])
+        self.assertEqual('Goo and Sons', result['name__min'])
+        self.assertEqual({'count': 0, 'gpa__avg': None}, self.doc_class.objects().filter(
+            {'city': 'nowhere'}).aggregate(Count(), Avg('gpa')))
+        with self.assertRaises(QueryError):
+            self.doc_class.objects().all().aggregate(Sum('name'))
+        with self.assertRaises(ValueError):
+            self.doc_class.objects().all().aggregate(Max('missing'))
+
     def test_objects_get_single_indexed_prop(self):
         obj = self.doc_class.objects().get({'name': self.t1.name})
         self.assertEqual(obj.slug, self.t1.slug)
@@ -174,6 +371,65 @@ class S3RedisQueryTestCase(KevTestCase):
         obj = self.doc_class.get(self.t1.id)
         self.assertEqual(obj._id, self.t1._id)
 
+    def test_get_many(self):
+        ids = [self.t3.id, 'missing', self.t1.id]
+        docs = list(self.doc_class.get_many(ids))
+        self.assertEqual([self.t3._id, self.t1._id], [doc._id for doc in docs])
+        docs = list(self.doc_class.get_many(ids, missing='none', batch_size=2))
+        self.assertIsNone(docs[1])
+        self.assertEqual(self.t1.name, docs[2].name)
+        with self.assertRaises(DocNotFoundError):
+            list(self.doc_class.get_many(ids, missing='raise'))
+        with self.assertRaises(ValueError):
+            self.doc_class.get_many(ids, missing='ignore')
+
+    def test_unique_reservations(self):
+        dupe = self.doc_class(name='Goo and Sons', slug='goo-sons-2', gpa=3.5,
+                              email='goo2@sons.com', city='Raleigh')
+        with self.assertRaises(ValidationException):
+            dupe.save()
+        self.t1.name = 'Goo Renamed'
+        self.t1.save()
+        dupe.save()
+        with self.assertRaises(ValidationException):
+            self.t1.name = 'Goo and Sons'
+            self.t1.save()
+        dupe.delete()
+        self.t1.save()
+        self.assertEqual(self.t1._id, self.doc_class.get_db().get_unique_owner(
+            self.t1, 'name', 'goo and sons'))
+
+    def test_concurrent_unique_saves(self):
+        def save(i):
+            try:
+                self.doc_class(name='Racing Doc', slug='racing-{}'.format(i), gpa=3.5,
+                               email='racing{}@doc.com'.format(i), city='Raleigh').save()
+            except ValidationException:
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(save, range(8)))
+        self.assertEqual(1, results.count(True))
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'raleigh'}).count())
+
+    def test_save_many(self):
+        docs = [self.doc_class(name='Bulk Doc {}'.format(i), slug='bulk-doc-{}'.format(i),
+                               gpa=3.5, email='bulk{}@doc.com'.format(i), city='Raleigh')
+                for i in range(5)]
+        docs.insert(2, self.doc_class(name='Goo and Sons', slug='goo-sons-2', gpa=3.5,
+                                      email='goo2@sons.com', city='Raleigh'))
+        docs.append(self.doc_class(name='Bulk Doc 0', slug='bulk-doc-dupe', gpa=3.5,
+                                   email='dupe@doc.com', city='Raleigh'))
+        result = self.doc_class.save_many(docs)
+        self.assertEqual(5, len(result.saved))
+        self.assertEqual([2, 6], sorted(result.errors.keys()))
+        self.assertIsInstance(result.errors[2], ValidationException)
+        self.assertIs(result.results[0], docs[0])
+        self.assertGreater(result.docs_per_second, 0)
+        self.assertEqual(5, self.doc_class.objects().filter({'city': 'raleigh'}).count())
+        self.assertEqual(docs[1].slug, self.doc_class.get(docs[1].id).slug)
+
     def test_flush_db(self):
         self.assertEqual(3, len(list(self.doc_class.all())))
         self.doc_class().flush_db()
@@ -186,6 +442,41 @@ class S3RedisQueryTestCase(KevTestCase):
         qs = self.doc_class.objects().filter({'city': 'durham'})
         self.assertEqual(1, qs.count())
 
+    def test_count_exists_first(self):
+        qs = self.doc_class.objects().filter({'city': 'durham'})
+        self.assertEqual(2, qs.count())
+        self.assertEqual(1, qs[1:].count())
+        self.assertEqual(0, qs[2:].count())
+        self.assertEqual(2, len(qs))
+        self.assertIsNone(qs._result_cache)
+        self.assertTrue(qs.exists())
+        self.assertTrue(qs)
+        self.assertFalse(qs[2:].exists())
+        self.assertEqual(3, self.doc_class.objects().all().count())
+        self.assertEqual(1, self.doc_class.objects().all(skip=1, limit=1).count())
+        self.assertEqual(2, self.doc_class.objects().filter({'rank__gt': 1}).count())
+        empty = self.doc_class.objects().filter({'city': 'nowhere'})
+        self.assertFalse(empty.exists())
+        self.assertIsNone(empty.first())
+        first = self.doc_class.objects().filter({'city': 'durham'}).sort_by('rank').first()
+        self.assertEqual(self.t3.name, first.name)
+
+    def test_iterator(self):
+        qs = self.doc_class.objects().all()
+        names = sorted(doc.name for doc in qs.iterator(chunk_size=2))
+        self.assertEqual(sorted([self.t1.name, self.t2.name, self.t3.name]), names)
+        self.assertIsNone(qs._result_cache)
+        qs = self.doc_class.objects().filter({'city': 'durham'})
+        self.assertEqual(2, len(list(qs.iterator(chunk_size=1))))
+        self.assertIsNone(qs._result_cache)
+        qs = self.doc_class.objects().filter({'rank__gte': 2})
+        self.assertEqual(2, len(list(qs.iterator())))
+        sorted_qs = self.doc_class.objects().all().sort_by('rank')
+        self.assertEqual([self.t3.name, self.t2.name],
+                         [doc.name for doc in sorted_qs[:2].iterator(chunk_size=1)])
+        with self.assertRaises(ValueError):
+            qs.iterator(chunk_size=0)
+
     def test_wildcard_queryset_iter(self):
         qs = self.doc_class.objects().filter({'city': 'du*ham'})
         for i in qs:
@@ -224,6 +515,155 @@ class S3RedisQueryTestCase(KevTestCase):
         qs = self.doc_class.all()
         self.assertEqual(3, len(list(qs)))
 
+    def test_all_pages_in_stable_order(self):
+        ids = [doc._id for doc in self.doc_class.all()]
+        paged = [doc._id for x in range(3)
+                 for doc in self.doc_class.all(skip=x, limit=1)]
+        self.assertEqual(ids, paged)
+
+    def test_only(self):
+        qs = self.doc_class.objects().filter({'city': 'durham'}).only('name', 'city')
+        docs = sorted(qs, key=lambda doc: doc.name)
+        self.assertEqual(2, len(docs))
+        self.assertEqual(self.t1.name, docs[0].name)
+        self.assertEqual(self.t1.email, docs[0].email)
+        doc = self.doc_class.get(self.t2.id, fields=['slug'])
+        self.assertEqual(self.t2.slug, doc.slug)
+        doc.name = 'Updated Name'
+        doc.save()
+        doc = self.doc_class.get(self.t2.id)
+        self.assertEqual('Updated Name', doc.name)
+        self.assertEqual(self.t2.email, doc.email)
+        self.assertEqual(1, self.doc_class.objects().filter({'name': 'Updated Name'}).count())
+        sorted_qs = self.doc_class.objects().all().sort_by('name').only('city')
+        self.assertEqual(3, len(list(sorted_qs)))
+        with self.assertRaises(ValueError):
+            self.doc_class.objects().all().only('nonexistent_field')
+
+    def test_values(self):
+        qs = self.doc_class.objects().filter({'city': 'durham'}).sort_by('rank')
+        self.assertEqual([{'name': self.t3.name, 'gpa': self.t3.gpa},
+                          {'name': self.t1.name, 'gpa': self.t1.gpa}],
+                         list(qs.values('name', 'gpa')))
+        self.assertEqual([(self.t3.id, 1), (self.t1.id, 3)],
+                         list(qs.values_list('id', 'rank')))
+        self.assertEqual([self.t3.name, self.t1.name],
+                         list(qs.sort_by('rank').values_list('name', flat=True)))
+        self.assertEqual(sorted([self.t1.email, self.t3.email]), sorted(
+            self.doc_class.objects().filter({'city': 'durham'}).values_list(
+                'email', flat=True)))
+        row = self.doc_class.objects().all().values()[0]
+        self.assertEqual(set(['id'] + list(self.doc_class._base_properties)), set(row))
+        self.assertIsInstance(row['gpa'], float)
+        self.assertEqual(3, self.doc_class.objects().all().values('name').count())
+        self.assertEqual(2, len(list(self.doc_class.objects().all().values_list('name')[1:])))
+        with self.assertRaises(ValueError):
+            self.doc_class.objects().all().values_list('name', 'city', flat=True)
+        with self.assertRaises(ValueError):
+            self.doc_class.objects().all().values('nonexistent_field')
+
+    def test_changed_fields(self):
+        doc = self.doc_class(name='Tracked Co', slug='tracked', email='tracked@co.com',
+                             city='Durham')
+        self.assertIsNone(doc.get_changed_fields())
+        doc.save()
+        self.assertEqual(set(['last_updated']), doc.get_changed_fields())
+        doc = self.doc_class.get(doc.id)
+        self.assertEqual(set(['last_updated']), doc.get_changed_fields())
+        doc.city = 'Raleigh'
+        doc.rank = 7
+        self.assertEqual(set(['last_updated', 'city', 'rank']), doc.get_changed_fields())
+        doc.save()
+        doc = self.doc_class.get(doc.id)
+        self.assertEqual('Raleigh', doc.city)
+        self.assertEqual('tracked@co.com', doc.email)
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'durham'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'raleigh'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'rank__gt': 5}).count())
+        doc.email = self.t1.email
+        with self.assertRaises(ValidationException):
+            doc.save()
+
+    def test_incr(self):
+        doc = self.doc_class.get(self.t1.id)
+        self.assertEqual(4, doc.incr('rank'))
+        self.assertEqual(4, doc.rank)
+        self.assertEqual(set(['last_updated']), doc.get_changed_fields())
+        self.assertEqual(2, self.t1.decr('rank', 2))
+        self.assertEqual(2, self.doc_class.get(self.t1.id).rank)
+        self.assertEqual([self.t1.name, self.t2.name], [doc.name for doc in
+            self.doc_class.objects().filter({'rank__gte': 2}).sort_by('name')])
+        self.assertEqual(3.5, self.t1.incr('gpa', 0.5))
+        self.assertEqual(3.5, self.doc_class.get(self.t1.id).gpa)
+        self.assertEqual(2, self.t1.incr('no_subscriptions'))
+        with self.assertRaises(ValidationException):
+            self.t1.incr('no_subscriptions', 19)
+        self.assertEqual(2, self.doc_class.get(self.t1.id).no_subscriptions)
+        with self.assertRaises(ValueError):
+            self.t1.incr('city')
+        with self.assertRaises(ValueError):
+            self.t1.incr('rank', 0.5)
+
+    def test_set_fields(self):
+        self.t1.set_fields(city='Raleigh', gpa=2.5)
+        doc = self.doc_class.get(self.t1.id)
+        self.assertEqual('Raleigh', doc.city)
+        self.assertEqual(2.5, doc.gpa)
+        self.assertEqual(self.t1.email, doc.email)
+        self.assertEqual('Raleigh', self.t1.city)
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'durham'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'raleigh'}).count())
+        with self.assertRaises(ValidationException):
+            self.t1.set_fields(email=self.t2.email)
+        self.t1.set_fields(email='new@ymca.com')
+        # The old value was released
+        self.t2.set_fields(email='goo@sons.com')
+        self.assertEqual('goo@sons.com', self.doc_class.get(self.t2.id).email)
+        with self.assertRaises(ValueError):
+            self.t1.set_fields(nonexistent_field=1)
+
+    def test_queryset_delete(self):
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'durham'}).delete())
+        self.assertEqual(0, self.doc_class.objects().filter({'city': 'durham'}).count())
+        self.assertEqual([self.t2.id], [doc.id for doc in self.doc_class.all()])
+        self.assertEqual(0, self.doc_class.objects().filter({'rank__lt': 2}).count())
+        # The unique values of the deleted documents are free again
+        self.doc_class(name=self.t1.name, slug=self.t1.slug, email=self.t1.email,
+                       city='Durham').save()
+        self.assertEqual(0, self.doc_class.objects().filter({'city': 'nowhere'}).delete())
+        self.assertEqual(2, self.doc_class.objects().all().delete())
+        self.assertEqual(0, self.doc_class.objects().all().count())
+
+    def test_queryset_update(self):
+        qs = self.doc_class.objects().filter({'city': 'durham'})
+        self.assertEqual(2, qs.update(city='Raleigh', gpa=2.0))
+        self.assertEqual(0, qs.count())
+        docs = self.doc_class.objects().filter({'city': 'raleigh'}).sort_by('name')
+        self.assertEqual([self.t1.name, self.t3.name], [doc.name for doc in docs])
+        self.assertEqual([2.0, 2.0], [doc.gpa for doc in docs])
+        self.assertEqual(self.t1.email, self.doc_class.get(self.t1.id).email)
+        self.assertEqual(1, self.doc_class.objects().all()[:1].update(rank=10))
+        self.assertEqual(1, self.doc_class.objects().filter({'rank__gte': 10}).count())
+        with self.assertRaises(ValidationException):
+            self.doc_class.objects().all().update(no_subscriptions=50)
+        with self.assertRaises(ValidationException):
+            self.doc_class.objects().all().update(email='same@ymca.com')
+        with self.assertRaises(ValueError):
+            self.doc_class.objects().all().update(nonexistent_field=1)
+
+    def test_lazy_indexing(self):
+        qs = self.doc_class.objects().all()
+        ids = [doc._id for doc in self.doc_class.all()]
+        self.assertEqual(ids[1], qs[1]._id)
+        self.assertEqual(ids[-1], qs[-1]._id)
+        self.assertEqual(ids[1:], [doc._id for doc in qs[1:]])
+        self.assertIsNone(qs._result_cache)
+        with self.assertRaises(IndexError):
+            qs[3]
+        qs = self.doc_class.objects().filter({'city': 'durham'})
+        self.assertEqual(1, len(list(qs[1:5])))
+        self.assertEqual(qs[0]._id, list(qs)[0]._id)
+
     def test_objects_get_multiple_results(self):
         with self.assertRaises(QueryError) as vm:
             self.doc_class.objects().get({'city': 'durham'})
@@ -291,6 +731,18 @@ class S3RedisQueryTestCase(KevTestCase):
         with self.assertRaises(AttributeError):
             list(self.doc_class.all(skip=-1))
 
+    def test_sorted_slices(self):
+        for key in ('gpa', 'rank'):
+            reverse = key == 'gpa'
+            qs = self.doc_class.objects().filter({'city': 'Durham'}).sort_by(key, reverse=reverse)
+            self.assertEqual([self.t3.name], [doc.name for doc in qs[:1]])
+            qs = self.doc_class.objects().all().sort_by(key, reverse=not reverse)
+            self.assertEqual([self.t2.name, self.t3.name], [doc.name for doc in qs[1:3]])
+            self.assertEqual([self.t2.name], [doc.name for doc in qs[1:3][:1]])
+            self.assertEqual([], list(qs[3:]))
+            qs = self.doc_class.objects().all(skip=1, limit=1).sort_by(key)
+            self.assertEqual([self.t2.name], [doc.name for doc in qs])
+
     def test_sorting(self):
         qs = self.doc_class.objects().filter({'city': 'Durham'}).sort_by('name')
         self.assertEqual(2, qs.count())
@@ -316,10 +768,42 @@ class S3RedisQueryTestCase(KevTestCase):
         qs = self.doc_class.objects().all().sort_by('name', reverse=True)
         self.assertEqual(qs[2].name, 'Goo and Sons')
 
+class S3RedisSaveTestCase(KevTestCase):
+
+    doc_class = S3RedisTestDocumentSlug
+
+    def test_failed_index_write(self):
+        db = self.doc_class.get_db()
+        doc = self.doc_class(name='Goo and Sons', slug='goo-sons', gpa=3.0,
+                             email='goo@sons.com', city='Durham', rank=3)
+        db.write_indexes = lambda doc_obj, doc, pipe: pipe.execute_command('NOSUCHCOMMAND')
+        try:
+            with self.assertRaises(redis.RedisError):
+                doc.save()
+        finally:
+            del db.write_indexes
+        self.assertIsNone(db.get_object(doc._id))
+        self.assertIsNone(db.get_unique_owner(doc, 'slug', 'goo-sons'))
+        doc = self.doc_class(name='Goo and Sons', slug='goo-sons', gpa=3.0,
+                             email='goo@sons.com', city='Durham', rank=3)
+        doc.save()
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'durham'}).count())
+
+
 class RedisQueryTestCase(S3RedisQueryTestCase):
 
     doc_class = RedisTestDocumentSlug
 
+    def test_sort_index(self):
+        db = self.doc_class.get_db()
+        sort_key = self.doc_class.get_sort_index_name('rank')
+        self.assertEqual(3, db._indexer.zcard(sort_key))
+        qs = self.doc_class.objects().filter({'city': 'Durham'}).sort_by('rank')
+        self.assertEqual([self.t3._id.encode()], db.get_sorted_id_list(
+            qs.prepare_filters(), qs.sortingp_list, qs[:1].all_param, self.doc_class))
+        self.t3.delete()
+        self.assertEqual(2, db._indexer.zcard(sort_key))
+
     def test_sorting(self):
         qs = self.doc_class.objects().filter({'city': 'Durham'}).sort_by('name')
         self.assertEqual(2, qs.count())
@@ -346,22 +830,285 @@ class RedisQueryTestCase(S3RedisQueryTestCase):
         self.assertEqual(qs[2].name, 'Goo and Sons')
 
 
+    def test_partial_update(self):
+        doc = self.doc_class.get(self.t1.id)
+        # Written behind the loaded document's back, and left alone by the
+        # partial update below
+        self.doc_class.get_db()._db.hset(self.t1._id, 'gpa', '1.5')
+        doc.city = 'Raleigh'
+        doc.save()
+        doc = self.doc_class.get(self.t1.id)
+        self.assertEqual(1.5, doc.gpa)
+        self.assertEqual('Raleigh', doc.city)
+        self.assertEqual(self.t1.name, doc.name)
+
+    def test_query_plan(self):
+        db = self.doc_class.get_db()
+        filters = self.doc_class.objects().filter(
+            {'city': 'durham', 'rank__lte': 2}).prepare_filters()
+        key, count, stored = db.plan_query(filters, self.doc_class)
+        self.assertEqual((1, True), (count, stored))
+        self.assertEqual([self.t3._id.encode()], list(db._indexer.smembers(key)))
+        self.assertEqual(key, db.plan_query(filters, self.doc_class)[0])
+        self.t1.rank = 2
+        self.t1.save()
+        # The result of the previous version only lingers briefly
+        self.assertLessEqual(db._indexer.ttl(key), db.stale_result_ttl)
+        key, count, stored = db.plan_query(filters, self.doc_class)
+        self.assertEqual(2, count)
+        # A single index set is read directly and an empty one ends the plan
+        filters = self.doc_class.objects().filter({'city': 'durham'}).prepare_filters()
+        self.assertEqual((filters[0], 2, False), db.plan_query(filters, self.doc_class))
+        filters = self.doc_class.objects().filter(
+            {'city': 'raleigh', 'rank__gte': 1}).prepare_filters()
+        self.assertEqual((None, 0, False), db.plan_query(filters, self.doc_class))
+        db.query_cache_ttl = 0
+        try:
+            qs = self.doc_class.objects().filter({'city': 'durham', 'rank__gte': 1})
+            self.assertEqual(2, qs.count())
+            self.assertEqual([self.t3.name], [doc.name for doc in qs.sort_by('name')[1:]])
+            self.assertEqual([], list(db._indexer.scan_iter('*:tmp:*')))
+        finally:
+            del db.query_cache_ttl
+
+    def test_fetch_page(self):
+        db = self.doc_class.get_db()
+        qs = self.doc_class.objects().filter({'rank__gte': 1})
+        args = (qs.prepare_filters(), [], qs.all_param, self.doc_class)
+        self.assertIsNone(db.fetch_page(*args))
+        page = db.fetch_page(*args[:2] + (AllParam(skip=1, limit=1),) + args[3:])
+        self.assertEqual(1, len(page))
+        self.assertEqual([self.t2.name, self.t3.name],
+                         [doc.name for doc in qs.sort_by('rank', reverse=True)[1:3]])
+        self.assertEqual([self.t2.name], [doc.name for doc in qs.filter(
+            {'city': 'charlotte'}).sort_by('rank').only('name')[:5]])
+        self.assertEqual([2, 3], list(self.doc_class.objects().all().sort_by('rank')[1:3]
+                                      .values_list('rank', flat=True)))
+        self.assertEqual([], list(self.doc_class.objects().filter(
+            {'city': 'raleigh'})[:5]))
+        # A sorted index missing documents is left to the Python sort
+        db._indexer.zrem(self.doc_class.get_sort_index_name('rank'), self.t1._id)
+        self.assertIsNone(db.fetch_page(
+            None, [SortingParam('rank')], AllParam(all=True, limit=2), self.doc_class))
+        self.assertEqual([self.t3.name, self.t2.name], [
+            doc.name for doc in self.doc_class.objects().all().sort_by('rank')[:2]])
+
+    def test_sorted_index_aggregates(self):
+        db = self.doc_class.get_db()
+        self.assertEqual((3, {'rank': (None, None, 1, 3)}),
+                         db.aggregate(None, self.doc_class, [Min('rank'), Max('rank')]))
+        self.doc_class(name='No Rank Inc', slug='no-rank', email='no@rank.com',
+                       city='Charlotte').save()
+        result = self.doc_class.objects().filter({'city': 'charlotte'}).aggregate(
+            Min('rank'), Max('rank'), Avg('gpa'))
+        self.assertEqual((2, 2), (result['rank__min'], result['rank__max']))
+        self.assertAlmostEqual(3.1, result['gpa__avg'])
+        self.assertEqual({'rank__min': None, 'rank__max': None}, self.doc_class.objects().filter(
+            {'city': 'nowhere'}).aggregate(Min('rank'), Max('rank')))
+        # Without a complete sorted index the values are read instead
+        db._indexer.zrem(self.doc_class.get_sort_index_name('rank'), self.t3._id)
+        self.assertEqual(1, self.doc_class.objects().filter(
+            {'city': 'durham'}).aggregate(Min('rank'))['rank__min'])
+
+    def test_compound_index_wildcards(self):
+        RedisCompoundTestDocument(city='Durham', rank=3, state='open').save()
+        RedisCompoundTestDocument(city='Durham', rank=3, state='closed').save()
+        RedisCompoundTestDocument(city='Charlotte', rank=3, state='open').save()
+        qs = RedisCompoundTestDocument.objects().filter({'city': 'du*', 'rank': 3})
+        self.assertEqual(2, len(qs.prepare_filters()))
+        self.assertEqual(2, qs.count())
+        self.assertEqual(1, RedisCompoundTestDocument.objects().filter(
+            {'city': 'du*', 'state': 'open'}).count())
+        self.assertEqual(1, RedisCompoundTestDocument.objects().filter(
+            {'city': 'durham', 'state': 'open'}).count())
+
+    def test_exact_glob_characters(self):
+        # Without a '*' the value is matched exactly
+        self.t2.city = 'Who?'
+        self.t2.save()
+        self.t3.city = 'Whoa'
+        self.t3.save()
+        self.assertEqual([self.t2.name], [doc.name for doc in self.doc_class.objects().filter(
+            {'city': 'who?'})])
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'who*'}).count())
+
+    def test_index_registry(self):
+        db = self.doc_class.get_db()
+        registry = db.get_index_registry(self.doc_class.get_index_name('city', ''))[0]
+        self.assertEqual([b'charlotte', b'durham'], db._indexer.zrange(registry, 0, -1))
+        self.t2.city = 'Dunham'
+        self.t2.save()
+        self.assertEqual([b'dunham', b'durham'], db._indexer.zrange(registry, 0, -1))
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'dun*'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'city': '*nham'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'd?nha*'}).count())
+        self.assertEqual(1, self.doc_class.objects().filter({'city': 'du[nx]ha*'}).count())
+        self.assertEqual(2, self.doc_class.objects().filter({'city': 'du[^n]ha*'}).count())
+        self.assertEqual(3, self.doc_class.objects().filter({'city': 'du*'}).count())
+        self.assertEqual(0, self.doc_class.objects().filter(
+            {'city': 'durham', 'name': 'x*'}).count())
+        db._indexer.delete(registry)
+        db.build_index_registry(self.doc_class)
+        self.assertEqual([b'dunham', b'durham'], db._indexer.zrange(registry, 0, -1))
+
+    def test_only_loads_partial_documents(self):
+        doc = self.doc_class.get(self.t1.id, fields=['name'])
+        self.assertEqual(set(['name', '_id']), set(doc._data))
+        self.assertEqual(self.t1.city, doc.city)
+        self.assertEqual(self.t1.email, doc._data['email'])
+        doc = self.doc_class.objects().all().only('name')[0]
+        doc.delete()
+        self.assertEqual(0, self.doc_class.objects().filter({'email': doc.email}).count())
+        with self.assertRaises(DocNotFoundError):
+            self.doc_class.get('missing', fields=['name'])
+
+
+@unittest.skipUnless(env('REDIS_CLUSTER_HOST_TEST', None),
+                     'Set REDIS_CLUSTER_HOST_TEST to test against a Redis Cluster')
+class RedisClusterQueryTestCase(RedisQueryTestCase):
+
+    doc_class = RedisClusterTestDocumentSlug
+
+    def test_key_slots(self):
+        db = self.doc_class.get_db()
+        slots = set(db._indexer.keyslot(key) for key in db._indexer.scan_iter('*'))
+        self.assertEqual(1, len(slots))
+        self.assertEqual(slots, {db._indexer.keyslot(self.t1._id)})
+
+
+class ShardedRedisQueryTestCase(S3RedisQueryTestCase):
+
+    doc_class = ShardedRedisTestDocumentSlug
+
+    def test_shard_placement(self):
+        db = self.doc_class.get_db()
+        for shard in db.get_shards():
+            ids = shard._indexer.smembers(shard.get_model_set_name(self.doc_class))
+            for doc_id in ids:
+                self.assertIs(shard, db.get_doc_shard(doc_id.decode()))
+        self.assertEqual(3, sum(shard.count(None, AllParam(all=True), self.doc_class)
+                                for shard in db.get_shards()))
+        owner = db.get_shard(self.t1.get_unique_name('slug', self.t1.slug))
+        self.assertEqual(self.t1._id, RedisDB.get_unique_owner(
+            owner, self.t1, 'slug', self.t1.slug))
+
+    def test_hash_ring(self):
+        nodes = ['node-{0}'.format(i) for i in range(4)]
+        ring, grown = HashRing(nodes), HashRing(nodes + ['node-4'])
+        keys = ['{0:010x}'.format(i * 7919) for i in range(2000)]
+        moved = [key for key in keys if ring.get_node(key) != grown.get_node(key)]
+        self.assertTrue(all(grown.get_node(key) == 'node-4' for key in moved))
+        self.assertLess(abs(len(moved) / len(keys) - 0.2), 0.05)
+
+    def test_failed_write_keeps_reservations(self):
+        db = self.doc_class.get_db()
+        shard = db.get_doc_shard(self.t1._id)
+        shard.add_indexes = lambda doc_obj, doc, pipe: pipe.execute_command('NOSUCHCOMMAND')
+        self.t1.slug = 'goo-sons-two'
+        try:
+            with self.assertRaises(redis.RedisError):
+                self.t1.save()
+        finally:
+            del shard.add_indexes
+        # The old value is only released once the document is written
+        self.assertEqual(self.t1._id, db.get_unique_owner(self.t1, 'slug', 'goo-sons'))
+        self.assertIsNone(db.get_unique_owner(self.t1, 'slug', 'goo-sons-two'))
+
+    def test_rebalance(self):
+        db = self.doc_class.get_db()
+        nodes = db._kwargs['nodes'] + [dict(db._kwargs['nodes'][0], db=4)]
+        grown = ShardedRedisDB(nodes=nodes)
+        try:
+            created = []
+            for i in range(40):
+                doc = self.doc_class(name='Shard Doc {0}'.format(i), slug='shard-{0}'.format(i),
+                                     email='shard{0}@doc.com'.format(i), city='Raleigh',
+                                     gpa=3.5, rank=i + 4)
+                doc.save()
+                created.append(doc._id)
+            ids = [doc._id for doc in self.doc_class.all()]
+            # Only the Raleigh documents are picked so the facets are known
+            misplaced = [doc_id for doc_id in created if grown.get_doc_shard(doc_id).name
+                         != db.get_doc_shard(doc_id).name]
+            moving = len([doc_id for doc_id in ids if grown.get_doc_shard(doc_id).name
+                          != db.get_doc_shard(doc_id).name])
+            self.assertGreater(len(misplaced), 1)
+            # Reads fall back to the old node and writes move the document
+            doc_id = self.doc_class.get_db().parse_id(misplaced[0])
+            self.assertEqual(doc_id, grown.get(self.doc_class, doc_id).id)
+            grown.incr(grown.get(self.doc_class, doc_id), 'rank', 1)
+            doc = grown.get(self.doc_class, db.parse_id(misplaced[1]))
+            doc.city = 'Cary'
+            grown.save(doc)
+            self.assertEqual(43, grown.count(None, AllParam(all=True), self.doc_class))
+            self.assertEqual({'raleigh': 39, 'cary': 1, 'durham': 2, 'charlotte': 1},
+                             grown.facets(None, self.doc_class, ['city'])['city'])
+            moved = grown.rebalance(self.doc_class)
+            self.assertEqual(moving - 2, moved)
+            self.assertEqual(0, grown.rebalance(self.doc_class))
+            self.assertEqual(43, grown.count(None, AllParam(all=True), self.doc_class))
+            self.assertEqual(sorted(ids), [doc._id for doc in grown.all(self.doc_class, None, None)])
+            self.assertEqual({'raleigh': 39, 'cary': 1, 'durham': 2, 'charlotte': 1},
+                             grown.facets(None, self.doc_class, ['city'])['city'])
+            self.assertEqual(self.t1._id, grown.get_unique_owner(self.t1, 'slug', self.t1.slug))
+        finally:
+            grown.get_shards()[-1].flush_db()
+
+    def test_rebalance_unique_conflict(self):
+        db = self.doc_class.get_db()
+        nodes = db._kwargs['nodes'] + [dict(db._kwargs['nodes'][0], db=4)]
+        grown = ShardedRedisDB(nodes=nodes)
+        keys = (self.doc_class.get_unique_name('slug', 'slug-{0}'.format(i)) for i in range(100))
+        key = next(key for key in keys
+                   if grown.get_shard(key).name != db.get_shard(key).name)
+        db.get_shard(key)._indexer.set(key, 'old-owner')
+        grown.get_shard(key)._indexer.set(key, 'new-owner')
+        try:
+            with self.assertRaises(ResourceError):
+                grown.rebalance(self.doc_class)
+            self.assertEqual(b'old-owner', db.get_shard(key)._indexer.get(key))
+        finally:
+            grown.get_shards()[-1].flush_db()
+
+
 class S3QueryTestCase(S3RedisQueryTestCase):
 
     doc_class = S3TestDocumentSlug
 
     def test_wildcard_queryset_chaining(self):
+        # Wildcards are matched literally by the S3 backend
         qs = self.doc_class.objects().filter(
             {'name': 'Goo and Sons'}).filter({'city': 'Du*ham'})
-        with self.assertRaises(ValueError):
-            qs.count()
-
-
-    def test_queryset_chaining(self):
-        qs = self.doc_class.objects().filter(
-            {'name': 'Goo and Sons'}).filter({'city': 'Durham'})
-        with self.assertRaises(ValueError):
-            qs.count()
+        self.assertEqual(0, qs.count())
+
+    def test_multi_filter_listing(self):
+        db = self.doc_class.get_db()
+        db.list_page_size, db.verify_size = 1, 1
+        try:
+            qs = self.doc_class.objects().filter({'city': 'durham', 'rank__lte': 2})
+            self.assertEqual([self.t3.name], [doc.name for doc in qs])
+            qs = self.doc_class.objects().filter({'city': 'durham', 'slug': self.t1.slug})
+            self.assertEqual(1, qs.count())
+            qs = self.doc_class.objects().filter({'city': 'durham', 'slug': self.t2.slug})
+            self.assertEqual(0, qs.count())
+            qs = self.doc_class.objects().filter({'city': 'durham', 'rank__gte': 1,
+                                                   'email': self.t3.email})
+            self.assertEqual([self.t3.id], list(qs.values_list('id', flat=True)))
+        finally:
+            del db.list_page_size, db.verify_size
+
+    def test_filtered_evaluate_lists_once(self):
+        db = self.doc_class.get_db()
+        calls = []
+        intersect_filters = db.intersect_filters
+        db.intersect_filters = lambda filters_list: calls.append(
+            filters_list) or intersect_filters(filters_list)
+        try:
+            qs = self.doc_class.objects().filter({'city': 'durham', 'rank__lte': 2})
+            self.assertEqual([self.t3.name], [doc.name for doc in qs])
+            self.assertEqual(1, len(calls))
+        finally:
+            del db.intersect_filters
 
     def test_non_unique_wildcard_filter(self):
         qs = self.doc_class.objects().filter({'city': 'du*ham'})
@@ -370,6 +1117,23 @@ class S3QueryTestCase(S3RedisQueryTestCase):
     def test_non_unique_wildcard_filter(self):
         pass
 
+    def test_all_resumes_listing(self):
+        ids = [doc._id for doc in self.doc_class.all()]
+        db = self.doc_class.get_db()
+        self.assertEqual(ids[:2], [doc._id for doc in self.doc_class.all(limit=2)])
+        self.assertEqual({}, db.get_page_cursors(self.doc_class))
+        db.page_cursor_size = 1000
+        try:
+            self.assertEqual(ids[:2], [doc._id for doc in self.doc_class.all(limit=2)])
+            cursors = db.get_page_cursors(self.doc_class)[db.all_prefix(self.doc_class)]
+            self.assertIn(2, cursors)
+            self.assertEqual(ids[2:], [doc._id for doc in self.doc_class.all(skip=2)])
+            self.doc_class(name='Zed and Sons', slug='zed-and-sons', gpa=3.0,
+                           email='zed@ymca.com', city='Durham').save()
+            self.assertEqual({}, db.get_page_cursors(self.doc_class))
+        finally:
+            del db.page_cursor_size
+
     @unittest.skip("Takes more than 10 min to complete.")
     def test_more_than_hundred_objects(self):
         count = 1100
@@ -204,6 +204,18 @@ class PropertiesTestCase(unittest.TestCase):
         prop.validate(None, 'is_active')
         self.assertEqual(type(prop.get_default_value()), type(True))
 
+    def test_sortable_property(self):
+        with self.assertRaises(ValueError):
+            CharProperty(sortable=True)
+        prop = IntegerProperty(sortable=True)
+        self.assertEqual(prop.get_score('7'), 7.0)
+        self.assertEqual(prop.get_score(None), float('-inf'))
+        prop = DateTimeProperty(sortable=True)
+        self.assertEqual(prop.get_score('1970-01-02T00:00:00Z'), 86400.0)
+        self.assertLess(DateProperty(sortable=True).get_score('2020-01-01'),
+                        DateProperty(sortable=True).get_score('2020-01-02'))
+        self.assertFalse(IntegerProperty(index=True).sortable)
+
 
 if __name__ == '__main__':
     unittest.main()
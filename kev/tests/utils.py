@@ -1,6 +1,7 @@
 import unittest
 
-from kev.utils import import_util, import_mod, get_doc_type
+from kev.utils import import_util, import_mod, get_doc_type, encode_score, \
+    translate_glob
 from kev.document import Document
 from kev.properties import CharProperty
 
@@ -24,5 +25,21 @@ class UtilTest(unittest.TestCase):
         b = get_doc_type(Dog)
         self.assertEqual('animal', b)
 
+    def test_encode_score(self):
+        scores = [float('-inf'), -1e9, -2.5, -0.0, 0.5, 3, 1e12, float('inf')]
+        encoded = [encode_score(i) for i in scores]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual(16, len(encoded[0]))
+
+    def test_translate_glob(self):
+        prefix, match = translate_glob('du?h[a-c]m*')
+        self.assertEqual('du', prefix)
+        self.assertTrue(match.fullmatch('durham city'))
+        self.assertFalse(match.fullmatch('durhem'))
+        prefix, match = translate_glob('n\\*y[^x]')
+        self.assertEqual('n*y', prefix)
+        self.assertTrue(match.fullmatch('n*yc'))
+        self.assertFalse(match.fullmatch('nayc'))
+
 if __name__ == '__main__':
     unittest.main()
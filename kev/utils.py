@@ -1,4 +1,6 @@
+import re
 import sys
+import struct
 import importlib
 
 
@@ -29,3 +31,79 @@ def get_doc_type(klass):
         if klass.Meta.doc_type is not None:
             return klass.Meta.doc_type
     return klass.__name__
+
+
+def chunks(iterable, size):
+    '''
+    Splits an iterable into lists of at most size items.
+    @param iterable:
+    @param size:
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_score(score):
+    '''
+    Encodes a float score as a fixed width hex string whose lexicographic
+    order matches the numeric order, for key-ordered stores like S3.
+    @param score:
+    '''
+    bits = struct.unpack('>Q', struct.pack('>d', float(score)))[0]
+    if bits & (1 << 63):
+        bits ^= 0xFFFFFFFFFFFFFFFF
+    else:
+        bits |= 1 << 63
+    return '{0:016x}'.format(bits)
+
+
+def translate_glob(pattern):
+    '''
+    Translates a Redis glob pattern (*, ?, [...] classes and backslash
+    escapes) into a compiled regex. Returns the literal text before the
+    first wildcard along with the regex.
+    @param pattern:
+    '''
+    prefix = None
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        j = pattern.find(']', i + 1) if c == '[' else -1
+        if prefix is None and (c in '*?' or j != -1):
+            prefix = ''.join(regex)
+        if c == '*':
+            regex.append('.*')
+        elif c == '?':
+            regex.append('.')
+        elif j != -1:
+            body, k = [], i + 1
+            if pattern[k:k + 1] in ('^', '!'):
+                body.append('^')
+                k += 1
+            while k < j:
+                if pattern[k] == '\\' and k + 1 < j:
+                    k += 1
+                    body.append(re.escape(pattern[k]))
+                elif pattern[k] == '-':
+                    body.append('-')
+                else:
+                    body.append(re.escape(pattern[k]))
+                k += 1
+            regex.append('[{0}]'.format(''.join(body)))
+            i = j
+        else:
+            if c == '\\' and i + 1 < n:
+                i += 1
+            regex.append(re.escape(pattern[i]))
+        i += 1
+    if prefix is None:
+        prefix = ''.join(regex)
+    return re.sub(r'\\(.)', r'\1', prefix), \
+        re.compile(''.join(regex), re.DOTALL)